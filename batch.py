@@ -0,0 +1,63 @@
+import json
+import logging
+from db import batch_transaction
+
+logger = logging.getLogger(__name__)
+
+# Команды, которые нельзя выполнять внутри пакета
+EXCLUDED_COMMANDS = ('batch', 'serve', 'migrate_schema', 'gc_blobs', 'purge', 'send_mail', 'download_file', 'migrate')
+
+def execute_request(line, storage, execute_command):
+    try:
+        request = json.loads(line)
+        command = request['command']
+        args = request.get('args', [])
+        if not isinstance(args, list):
+            raise ValueError('args must be a list')
+    except (ValueError, KeyError, TypeError) as e:
+        logger.error("Invalid batch request: %s", e)
+        return {'error': f'Invalid request: {str(e)}'}
+    if command in EXCLUDED_COMMANDS:
+        return {'error': f'Command {command} is not allowed in batch'}
+    return execute_command(command, [str(arg) for arg in args], storage)
+
+def execute_group(lines, storage, execute_command):
+    results = []
+    try:
+        with batch_transaction() as batch:
+            for line in lines:
+                result = execute_request(line, storage, execute_command)
+                batch.end_command('error' not in result)
+                results.append(result)
+    except Exception as e:
+        logger.error("Batch of %s commands failed: %s", len(lines), e)
+        return [{'error': f'Batch failed: {str(e)}'} for _ in lines]
+    return results
+
+def run_batch(source, output, storage, execute_command, batch_size):
+    processed = 0
+    failed = 0
+    lines = []
+
+    def flush():
+        nonlocal processed, failed
+        # Результаты выдаются только после фиксации группы
+        for result in execute_group(lines, storage, execute_command):
+            output.write(json.dumps(result) + '\n')
+            processed += 1
+            if 'error' in result:
+                failed += 1
+        output.flush()
+        lines.clear()
+
+    for line in source:
+        if not line.strip():
+            continue
+        lines.append(line)
+        if len(lines) >= batch_size:
+            flush()
+    if lines:
+        flush()
+
+    logger.info("Batch completed: %s commands, %s failed", processed, failed)
+    return {'message': 'Batch completed', 'processed': processed, 'failed': failed}
@@ -0,0 +1,83 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import generate, MAIN
+
+# Команды только для чтения, которые PHP вызывает на каждой странице
+READ_COMMANDS = {
+    'get_tasks': lambda s: [s['user_id'], 'created_at'],
+    'get_notes': lambda s: [s['user_id'], s['task_ids'][0], 'created_at'],
+    'get_dashboard': lambda s: [s['user_id'], 'created_at', s['task_ids'][0]],
+    'get_subtasks': lambda s: [s['user_id'], s['task_ids'][0]],
+    'get_shared_notes': lambda s: [s['target_user_id']],
+    'search': lambda s: [s['user_id'], 'budget'],
+    'list_files': lambda s: [s['user_id'], s['task_ids'][0]],
+}
+# Модули, которые команды чтения загружать не должны
+FORBIDDEN = ('bcrypt', 'smtplib', 'email.mime.text', 'mimetypes', 'argparse', 'secrets', 'shutil')
+DEFAULT_MAX_IMPORT_MS = 60
+RUNS = 5
+
+def import_profile(command, args, config_path):
+    env = dict(os.environ, NOTE_SERVER_CONFIG=config_path)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', MAIN, command] + args, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    total_us = 0
+    modules = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # Время верхнего уровня уже включает вложенные импорты
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+    return total_us / 1000, modules, proc.stdout
+
+def check(storage, max_import_ms, tmpdir):
+    root = tempfile.mkdtemp(prefix=f'note_startup_{storage}_', dir=tmpdir)
+    try:
+        sample = generate(root, storage, 2000)
+        results = {}
+        for command, make_args in READ_COMMANDS.items():
+            runs = [import_profile(command, make_args(sample), sample['config']) for _ in range(RUNS)]
+            import_ms = min(run[0] for run in runs)
+            forbidden = sorted(name for name in FORBIDDEN if name in runs[0][1])
+            try:
+                ok = 'error' not in json.loads(runs[0][2])
+            except ValueError:
+                ok = False
+            results[command] = {
+                "import_ms": round(import_ms, 2),
+                "forbidden_imports": forbidden,
+                "command_ok": ok,
+                "passed": ok and not forbidden and import_ms <= max_import_ms
+            }
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check cold-start imports of read-only commands')
+    parser.add_argument('--storage', default='sqlite,txt')
+    parser.add_argument('--max-import-ms', type=float, default=DEFAULT_MAX_IMPORT_MS,
+                        help='cap on the summed top-level -X importtime of one command (best of runs)')
+    parser.add_argument('--tmpdir', default=None)
+    args = parser.parse_args()
+
+    report = {storage: check(storage, args.max_import_ms, args.tmpdir) for storage in args.storage.split(',') if storage}
+    print(json.dumps(report, indent=2))
+    failed = [f"{storage} {command}" for storage, results in report.items()
+              for command, result in results.items() if not result['passed']]
+    if failed:
+        print(f"Startup check failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,217 @@
+import os
+import sys
+import random
+import sqlite3
+import hashlib
+import datetime
+import subprocess
+import bcrypt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN = os.path.join(ROOT, 'main.py')
+
+BENCH_PASSWORD = 'BenchPass1'
+WORDS = ('report', 'budget', 'meeting', 'draft', 'review', 'release', 'invoice', 'plan',
+         'design', 'backup', 'server', 'client', 'deadline', 'sprint', 'contract', 'travel')
+MIME_TYPES = (('txt', 'text/plain'), ('png', 'image/png'), ('pdf', 'application/pdf'), ('jpg', 'image/jpeg'))
+DISTINCT_BLOBS = 16
+CHUNK_ROWS = 50000
+SAMPLE_IDS = 1000
+BASE_TIME = datetime.datetime(2025, 1, 1)
+
+# Доли строк каждого вида от общего объёма --rows
+SHARES = {'tasks': 0.3, 'notes': 0.45, 'subtasks': 0.15, 'files': 0.05, 'shared_notes': 0.05}
+ROWS_PER_USER = 1000
+
+def write_config(root, storage, extra=None):
+    values = {
+        'STORAGE': storage,
+        'USERS_TXT': os.path.join(root, 'users.txt'),
+        'TASKS_TXT': os.path.join(root, 'tasks.txt'),
+        'NOTES_TXT': os.path.join(root, 'notes.txt'),
+        'SUBTASKS_TXT': os.path.join(root, 'subtasks.txt'),
+        'FILES_TXT': os.path.join(root, 'files.txt'),
+        'SHARED_NOTES_TXT': os.path.join(root, 'shared_notes.txt'),
+        'RESET_TOKENS_TXT': os.path.join(root, 'reset_tokens.txt'),
+        'USERS_DB': os.path.join(root, 'users.db'),
+        'TASKS_DB': os.path.join(root, 'tasks.db'),
+        'FILES_DIR': os.path.join(root, 'files'),
+        'LOG_FILE': os.path.join(root, 'note_server.log'),
+        'SMTP_HOST': '127.0.0.1',
+        'SMTP_PORT': '25',
+        'SMTP_USER': '',
+        'SMTP_PASS': '',
+        'SMTP_FROM': 'bench@example.com',
+        'SERVER_HOST': 'localhost',
+        'DAEMON_SOCKET': os.path.join(root, 'note_server.sock'),
+        'MAIL_SPOOL_DIR': os.path.join(root, 'mail_spool'),
+        'BCRYPT_ROUNDS': '4',
+    }
+    values.update(extra or {})
+    path = os.path.join(root, 'set.conf')
+    with open(path, 'w') as f:
+        f.write('[DEFAULT]\n')
+        for name, value in values.items():
+            f.write(f"{name} = {value}\n")
+    os.makedirs(values['FILES_DIR'], exist_ok=True)
+    return path, values
+
+class Generator:
+    # Идентификаторы и владельцы вычисляются из номера строки, поэтому
+    # генерация 10M строк не держит в памяти списки уже созданных записей
+    def __init__(self, rows, seed):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.counts = {kind: max(1, int(rows * share)) for kind, share in SHARES.items()}
+        self.counts['users'] = max(2, rows // ROWS_PER_USER)
+
+    def make_id(self, kind, i):
+        return hashlib.blake2b(f"{self.seed}:{kind}:{i}".encode(), digest_size=8).hexdigest()
+
+    def text(self, words):
+        return ' '.join(self.rng.choice(WORDS) for _ in range(words))
+
+    def timestamp(self, i):
+        return (BASE_TIME + datetime.timedelta(seconds=i, microseconds=1 + i % 999999)).isoformat()
+
+    def task_owner(self, task):
+        return task % self.counts['users']
+
+    def note_task(self, note):
+        return note % self.counts['tasks']
+
+    def users(self, password_hash):
+        for i in range(self.counts['users']):
+            yield (self.make_id('user', i), f"bench_user_{i}", password_hash, f"bench{i}@example.com", 'ru', 'light')
+
+    def tasks(self):
+        for i in range(self.counts['tasks']):
+            yield (self.make_id('task', i), self.make_id('user', self.task_owner(i)), self.text(3), self.text(8),
+                   self.rng.choice(('pending', 'done')), self.timestamp(i), 0)
+
+    def notes(self):
+        for i in range(self.counts['notes']):
+            task = self.note_task(i)
+            yield (self.make_id('note', i), self.make_id('user', self.task_owner(task)), self.make_id('task', task),
+                   self.text(12), self.timestamp(i), 0)
+
+    def subtasks(self):
+        for i in range(self.counts['subtasks']):
+            yield (self.make_id('subtask', i), self.make_id('task', i % self.counts['tasks']), self.text(2), self.rng.randint(0, 1))
+
+    def files(self, blobs):
+        for i in range(self.counts['files']):
+            task = i % self.counts['tasks']
+            ext, mime = MIME_TYPES[i % len(MIME_TYPES)]
+            path, size, sha = blobs[i % len(blobs)]
+            yield (self.make_id('file', i), self.make_id('user', self.task_owner(task)), self.make_id('task', task),
+                   f"file_{i}.{ext}", mime, path, size, sha)
+
+    def shared_notes(self):
+        # Каждый пользователь делится заметками со следующим по номеру
+        for i in range(min(self.counts['shared_notes'], self.counts['notes'])):
+            owner = self.task_owner(self.note_task(i))
+            target = (owner + 1) % self.counts['users']
+            yield (self.make_id('user', owner), self.make_id('user', target), self.make_id('note', i))
+
+    def owned(self, kind, user):
+        ids = []
+        if kind == 'task':
+            for task in range(user, self.counts['tasks'], self.counts['users']):
+                ids.append(self.make_id('task', task))
+                if len(ids) >= SAMPLE_IDS:
+                    break
+        else:
+            for task in range(user, self.counts['tasks'], self.counts['users']):
+                for note in range(task, self.counts['notes'], self.counts['tasks']):
+                    ids.append(self.make_id('note', note))
+                if len(ids) >= SAMPLE_IDS:
+                    break
+        return ids
+
+def make_blobs(files_dir, count):
+    blobs = []
+    blob_dir = os.path.join(files_dir, 'bench')
+    os.makedirs(blob_dir, exist_ok=True)
+    for i in range(count):
+        content = os.urandom(1024 * (i + 1))
+        path = os.path.join(blob_dir, f"blob_{i}")
+        with open(path, 'wb') as f:
+            f.write(content)
+        blobs.append((path, len(content), hashlib.sha256(content).hexdigest()))
+    return blobs
+
+def chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def bench_hash(config):
+    return bcrypt.hashpw(BENCH_PASSWORD.encode('utf-8'), bcrypt.gensalt(int(config['BCRYPT_ROUNDS']))).decode('utf-8')
+
+def generate_sqlite(gen, config_path, config):
+    env = dict(os.environ, NOTE_SERVER_CONFIG=config_path)
+    subprocess.run([sys.executable, MAIN, 'migrate_schema'], env=env, check=True, stdout=subprocess.DEVNULL)
+    with sqlite3.connect(config['USERS_DB']) as conn:
+        conn.executemany("INSERT INTO users (id, username, password_hash, email, language, theme) VALUES (?, ?, ?, ?, ?, ?)",
+                         gen.users(bench_hash(config)))
+
+    conn = sqlite3.connect(config['TASKS_DB'])
+    conn.execute("PRAGMA synchronous = OFF")
+    inserts = (
+        (gen.tasks(), "INSERT INTO tasks (id, user_id, title, description, status, created_at, deleted) VALUES (?, ?, ?, ?, ?, ?, ?)"),
+        (gen.notes(), "INSERT INTO notes (id, user_id, task_id, content, created_at, deleted) VALUES (?, ?, ?, ?, ?, ?)"),
+        (gen.subtasks(), "INSERT INTO subtasks (id, task_id, title, completed) VALUES (?, ?, ?, ?)"),
+        (gen.files(make_blobs(config['FILES_DIR'], DISTINCT_BLOBS)),
+         "INSERT INTO files (id, user_id, task_id, filename, mime_type, path, size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"),
+        (gen.shared_notes(), "INSERT OR IGNORE INTO shared_notes (user_id, target_user_id, note_id) VALUES (?, ?, ?)"),
+    )
+    for rows, query in inserts:
+        for chunk in chunks(rows):
+            conn.executemany(query, chunk)
+    conn.execute("INSERT INTO blobs (sha256, size, refcount) SELECT sha256, MAX(size), COUNT(*) FROM files GROUP BY sha256")
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+def write_lines(path, rows):
+    with open(path, 'w') as f:
+        for chunk in chunks(rows):
+            f.write(''.join(':'.join(str(field) for field in row) + '\n' for row in chunk))
+
+def generate_txt(gen, config):
+    write_lines(config['USERS_TXT'], gen.users(bench_hash(config)))
+    write_lines(config['TASKS_TXT'], gen.tasks())
+    write_lines(config['NOTES_TXT'], gen.notes())
+    write_lines(config['SUBTASKS_TXT'], gen.subtasks())
+    write_lines(config['FILES_TXT'], gen.files(make_blobs(config['FILES_DIR'], DISTINCT_BLOBS)))
+    write_lines(config['SHARED_NOTES_TXT'], gen.shared_notes())
+    open(config['RESET_TOKENS_TXT'], 'a').close()
+
+def generate(root, storage, rows, seed=1, extra_config=None):
+    config_path, config = write_config(root, storage, extra_config)
+    gen = Generator(rows, seed)
+    if storage == 'sqlite':
+        generate_sqlite(gen, config_path, config)
+    else:
+        # log-хранилище при первом обращении импортирует те же txt-файлы
+        generate_txt(gen, config)
+
+    # Команды выполняются от имени первого пользователя; второй видит его общие заметки
+    return {
+        'config': config_path,
+        'user_id': gen.make_id('user', 0),
+        'username': 'bench_user_0',
+        'password': BENCH_PASSWORD,
+        'email': 'bench0@example.com',
+        'target_user_id': gen.make_id('user', 1),
+        'target_username': 'bench_user_1',
+        'task_ids': gen.owned('task', 0),
+        'note_ids': gen.owned('note', 0),
+        'counts': gen.counts,
+    }
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import queue
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import generate
+from run_bench import DaemonRunner, summarize, STORAGES
+
+# Задержка доставки меряется от запроса сброса пароля до приёма письма локальным SMTP-приёмником.
+# Опрос очереди намеренно редкий: если отправитель пропустил пробуждение, письмо придёт
+# только через MAIL_POLL_INTERVAL, и это сразу видно в p99
+POLL_INTERVAL = 60
+DELIVERY_TIMEOUT = 30
+
+class SmtpSink:
+    # Принимает письма и запоминает время приёма; aiosmtpd, если установлен, иначе smtpd (до Python 3.12)
+    def __init__(self):
+        self.arrivals = queue.SimpleQueue()
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            self.port = probe.getsockname()[1]
+        self.stop = self._start_aiosmtpd() or self._start_smtpd()
+
+    def received(self):
+        self.arrivals.put(time.perf_counter())
+
+    def _start_aiosmtpd(self):
+        try:
+            from aiosmtpd.controller import Controller
+        except ImportError:
+            return None
+        sink = self
+
+        class Handler:
+            async def handle_DATA(self, server, session, envelope):
+                sink.received()
+                return '250 OK'
+
+        controller = Controller(Handler(), hostname='127.0.0.1', port=self.port)
+        controller.start()
+        return controller.stop
+
+    def _start_smtpd(self):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', DeprecationWarning)
+            try:
+                import smtpd
+                import asyncore
+            except ImportError:
+                raise RuntimeError('SMTP sink needs aiosmtpd (pip install aiosmtpd) on Python 3.12+')
+        sink = self
+
+        class Server(smtpd.SMTPServer):
+            def process_message(self, peer, mailfrom, rcpttos, data, **kwargs):
+                sink.received()
+
+        server = Server(('127.0.0.1', self.port), None, decode_data=True)
+        thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.05}, daemon=True)
+        thread.start()
+
+        def stop():
+            server.close()
+            thread.join()
+        return stop
+
+    def wait(self, count):
+        # Время приёма count писем или None, если они не пришли за DELIVERY_TIMEOUT
+        times = []
+        deadline = time.monotonic() + DELIVERY_TIMEOUT
+        while len(times) < count:
+            try:
+                times.append(self.arrivals.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                return None
+        return times
+
+def bench_storage(storage, args, sink):
+    root = tempfile.mkdtemp(prefix=f'note_mail_{storage}_', dir=args.tmpdir)
+    try:
+        sample = generate(root, storage, args.rows, extra_config={
+            'SMTP_PORT': sink.port,
+            'SMTP_STARTTLS': 'false',
+            'MAIL_POLL_INTERVAL': POLL_INTERVAL,
+        })
+        runner = DaemonRunner(sample['config'], os.path.join(root, 'note_server.sock'))
+        try:
+            if storage == 'sqlite':
+                runner.run('migrate_schema', [])
+            # Первое письмо открывает SMTP-соединение, в замеры не входит
+            runner.run('request_password_reset', [sample['email']])
+            sink.wait(1)
+            latencies = []
+            errors = 0
+            started = time.perf_counter()
+            for _ in range(args.messages):
+                sent = time.perf_counter()
+                _, ok, _ = runner.run('request_password_reset', [sample['email']])
+                arrived = sink.wait(1) if ok else None
+                if arrived is None:
+                    errors += 1
+                else:
+                    latencies.append(arrived[0] - sent)
+            result = {"sequential": summarize(latencies, errors, time.perf_counter() - started, runner.peak_rss_kb())}
+            # Пачка писем подряд: очередь пополняется, пока отправитель занят проходом
+            started = time.perf_counter()
+            sent = 0
+            for _ in range(args.burst):
+                sent += runner.run('request_password_reset', [sample['email']])[1]
+            arrived = sink.wait(sent)
+            elapsed = time.perf_counter() - started
+            result["burst"] = {
+                "messages": args.burst,
+                "delivered": len(arrived) if arrived else None,
+                "drain_ms": round((arrived[-1] - started) * 1000, 3) if arrived else None,
+                "throughput_per_s": round(len(arrived) / elapsed, 2) if arrived else None,
+            }
+            print(f"{storage:7} sequential p50 {result['sequential']['p50_ms']:9.2f} ms  "
+                  f"p99 {result['sequential']['p99_ms']:9.2f} ms  errors {errors}  "
+                  f"burst {args.burst} drained in {result['burst']['drain_ms']} ms", file=sys.stderr)
+            return result
+        finally:
+            runner.close()
+    finally:
+        if args.keep:
+            print(f"Kept {storage} data in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Note Server mail sender benchmark against a local SMTP sink')
+    parser.add_argument('--storage', default='sqlite,txt', help=f"comma-separated: {', '.join(STORAGES)}")
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=50, help='password reset mails sent one at a time')
+    parser.add_argument('--burst', type=int, default=200, help='mails queued back to back')
+    parser.add_argument('--tmpdir', default=None, help='where to create temporary data directories')
+    parser.add_argument('--keep', action='store_true', help='keep generated data directories')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    storages = [storage for storage in args.storage.split(',') if storage]
+    unknown = [name for name in storages if name not in STORAGES]
+    if unknown or args.messages < 1 or args.burst < 1 or args.rows < 1:
+        parser.error(f"invalid arguments: {', '.join(unknown) or 'messages, burst and rows must be positive'}")
+
+    sink = SmtpSink()
+    try:
+        report = {"results": {storage: bench_storage(storage, args, sink) for storage in storages}}
+    finally:
+        sink.stop()
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    failed = [storage for storage, result in report['results'].items()
+              if result['sequential']['errors'] or result['burst']['delivered'] != args.burst]
+    if failed:
+        print(f"Mail benchmark failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
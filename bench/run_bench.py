@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from datagen import generate, MAIN, ROOT
+
+STORAGES = ('sqlite', 'txt', 'log')
+DAEMON_START_TIMEOUT = 30
+
+# Команда -> аргументы для i-й итерации; пишущие команды идут после читающих
+COMMANDS = {
+    'login': lambda s, i: [s['username'], s['password']],
+    'get_tasks': lambda s, i: [s['user_id'], 'created_at'],
+    'get_tasks_page': lambda s, i: [s['user_id'], 'created_at', '50'],
+    'get_dashboard': lambda s, i: [s['user_id'], 'created_at', s['task_ids'][0]],
+    'get_notes': lambda s, i: [s['user_id'], s['task_ids'][i % len(s['task_ids'])], 'created_at'],
+    'get_subtasks': lambda s, i: [s['user_id'], s['task_ids'][i % len(s['task_ids'])]],
+    'get_shared_notes': lambda s, i: [s['target_user_id']],
+    'search': lambda s, i: [s['user_id'], 'budget rep'],
+    'list_files': lambda s, i: [s['user_id'], '', '50'],
+    'create_task': lambda s, i: [s['user_id'], f"Bench task {i}", 'Created by the benchmark'],
+    'create_note': lambda s, i: [s['user_id'], s['task_ids'][i % len(s['task_ids'])], f"Bench note {i}"],
+    'create_subtask': lambda s, i: [s['user_id'], s['task_ids'][i % len(s['task_ids'])], f"Bench subtask {i}"],
+    'edit_note': lambda s, i: [s['user_id'], s['note_ids'][i % len(s['note_ids'])], f"Edited note {i}"],
+    'share_note': lambda s, i: [s['user_id'], s['note_ids'][-1 - i % len(s['note_ids'])], s['target_username']],
+    'delete_note': lambda s, i: [s['user_id'], s['note_ids'][-1 - i % len(s['note_ids'])]],
+}
+ALIASES = {'get_tasks_page': 'get_tasks'}
+
+def percentile(values, p):
+    if not values:
+        return None
+    # Метод ближайшего ранга по отсортированному списку
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(latencies, errors, elapsed, peak_rss_kb):
+    latencies = sorted(latencies)
+    return {
+        "runs": len(latencies),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "throughput_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "peak_rss_kb": peak_rss_kb
+    }
+
+class CliRunner:
+    # Как PHP без фонового процесса: новый интерпретатор на каждую команду
+    def __init__(self, config_path):
+        self.env = dict(os.environ, NOTE_SERVER_CONFIG=config_path)
+
+    def run(self, command, args):
+        started = time.perf_counter()
+        proc = subprocess.Popen([sys.executable, MAIN, command] + args, env=self.env,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        output = proc.stdout.read()
+        # wait4 возвращает rusage именно этого процесса, ru_maxrss в Linux в килобайтах
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        elapsed = time.perf_counter() - started
+        try:
+            ok = 'error' not in json.loads(output)
+        except ValueError:
+            ok = False
+        return elapsed, ok, usage.ru_maxrss
+
+    def close(self):
+        pass
+
+class DaemonRunner:
+    # Как PHP с запущенным python3 main.py serve: одно соединение с Unix-сокетом
+    def __init__(self, config_path, socket_path):
+        env = dict(os.environ, NOTE_SERVER_CONFIG=config_path)
+        self.proc = subprocess.Popen([sys.executable, MAIN, 'serve'], env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + DAEMON_START_TIMEOUT
+        while True:
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.connect(socket_path)
+                break
+            except OSError:
+                self.sock.close()
+                if time.monotonic() > deadline or self.proc.poll() is not None:
+                    self.proc.kill()
+                    raise RuntimeError('Daemon did not start')
+                time.sleep(0.05)
+        self.reader = self.sock.makefile('rb')
+
+    def peak_rss_kb(self):
+        with open(f"/proc/{self.proc.pid}/status") as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+        return None
+
+    def run(self, command, args):
+        started = time.perf_counter()
+        self.sock.sendall(json.dumps({'command': command, 'args': args}).encode('utf-8') + b'\n')
+        output = self.reader.readline()
+        elapsed = time.perf_counter() - started
+        try:
+            ok = 'error' not in json.loads(output)
+        except ValueError:
+            ok = False
+        return elapsed, ok, None
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+        self.proc.terminate()
+        self.proc.wait()
+
+def bench_storage(storage, args, commands):
+    root = tempfile.mkdtemp(prefix=f'note_bench_{storage}_', dir=args.tmpdir)
+    try:
+        started = time.perf_counter()
+        sample = generate(root, storage, args.rows, seed=args.seed)
+        result = {"generate_seconds": round(time.perf_counter() - started, 3), "rows": sample['counts'], "commands": {}}
+        if args.transport == 'daemon':
+            runner = DaemonRunner(sample['config'], os.path.join(root, 'note_server.sock'))
+        else:
+            runner = CliRunner(sample['config'])
+        try:
+            for name in commands:
+                command = ALIASES.get(name, name)
+                for i in range(args.warmup):
+                    runner.run(command, COMMANDS[name](sample, args.iterations + i))
+                latencies = []
+                errors = 0
+                peak_rss = 0
+                started = time.perf_counter()
+                for i in range(args.iterations):
+                    elapsed, ok, rss = runner.run(command, COMMANDS[name](sample, i))
+                    latencies.append(elapsed)
+                    errors += not ok
+                    peak_rss = max(peak_rss, rss or 0)
+                total = time.perf_counter() - started
+                if isinstance(runner, DaemonRunner):
+                    peak_rss = runner.peak_rss_kb()
+                result['commands'][name] = summarize(latencies, errors, total, peak_rss)
+                print(f"{storage:7} {name:18} p50 {result['commands'][name]['p50_ms']:9.2f} ms  "
+                      f"p99 {result['commands'][name]['p99_ms']:9.2f} ms  errors {errors}", file=sys.stderr)
+        finally:
+            runner.close()
+        return result
+    finally:
+        if args.keep:
+            print(f"Kept {storage} data in {root}", file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report, baseline):
+    # Отношение новых задержек к базовым: > 1 означает замедление
+    for storage, result in report['results'].items():
+        base = baseline.get('results', {}).get(storage, {}).get('commands', {})
+        for name, stats in result['commands'].items():
+            if name in base and base[name]['p50_ms']:
+                stats['p50_ratio'] = round(stats['p50_ms'] / base[name]['p50_ms'], 3)
+                stats['p95_ratio'] = round(stats['p95_ms'] / base[name]['p95_ms'], 3) if base[name]['p95_ms'] else None
+
+def main():
+    parser = argparse.ArgumentParser(description='Note Server benchmark')
+    parser.add_argument('--rows', type=int, default=10000, help='total synthetic rows (tasks, notes, subtasks, files, shares)')
+    parser.add_argument('--storage', default='sqlite,txt', help=f"comma-separated: {', '.join(STORAGES)}")
+    parser.add_argument('--commands', default=','.join(COMMANDS), help='comma-separated commands to run')
+    parser.add_argument('--iterations', type=int, default=30)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--transport', choices=('cli', 'daemon'), default='cli')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--tmpdir', default=None, help='where to create temporary data directories')
+    parser.add_argument('--keep', action='store_true', help='keep generated data directories')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    storages = [storage for storage in args.storage.split(',') if storage]
+    commands = [command for command in args.commands.split(',') if command]
+    unknown = [name for name in storages if name not in STORAGES] + [name for name in commands if name not in COMMANDS]
+    if unknown or args.iterations < 1 or args.rows < 1:
+        parser.error(f"invalid arguments: {', '.join(unknown) or 'iterations and rows must be positive'}")
+
+    report = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "rows": args.rows,
+        "iterations": args.iterations,
+        "transport": args.transport,
+        "results": {storage: bench_storage(storage, args, commands) for storage in storages}
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
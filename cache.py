@@ -0,0 +1,147 @@
+import time
+import logging
+import threading
+import functools
+import collections
+import metrics
+from config import get_config, on_config_reload
+
+logger = logging.getLogger(__name__)
+
+class ResultCache:
+    # Результаты чтения по ключу (функция, аргументы); запись годна, пока не изменились
+    # поколения её пользователя (и общих заметок) и не истёк TTL
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.generations = {}
+        self.shared_generation = 0
+        self.lock = threading.Lock()
+        self.counts = {"hits": 0, "misses": 0, "stale": 0, "expired": 0, "evicted": 0, "invalidations": 0}
+        self.by_function = {}
+
+    def generation(self, user_id, shared):
+        user_generation = self.generations.get(user_id, 0)
+        return (user_generation, self.shared_generation) if shared else user_generation
+
+    def count(self, name, function):
+        self.counts[name] += 1
+        if name in ('hits', 'misses'):
+            stats = self.by_function.setdefault(function, {"hits": 0, "misses": 0})
+            stats[name] += 1
+
+    def get(self, key, user_id, shared):
+        with self.lock:
+            generation = self.generation(user_id, shared)
+            entry = self.entries.get(key)
+            if entry is not None:
+                expires_at, entry_generation, result = entry
+                if entry_generation != generation:
+                    del self.entries[key]
+                    self.count('stale', key[0])
+                elif expires_at < time.monotonic():
+                    del self.entries[key]
+                    self.count('expired', key[0])
+                else:
+                    self.entries.move_to_end(key)
+                    self.count('hits', key[0])
+                    return generation, result
+            self.count('misses', key[0])
+            return generation, None
+
+    def put(self, key, generation, result):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, generation, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evicted'] += 1
+
+    def invalidate(self, user_id, shared):
+        # Записи не удаляются сразу: устаревшие отбрасываются при следующем обращении или вытесняются LRU
+        with self.lock:
+            self.generations[user_id] = self.generations.get(user_id, 0) + 1
+            if shared:
+                self.shared_generation += 1
+            self.counts['invalidations'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.counts['hits'] + self.counts['misses']
+            return {
+                "enabled": True,
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                **self.counts,
+                "hit_ratio": round(self.counts['hits'] / lookups, 4) if lookups else None,
+                "functions": {name: dict(stats) for name, stats in self.by_function.items()}
+            }
+
+_cache = None
+
+def enable_cache():
+    # Кэш имеет смысл только в долгоживущем фоновом процессе: CLI-процесс живёт одну команду
+    global _cache
+    config = get_config()
+    if config['CACHE'] and _cache is None:
+        _cache = ResultCache(config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+        logger.info("Result cache enabled: %s entries, TTL %ss", config['CACHE_MAX_ENTRIES'], config['CACHE_TTL'])
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def cache_stats():
+    cache = _cache
+    return cache.stats() if cache is not None else {"enabled": False}
+
+def cached(func=None, shared=False):
+    # Первый позиционный аргумент функции чтения — user_id
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cache = _cache
+            if cache is None:
+                return func(*args, **kwargs)
+            key = (func.__name__, args, tuple(sorted(kwargs.items())))
+            # Поколение читается до вычисления: если запись успеет изменить данные, результат сразу устареет
+            generation, result = cache.get(key, args[0], shared)
+            if metrics.ENABLED:
+                metrics.increment('cache_hits' if result is not None else 'cache_misses', func.__name__)
+            if result is not None:
+                return result
+            result = func(*args, **kwargs)
+            if 'error' not in result:
+                cache.put(key, generation, result)
+            return result
+        return wrapper
+    return decorate(func) if func is not None else decorate
+
+def invalidates(func=None, shared=False):
+    # Поколение увеличивается после записи, в том числе неудачной: лишний промах дешевле устаревшего ответа
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            finally:
+                cache = _cache
+                if cache is not None:
+                    cache.invalidate(args[0], shared)
+        return wrapper
+    return decorate(func) if func is not None else decorate
+
+@on_config_reload
+def _reset(config):
+    # Пути к данным могли поменяться
+    cache = _cache
+    if cache is not None:
+        cache.clear()
+        cache.max_entries = config['CACHE_MAX_ENTRIES']
+        cache.ttl = config['CACHE_TTL']
@@ -1,6 +1,8 @@
 <?php
 define('PYTHON_PATH', '/usr/bin/python3');
 define('MAIN_PY_PATH', '/var/www/html/main.py');
+define('DAEMON_SOCKET', '/var/www/html/note_server.sock');
+define('UPLOAD_SPOOL_DIR', '/var/www/html/files/.incoming');
 
 $languages = [
     'ru' => [
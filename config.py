@@ -1,27 +1,124 @@
 import configparser
 import logging
 import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CONFIG_PATH = os.environ.get('NOTE_SERVER_CONFIG', '/var/www/html/set.conf')
+
+def _to_bool(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Поле set.conf -> (тип, значение по умолчанию); None означает обязательное поле
+FIELDS = {
+    'STORAGE': (str, None),
+    'USERS_TXT': (str, None),
+    'TASKS_TXT': (str, None),
+    'NOTES_TXT': (str, None),
+    'SUBTASKS_TXT': (str, None),
+    'FILES_TXT': (str, None),
+    'SHARED_NOTES_TXT': (str, None),
+    'RESET_TOKENS_TXT': (str, None),
+    'USERS_DB': (str, None),
+    'TASKS_DB': (str, None),
+    'FILES_DIR': (str, None),
+    'LOG_FILE': (str, None),
+    'LOG_LEVEL': (str, 'INFO'),
+    'LOG_LEVELS': (str, ''),
+    'LOG_SAMPLE': (str, ''),
+    'LOG_FORMAT': (str, 'json'),
+    'LOG_MAX_BYTES': (int, 10485760),
+    'LOG_BACKUP_COUNT': (int, 5),
+    'LOG_ROTATE': (str, ''),
+    'SMTP_HOST': (str, None),
+    'SMTP_PORT': (int, None),
+    'SMTP_USER': (str, None),
+    'SMTP_PASS': (str, None),
+    'SMTP_FROM': (str, None),
+    'SMTP_STARTTLS': (bool, True),
+    'SMTP_TIMEOUT': (int, 30),
+    'SMTP_IDLE_TIMEOUT': (int, 60),
+    'MAIL_SPOOL_DIR': (str, '/var/www/html/mail_spool'),
+    'MAIL_BATCH_SIZE': (int, 50),
+    'MAIL_MAX_ATTEMPTS': (int, 8),
+    'MAIL_RETRY_DELAY': (int, 30),
+    'MAIL_POLL_INTERVAL': (int, 5),
+    'SERVER_HOST': (str, None),
+    'DAEMON_SOCKET': (str, '/var/www/html/note_server.sock'),
+    'BATCH_SIZE': (int, 500),
+    'MIGRATE_BATCH_SIZE': (int, 10000),
+    'PURGE_RETENTION_DAYS': (int, 30),
+    'PURGE_BATCH_SIZE': (int, 500),
+    'PURGE_VACUUM_PAGES': (int, 1000),
+    'MAX_PAGE_SIZE': (int, 1000),
+    'BCRYPT_ROUNDS': (int, 12),
+    'BCRYPT_WORKERS': (int, 4),
+    'BCRYPT_MAX_PENDING': (int, 64),
+    'METRICS': (bool, False),
+    'METRICS_FILE': (str, '/var/www/html/note_server.prom'),
+    'METRICS_FLUSH_INTERVAL': (int, 10),
+    'CACHE': (bool, True),
+    'CACHE_TTL': (int, 30),
+    'CACHE_MAX_ENTRIES': (int, 1024),
+}
+
+_lock = threading.Lock()
+_config = None
+_stamp = None
+_reload_hooks = []
+last_parse_seconds = None
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _parse_config(path):
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    section = parser['DEFAULT']
+    config = {}
+    for name, (field_type, default) in FIELDS.items():
+        if name in section:
+            value = section[name]
+            config[name] = _to_bool(value) if field_type is bool else field_type(value)
+        elif default is not None:
+            config[name] = default
+        else:
+            raise KeyError(name)
+    return config
+
+def _load(stamp):
+    global _config, _stamp, last_parse_seconds
+    previous = _config
+    started = time.perf_counter()
+    _config = _parse_config(CONFIG_PATH)
+    last_parse_seconds = time.perf_counter() - started
+    _stamp = stamp
+    if previous is not None:
+        logger.info("Configuration %s reloaded", CONFIG_PATH)
+        for hook in _reload_hooks:
+            hook(_config)
+    return _config
 
 def get_config():
-    config = configparser.ConfigParser()
-    config.read('/var/www/html/set.conf')
-    return {
-        'STORAGE': config['DEFAULT']['STORAGE'],
-        'USERS_TXT': config['DEFAULT']['USERS_TXT'],
-        'TASKS_TXT': config['DEFAULT']['TASKS_TXT'],
-        'NOTES_TXT': config['DEFAULT']['NOTES_TXT'],
-        'SUBTASKS_TXT': config['DEFAULT']['SUBTASKS_TXT'],
-        'FILES_TXT': config['DEFAULT']['FILES_TXT'],
-        'SHARED_NOTES_TXT': config['DEFAULT']['SHARED_NOTES_TXT'],
-        'RESET_TOKENS_TXT': config['DEFAULT']['RESET_TOKENS_TXT'],
-        'USERS_DB': config['DEFAULT']['USERS_DB'],
-        'TASKS_DB': config['DEFAULT']['TASKS_DB'],
-        'FILES_DIR': config['DEFAULT']['FILES_DIR'],
-        'LOG_FILE': config['DEFAULT']['LOG_FILE'],
-        'SMTP_HOST': config['DEFAULT']['SMTP_HOST'],
-        'SMTP_PORT': int(config['DEFAULT']['SMTP_PORT']),
-        'SMTP_USER': config['DEFAULT']['SMTP_USER'],
-        'SMTP_PASS': config['DEFAULT']['SMTP_PASS'],
-        'SMTP_FROM': config['DEFAULT']['SMTP_FROM'],
-        'SERVER_HOST': config['DEFAULT']['SERVER_HOST']
-    }
\ No newline at end of file
+    stamp = _file_stamp(CONFIG_PATH)
+    config = _config
+    if config is not None and stamp == _stamp:
+        return config
+    with _lock:
+        if _config is not None and stamp == _stamp:
+            return _config
+        return _load(stamp)
+
+def reload_config():
+    with _lock:
+        return _load(_file_stamp(CONFIG_PATH))
+
+def on_config_reload(hook):
+    _reload_hooks.append(hook)
+    return hook
@@ -0,0 +1,175 @@
+import os
+import logging
+from config import get_config
+from metrics import timed
+from cache import cached
+from db import get_connection
+from utils import lock_file, validate_id, parse_txt_line, parse_files_line, TXT_LAYOUTS
+from logstore import open_store
+from notes import get_shared_notes
+
+logger = logging.getLogger(__name__)
+
+def task_entry(task_id, title, description, status, created_at):
+    return {
+        "task_id": task_id,
+        "title": title,
+        "description": description,
+        "status": status,
+        "created_at": created_at,
+        "subtasks": [],
+        "note_count": 0,
+        "latest_note": None,
+        "files": []
+    }
+
+def subtask_entry(subtask_id, title, completed):
+    return {"subtask_id": subtask_id, "title": title, "completed": completed}
+
+def file_entry(file_id, filename, mime_type, size):
+    return {"file_id": file_id, "filename": filename, "mime_type": mime_type, "size": size}
+
+def note_entry(note_id, content, created_at):
+    return {"note_id": note_id, "content": content, "created_at": created_at}
+
+def add_note(task, note_id, content, created_at):
+    task['note_count'] += 1
+    latest = task['latest_note']
+    if latest is None or created_at > latest['created_at']:
+        task['latest_note'] = note_entry(note_id, content, created_at)
+
+def load_files_txt(config, tasks):
+    if not os.path.exists(config['FILES_TXT']):
+        return
+    with lock_file(config['FILES_TXT'], 'r') as f:
+        for line in f:
+            entry = parse_files_line(line)
+            if entry and entry['task_id'] in tasks:
+                tasks[entry['task_id']]['files'].append(
+                    file_entry(entry['id'], entry['filename'], entry['mime_type'], entry['size']))
+
+def dashboard_sqlite(config, user_id, task_id):
+    tasks = {}
+    notes = []
+    with get_connection(config['TASKS_DB']) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, title, description, status, created_at FROM tasks WHERE user_id = ? AND deleted = 0", (user_id,))
+        for row in cursor.fetchall():
+            tasks[row[0]] = task_entry(*row)
+        cursor.execute("""
+            SELECT s.task_id, s.id, s.title, s.completed
+            FROM subtasks s
+            JOIN tasks t ON t.id = s.task_id
+            WHERE t.user_id = ? AND t.deleted = 0
+            ORDER BY s.rowid
+        """, (user_id,))
+        for row in cursor.fetchall():
+            tasks[row[0]]['subtasks'].append(subtask_entry(row[1], row[2], bool(row[3])))
+        # Голые столбцы при MAX() в SQLite берутся из строки с максимальным значением
+        cursor.execute("""
+            SELECT task_id, COUNT(*), id, content, MAX(created_at)
+            FROM notes
+            WHERE user_id = ? AND deleted = 0
+            GROUP BY task_id
+        """, (user_id,))
+        for row in cursor.fetchall():
+            if row[0] in tasks:
+                tasks[row[0]]['note_count'] = row[1]
+                tasks[row[0]]['latest_note'] = note_entry(*row[2:])
+        cursor.execute("""
+            SELECT f.task_id, f.id, f.filename, f.mime_type, f.size
+            FROM files f
+            JOIN tasks t ON t.id = f.task_id
+            WHERE t.user_id = ? AND t.deleted = 0
+        """, (user_id,))
+        for row in cursor.fetchall():
+            tasks[row[0]]['files'].append(file_entry(*row[1:]))
+        if task_id:
+            cursor.execute("SELECT id, content, created_at FROM notes WHERE user_id = ? AND task_id = ? AND deleted = 0", (user_id, task_id))
+            notes = [note_entry(*row) for row in cursor.fetchall()]
+    return tasks, notes
+
+def dashboard_log(config, user_id, task_id):
+    tasks = {}
+    notes = []
+    for task in open_store(config, 'TASKS_TXT').find('user_id', user_id):
+        tasks[task['id']] = task_entry(task['id'], task['title'], task['description'], task['status'], task['created_at'])
+    subtasks_store = open_store(config, 'SUBTASKS_TXT')
+    for owned_id, task in tasks.items():
+        for subtask in subtasks_store.find('task_id', owned_id, by_creation=True):
+            task['subtasks'].append(subtask_entry(subtask['id'], subtask['title'], bool(int(subtask['completed']))))
+    for note in open_store(config, 'NOTES_TXT').find('user_id', user_id):
+        if note['task_id'] in tasks:
+            add_note(tasks[note['task_id']], note['id'], note['content'], note['created_at'])
+            if note['task_id'] == task_id:
+                notes.append(note_entry(note['id'], note['content'], note['created_at']))
+    load_files_txt(config, tasks)
+    return tasks, notes
+
+def dashboard_txt(config, user_id, task_id):
+    tasks = {}
+    notes = []
+    if not os.path.exists(config['TASKS_TXT']):
+        return tasks, notes
+    with lock_file(config['TASKS_TXT'], 'r') as f:
+        for line in f:
+            task = parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT'])
+            if task and task['user_id'] == user_id and task['deleted'] == '0':
+                tasks[task['id']] = task_entry(task['id'], task['title'], task['description'], task['status'], task['created_at'])
+    if os.path.exists(config['SUBTASKS_TXT']):
+        with lock_file(config['SUBTASKS_TXT'], 'r') as f:
+            for line in f:
+                subtask = parse_txt_line(line, TXT_LAYOUTS['SUBTASKS_TXT'])
+                if subtask and subtask['task_id'] in tasks:
+                    tasks[subtask['task_id']]['subtasks'].append(
+                        subtask_entry(subtask['id'], subtask['title'], subtask['completed'] == '1'))
+    if os.path.exists(config['NOTES_TXT']):
+        with lock_file(config['NOTES_TXT'], 'r') as f:
+            for line in f:
+                note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+                if note and note['user_id'] == user_id and note['deleted'] == '0' and note['task_id'] in tasks:
+                    add_note(tasks[note['task_id']], note['id'], note['content'], note['created_at'])
+                    if note['task_id'] == task_id:
+                        notes.append(note_entry(note['id'], note['content'], note['created_at']))
+    load_files_txt(config, tasks)
+    return tasks, notes
+
+@timed
+@cached(shared=True)
+def get_dashboard(user_id, storage, sort_by='created_at', task_id=None):
+    try:
+        config = get_config()
+        logger.info("Getting dashboard for user_id %s, sort_by: %s", user_id, sort_by)
+
+        if not validate_id(user_id) or (task_id and not validate_id(task_id)):
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
+            return {"error": "Invalid user_id or task_id"}
+
+        if storage == 'sqlite':
+            tasks, notes = dashboard_sqlite(config, user_id, task_id)
+        elif storage == 'log':
+            tasks, notes = dashboard_log(config, user_id, task_id)
+        else:
+            tasks, notes = dashboard_txt(config, user_id, task_id)
+
+        tasks = list(tasks.values())
+        if sort_by == 'title':
+            tasks.sort(key=lambda x: x['title'])
+        else:
+            tasks.sort(key=lambda x: x['created_at'], reverse=True)
+
+        result = {"tasks": tasks}
+        shared = get_shared_notes(user_id, storage)
+        result['shared_notes'] = shared.get('shared_notes', [])
+        if task_id:
+            if sort_by == 'content':
+                notes.sort(key=lambda x: x['content'])
+            else:
+                notes.sort(key=lambda x: x['created_at'], reverse=True)
+            result['notes'] = notes
+
+        logger.info("Retrieved dashboard with %s tasks for user_id %s", len(tasks), user_id)
+        return result
+    except Exception as e:
+        logger.error("Failed to get dashboard: %s", e)
+        return {"error": f"Failed to get dashboard: {str(e)}"}
@@ -0,0 +1,174 @@
+import contextlib
+import os
+import threading
+import time
+import metrics
+from config import on_config_reload
+
+BUSY_TIMEOUT_MS = 5000
+MMAP_SIZE = 256 * 1024 * 1024
+CACHED_STATEMENTS = 256
+MAX_IDLE_CONNECTIONS = 8
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+_local = threading.local()
+
+def _open_connection(db_path):
+    # Для txt-хранилища sqlite3 не загружается вовсе
+    import sqlite3
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           cached_statements=CACHED_STATEMENTS)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    return conn
+
+class ConnectionPool:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return _open_connection(self.db_path)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < MAX_IDLE_CONNECTIONS:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+class PooledConnection:
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = None
+
+    def __enter__(self):
+        self.started = time.perf_counter() if metrics.ENABLED else None
+        self.conn = self.pool.acquire()
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            return self.conn.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self.pool.release(self.conn)
+            self.conn = None
+            if self.started is not None:
+                metrics.observe('db', os.path.basename(self.pool.db_path), time.perf_counter() - self.started)
+
+def _get_pool(db_path):
+    global _pools, _pools_pid
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Connections inherited across fork() must not be reused
+            _pools = {}
+            _pools_pid = os.getpid()
+        pool = _pools.get(db_path)
+        if pool is None:
+            pool = _pools[db_path] = ConnectionPool(db_path)
+        return pool
+
+class BatchConnection:
+    # Коммиты отдельных функций откладываются до конца пакета
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+    def commit(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class BatchTransaction:
+    def __init__(self):
+        self.conns = {}
+        self.savepoints = []
+
+    def connection(self, db_path):
+        conn = self.conns.get(db_path)
+        if conn is None:
+            conn = _get_pool(db_path).acquire()
+            self.conns[db_path] = conn
+            conn.execute("BEGIN IMMEDIATE")
+        if db_path not in self.savepoints:
+            conn.execute("SAVEPOINT batch_command")
+            self.savepoints.append(db_path)
+        return BatchConnection(conn)
+
+    def end_command(self, ok):
+        savepoints, self.savepoints = self.savepoints, []
+        for db_path in savepoints:
+            conn = self.conns[db_path]
+            if not ok:
+                conn.execute("ROLLBACK TO batch_command")
+            conn.execute("RELEASE batch_command")
+
+    def finish(self, commit):
+        try:
+            for conn in self.conns.values():
+                if commit:
+                    conn.commit()
+                else:
+                    conn.rollback()
+        finally:
+            for db_path, conn in self.conns.items():
+                _get_pool(db_path).release(conn)
+            self.conns = {}
+
+@contextlib.contextmanager
+def batch_transaction():
+    batch = _local.batch = BatchTransaction()
+    try:
+        yield batch
+        batch.finish(True)
+    except BaseException:
+        batch.finish(False)
+        raise
+    finally:
+        _local.batch = None
+
+def get_connection(db_path):
+    batch = getattr(_local, 'batch', None)
+    if batch is not None:
+        return batch.connection(db_path)
+    return PooledConnection(_get_pool(db_path))
+
+def attach_database(conn, db_path, alias):
+    # Соединения пула переиспользуются, поэтому база подключается один раз на соединение
+    if any(row[1] == alias for row in conn.execute("PRAGMA database_list")):
+        return
+    conn.execute(f"ATTACH DATABASE ? AS {alias}", (db_path,))
+
+def close_connections():
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close()
+
+@on_config_reload
+def _close_on_reload(config):
+    # Пути к базам могли измениться; новые соединения откроются по требованию
+    close_connections()
@@ -0,0 +1,51 @@
+<?php
+session_start();
+require_once 'config.php';
+require_once 'utils.php';
+
+if (!isset($_SESSION['user_id'])) {
+    http_response_code(403);
+    exit;
+}
+$user_id = $_SESSION['user_id'];
+session_write_close(); // Не держим блокировку сессии, пока идёт отдача файла
+
+$file_id = $_GET['file_id'] ?? '';
+if (!preg_match('/^[a-f0-9]{16}$/', $file_id)) {
+    http_response_code(400);
+    exit;
+}
+
+list($header, $stream, $close) = python_stream('download_file', [
+    $user_id,
+    $file_id,
+    $_SERVER['HTTP_RANGE'] ?? '',
+    $_SERVER['HTTP_IF_NONE_MATCH'] ?? '',
+    $_SERVER['HTTP_IF_MODIFIED_SINCE'] ?? ''
+]);
+
+if (!$header || isset($header['error'])) {
+    $close();
+    http_response_code(404);
+    exit;
+}
+
+http_response_code($header['status']);
+header('Accept-Ranges: bytes');
+header('ETag: ' . $header['etag']);
+header('Last-Modified: ' . $header['last_modified']);
+if (isset($header['content_range'])) {
+    header('Content-Range: ' . $header['content_range']);
+}
+if ($header['status'] === 200 || $header['status'] === 206) {
+    header('Content-Type: ' . ($header['mime_type'] ?: 'application/octet-stream'));
+    header('Content-Length: ' . $header['content_length']);
+    header("Content-Disposition: attachment; filename*=UTF-8''" . rawurlencode($header['filename']));
+    while (ob_get_level()) {
+        ob_end_flush();
+    }
+    // Тело копируется кусками, файл целиком в память PHP не читается
+    stream_copy_to_stream($stream, fopen('php://output', 'wb'), $header['content_length']);
+}
+$close();
+?>
@@ -1,69 +1,492 @@
-import sqlite3
-import secrets
 import os
+import io
+import sys
 import logging
-import base64
-import mimetypes
+import hashlib
+import fcntl
+import json
+import errno
 from config import get_config
-from utils import lock_file, validate_id, validate_file_mime, safe_path
+from metrics import timed
+from cache import cached, invalidates
+from db import get_connection
+from utils import lock_file, validate_id, validate_file_mime, safe_path, parse_txt_line, parse_files_line, format_files_line, TXT_LAYOUTS, encode_cursor, decode_cursor, select_page
+from logstore import get_owned_task, open_store
 
+logger = logging.getLogger(__name__)
+
+MAX_FILE_SIZE = 10 * 1024 * 1024 * 1024  # 10 GB
+CHUNK_SIZE = 1024 * 1024
+FICLONE = 0x40049409
+
+class FileTooLarge(Exception):
+    pass
+
+def task_owned(config, user_id, task_id, storage):
+    if storage == 'sqlite':
+        with get_connection(config['TASKS_DB']) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
+            return cursor.fetchone() is not None
+    elif storage == 'log':
+        return get_owned_task(config, task_id, user_id) is not None
+    else:
+        if not os.path.exists(config['TASKS_TXT']):
+            return False
+        with lock_file(config['TASKS_TXT'], 'r') as f:
+            for line in f:
+                task = parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT'])
+                if task and task['id'] == task_id:
+                    return task['user_id'] == user_id and task['deleted'] == '0'
+        return False
+
+def copy_stream(source, dest_path):
+    digest = hashlib.sha256()
+    size = 0
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(dest_path, 'wb') as out:
+        while True:
+            read = source.readinto(buffer)
+            if not read:
+                break
+            size += read
+            if size > MAX_FILE_SIZE:
+                raise FileTooLarge()
+            digest.update(view[:read])
+            out.write(view[:read])
+        out.flush()
+        os.fsync(out.fileno())
+    return size, digest.hexdigest()
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    buffer = bytearray(CHUNK_SIZE)
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        while True:
+            read = f.readinto(buffer)
+            if not read:
+                break
+            digest.update(view[:read])
+    return digest.hexdigest()
+
+def store_from_path(source_path, dest_path, move):
+    size = os.path.getsize(source_path)
+    if size > MAX_FILE_SIZE:
+        raise FileTooLarge()
+    if move and os.stat(source_path).st_dev == os.stat(os.path.dirname(dest_path)).st_dev:
+        # Та же файловая система: только читаем для хеша и переименовываем без копирования
+        sha256 = hash_file(source_path)
+        os.rename(source_path, dest_path)
+        return size, sha256
+    with open(source_path, 'rb') as source:
+        result = copy_stream(source, dest_path)
+    if move:
+        os.remove(source_path)
+    return result
+
+def blobs_dir(config):
+    return os.path.join(config['FILES_DIR'], 'blobs')
+
+def blob_lock(config):
+    os.makedirs(blobs_dir(config), exist_ok=True)
+    return lock_file(os.path.join(blobs_dir(config), '.lock'), 'a')
+
+def intern_blob(config, tmp_path, sha256):
+    path = os.path.join(blobs_dir(config), sha256[:2], sha256)
+    if os.path.exists(path):
+        os.remove(tmp_path)
+        logger.info("Deduplicated upload against blob %s", sha256)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        os.chmod(path, 0o444)
+    return path
+
+def materialise_blob(blob_path, dest_path):
+    try:
+        os.link(blob_path, dest_path)
+        return
+    except OSError:
+        pass
+    try:
+        with open(blob_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return
+    except OSError:
+        pass
+    import shutil
+    shutil.copyfile(blob_path, dest_path)
+
+def record_file(config, file_id, user_id, task_id, filename, mime_type, path, size, sha256, storage):
+    if storage == 'sqlite':
+        with get_connection(config['TASKS_DB']) as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO files (id, user_id, task_id, filename, mime_type, path, size, sha256) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                          (file_id, user_id, task_id, filename, mime_type, path, size, sha256))
+            cursor.execute("INSERT INTO blobs (sha256, size, refcount) VALUES (?, ?, 1) "
+                           "ON CONFLICT(sha256) DO UPDATE SET refcount = refcount + 1", (sha256, size))
+            conn.commit()
+    else:
+        with lock_file(config['FILES_TXT'], 'a') as f:
+            f.write(format_files_line({"id": file_id, "user_id": user_id, "task_id": task_id, "filename": filename,
+                                       "mime_type": mime_type, "path": path, "size": size, "sha256": sha256}))
+
+def save_upload(user_id, task_id, filename, storage, write_content):
+    config = get_config()
+    if not validate_id(user_id) or not validate_id(task_id):
+        logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
+        return {"error": "Invalid user_id or task_id"}
+
+    if not validate_file_mime(filename):
+        logger.error("Invalid file type: %s", filename)
+        return {"error": "Invalid file type. Allowed types: text/plain, image/jpeg, image/png, application/pdf"}
+
+    if not task_owned(config, user_id, task_id, storage):
+        logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+        return {"error": "Task not found or not owned by user"}
+
+    import secrets
+    import mimetypes
+    file_id = secrets.token_hex(8)
+    user_dir = os.path.join(config['FILES_DIR'], user_id)
+    os.makedirs(user_dir, exist_ok=True)
+    safe_filename = safe_path(user_dir, file_id + '_' + filename)
+    tmp_filename = safe_filename + '.part'
+
+    try:
+        size, sha256 = write_content(tmp_filename)
+        mime_type, _ = mimetypes.guess_type(filename)
+        with blob_lock(config):
+            blob_path = intern_blob(config, tmp_filename, sha256)
+            materialise_blob(blob_path, safe_filename)
+            record_file(config, file_id, user_id, task_id, filename, mime_type, safe_filename, size, sha256, storage)
+    except FileTooLarge:
+        logger.error("File too large: %s", filename)
+        return {"error": "File size exceeds 10 GB"}
+    except Exception:
+        if os.path.exists(safe_filename):
+            os.remove(safe_filename)
+        raise
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+    logger.info("File %s uploaded (%s bytes, sha256 %s)", file_id, size, sha256)
+    return {"message": "File uploaded", "file_id": file_id, "size": size, "sha256": sha256}
+
+@timed
+@invalidates
 def upload_file(user_id, task_id, filename, content, storage):
+    import base64
+    try:
+        logger.info("Uploading file for user_id %s, task_id %s: %s", user_id, task_id, filename)
+        content_bytes = base64.b64decode(content)
+        return save_upload(user_id, task_id, filename, storage,
+                           lambda dest_path: copy_stream(io.BytesIO(content_bytes), dest_path))
+    except Exception as e:
+        logger.error("Failed to upload file: %s", e)
+        return {"error": f"Failed to upload file: {str(e)}"}
+
+@timed
+@invalidates
+def upload_file_from_path(user_id, task_id, filename, source_path, storage, move=False):
+    try:
+        logger.info("Uploading file for user_id %s, task_id %s from %s: %s", user_id, task_id, source_path, filename)
+        if source_path == '-':
+            return save_upload(user_id, task_id, filename, storage,
+                               lambda dest_path: copy_stream(sys.stdin.buffer, dest_path))
+        if not os.path.isfile(source_path):
+            logger.error("Upload source %s does not exist", source_path)
+            return {"error": "Upload source not found"}
+        return save_upload(user_id, task_id, filename, storage,
+                           lambda dest_path: store_from_path(source_path, dest_path, move))
+    except Exception as e:
+        logger.error("Failed to upload file: %s", e)
+        return {"error": f"Failed to upload file: {str(e)}"}
+
+def file_record(file_id, task_id, filename, mime_type, size, sha256):
+    return {"file_id": file_id, "task_id": task_id, "filename": filename, "mime_type": mime_type,
+            "size": size, "sha256": sha256}
+
+def file_sort_key(record):
+    return (record['filename'], record['file_id'])
+
+def live_task_ids(config, user_id, storage):
+    if storage == 'log':
+        return {task['id'] for task in open_store(config, 'TASKS_TXT').find('user_id', user_id)}
+    live_tasks = set()
+    if os.path.exists(config['TASKS_TXT']):
+        with lock_file(config['TASKS_TXT'], 'r') as f:
+            for line in f:
+                task = parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT'])
+                if task and task['user_id'] == user_id and task['deleted'] == '0':
+                    live_tasks.add(task['id'])
+    return live_tasks
+
+@timed
+@cached
+def list_files(user_id, storage, task_id=None, limit=None, after=None):
     try:
         config = get_config()
-        logging.info(f"Uploading file for user_id {user_id}, task_id {task_id}: {filename}")
-        
-        if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+        logger.info("Listing files for user_id %s, task_id: %s, limit: %s, after: %s", user_id, task_id, limit, after)
+
+        if not validate_id(user_id) or (task_id is not None and not validate_id(task_id)):
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
-        
-        if not validate_file_mime(filename):
-            logging.error(f"Invalid file type: {filename}")
-            return {"error": "Invalid file type. Allowed types: text/plain, image/jpeg, image/png, application/pdf"}
-        
-        content_bytes = base64.b64decode(content)
-        if len(content_bytes) > 10 * 1024 * 1024 * 1024:  # 10 GB
-            logging.error(f"File too large: {filename}")
-            return {"error": "File size exceeds 10 GB"}
-        
-        file_id = secrets.token_hex(8)
-        user_dir = os.path.join(config['FILES_DIR'], user_id)
-        os.makedirs(user_dir, exist_ok=True)
-        safe_filename = safe_path(user_dir, file_id + '_' + filename)
-        
-        with open(safe_filename, 'wb') as f:
-            f.write(content_bytes)
-        
-        mime_type, _ = mimetypes.guess_type(filename)
+
+        if limit is not None and limit < 1:
+            logger.error("Invalid limit: %s", limit)
+            return {"error": "Limit must be positive"}
+        if limit is not None:
+            limit = min(limit, config['MAX_PAGE_SIZE'])
+        try:
+            after_key = decode_cursor(after) if after else None
+        except ValueError:
+            logger.error("Invalid cursor: %s", after)
+            return {"error": "Invalid cursor"}
+
+        if task_id is not None and not task_owned(config, user_id, task_id, storage):
+            logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+            return {"error": "Task not found or not owned by user"}
+
+        next_cursor = None
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
-                if not cursor.fetchone():
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
-                    os.remove(safe_filename)
-                    return {"error": "Task not found or not owned by user"}
-                cursor.execute("INSERT INTO files (id, user_id, task_id, filename, mime_type, path) VALUES (?, ?, ?, ?, ?, ?)",
-                              (file_id, user_id, task_id, filename, mime_type, safe_filename))
-                conn.commit()
-                logging.info(f"File {file_id} uploaded in SQLite")
-                return {"message": "File uploaded", "file_id": file_id}
+            with get_connection(config['TASKS_DB']) as conn:
+                query = """
+                    SELECT f.id, f.task_id, f.filename, f.mime_type, f.size, f.sha256
+                    FROM files f
+                    JOIN tasks t ON t.id = f.task_id
+                    WHERE f.user_id = ? AND t.deleted = 0
+                """
+                params = [user_id]
+                if task_id is not None:
+                    query += " AND f.task_id = ?"
+                    params.append(task_id)
+                if after_key:
+                    query += " AND (f.filename, f.id) > (?, ?)"
+                    params += list(after_key)
+                query += " ORDER BY f.filename, f.id"
+                if limit is not None:
+                    query += " LIMIT ?"
+                    params.append(limit + 1)
+                files = [file_record(*row) for row in conn.execute(query, params).fetchall()]
+            if limit is not None and len(files) > limit:
+                files = files[:limit]
+                next_cursor = encode_cursor(file_sort_key(files[-1]))
         else:
-            if not os.path.exists(config['TASKS_TXT']):
-                logging.info(f"Tasks file {config['TASKS_TXT']} does not exist")
-                os.remove(safe_filename)
-                return {"error": "Task not found"}
-            with lock_file(config['TASKS_TXT'], 'r') as f:
-                task_exists = any(line.strip().split(':')[0] == task_id and line.strip().split(':')[1] == user_id for line in f)
-            if not task_exists:
-                logging.error(f"Task {task_id} not found or not owned by user {user_id}")
-                os.remove(safe_filename)
-                return {"error": "Task not found or not owned by user"}
-            with lock_file(config['FILES_TXT'], 'a') as f:
-                f.write(f"{file_id}:{user_id}:{task_id}:{filename}:{mime_type}:{safe_filename}\n")
-            logging.info(f"File {file_id} uploaded in txt")
-            return {"message": "File uploaded", "file_id": file_id}
+            if not os.path.exists(config['FILES_TXT']):
+                logger.info("Files file %s does not exist", config['FILES_TXT'])
+                files = []
+            else:
+                tasks = {task_id} if task_id is not None else live_task_ids(config, user_id, storage)
+                with lock_file(config['FILES_TXT'], 'r') as f:
+                    entries = (parse_files_line(line) for line in f)
+                    records = (file_record(entry['id'], entry['task_id'], entry['filename'], entry['mime_type'],
+                                           entry['size'], entry['sha256'])
+                               for entry in entries
+                               if entry and entry['user_id'] == user_id and entry['task_id'] in tasks)
+                    files, next_cursor = select_page(records, file_sort_key, False, after_key, limit)
+
+        logger.info("Retrieved %s files for user_id %s", len(files), user_id)
+        result = {"files": files}
+        if limit is not None:
+            result["next_cursor"] = next_cursor
+        return result
     except Exception as e:
-        logging.error(f"Failed to upload file: {str(e)}")
-        if os.path.exists(safe_filename):
-            os.remove(safe_filename)
-        return {"error": f"Failed to upload file: {str(e)}"}
\ No newline at end of file
+        logger.error("Failed to list files: %s", e)
+        return {"error": f"Failed to list files: {str(e)}"}
+
+def find_file(config, user_id, file_id, storage):
+    if storage == 'sqlite':
+        with get_connection(config['TASKS_DB']) as conn:
+            row = conn.execute("""
+                SELECT f.filename, f.mime_type, f.path, f.sha256
+                FROM files f
+                JOIN tasks t ON t.id = f.task_id
+                WHERE f.id = ? AND f.user_id = ? AND t.deleted = 0
+            """, (file_id, user_id)).fetchone()
+        return dict(zip(('filename', 'mime_type', 'path', 'sha256'), row)) if row else None
+    if not os.path.exists(config['FILES_TXT']):
+        return None
+    with lock_file(config['FILES_TXT'], 'r') as f:
+        entry = next((entry for entry in map(parse_files_line, f) if entry and entry['id'] == file_id), None)
+    if entry is None or entry['user_id'] != user_id or not task_owned(config, user_id, entry['task_id'], storage):
+        return None
+    return entry
+
+def parse_range(range_header, size):
+    # Поддерживается один диапазон; несколько диапазонов и неверный синтаксис отдают файл целиком (RFC 7233)
+    if not range_header:
+        return None
+    unit, _, spec = range_header.strip().partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, dash, last = spec.strip().partition('-')
+    if not dash or not (first.isdigit() or last.isdigit()) or (first and not first.isdigit()) or (last and not last.isdigit()):
+        return None
+    if not first:
+        length = int(last)
+        if length == 0 or size == 0:
+            return 'unsatisfiable'
+        return max(0, size - length), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return 'unsatisfiable'
+    return start, end
+
+def not_modified(etag, mtime, if_none_match, if_modified_since):
+    # If-None-Match важнее If-Modified-Since; ETag сравнивается слабым сравнением
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        bare = lambda tag: tag[2:] if tag.startswith('W/') else tag
+        return '*' in tags or any(bare(tag) == bare(etag) for tag in tags)
+    if if_modified_since:
+        from email.utils import parsedate_to_datetime
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        return since.tzinfo is not None and int(mtime) <= since.timestamp()
+    return False
+
+def prepare_download(config, user_id, file_id, storage, range_header, if_none_match, if_modified_since):
+    from email.utils import formatdate
+    entry = find_file(config, user_id, file_id, storage)
+    if entry is None:
+        logger.error("File %s not found or not owned by user %s", file_id, user_id)
+        return {"error": "File not found or not owned by user"}, None, 0
+    f = open(entry['path'], 'rb')
+    try:
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        # Содержимое адресуется sha256, поэтому ETag сильный; для старых записей без хеша слабый
+        etag = f'"{entry["sha256"]}"' if entry['sha256'] else f'W/"{size:x}-{st.st_mtime_ns:x}"'
+        header = {"status": 200, "file_id": file_id, "filename": entry['filename'], "mime_type": entry['mime_type'],
+                  "size": size, "etag": etag, "last_modified": formatdate(st.st_mtime, usegmt=True),
+                  "content_length": size}
+        offset = 0
+        if not_modified(etag, st.st_mtime, if_none_match, if_modified_since):
+            header.update(status=304, content_length=0)
+        else:
+            byte_range = parse_range(range_header, size)
+            if byte_range == 'unsatisfiable':
+                header.update(status=416, content_length=0, content_range=f"bytes */{size}")
+            elif byte_range is not None:
+                offset, end = byte_range
+                header.update(status=206, content_length=end - offset + 1, content_range=f"bytes {offset}-{end}/{size}")
+        if not header['content_length']:
+            f.close()
+            f = None
+        return header, f, offset
+    except BaseException:
+        f.close()
+        raise
+
+def send_file(out_fd, f, offset, length):
+    # Данные идут из page cache прямо в сокет или канал без копирования в память процесса
+    try:
+        while length > 0:
+            sent = os.sendfile(out_fd, f.fileno(), offset, length)
+            if sent == 0:
+                raise IOError(f"File {f.name} was truncated while sending")
+            offset += sent
+            length -= sent
+    except OSError as e:
+        if e.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise
+        f.seek(offset)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                raise IOError(f"File {f.name} was truncated while sending")
+            view = memoryview(chunk)
+            while view:
+                view = view[os.write(out_fd, view):]
+            length -= len(chunk)
+
+@timed
+def download_file(out, user_id, file_id, storage, range_header=None, if_none_match=None, if_modified_since=None):
+    # Пишет в out строку JSON-заголовка, затем ровно content_length байт содержимого
+    f = None
+    offset = 0
+    try:
+        config = get_config()
+        logger.info("Downloading file %s for user_id %s, range: %s", file_id, user_id, range_header)
+        if not validate_id(user_id) or not validate_id(file_id):
+            logger.error("Invalid user_id or file_id: %s, %s", user_id, file_id)
+            header = {"error": "Invalid user_id or file_id"}
+        else:
+            header, f, offset = prepare_download(config, user_id, file_id, storage, range_header, if_none_match, if_modified_since)
+    except Exception as e:
+        logger.error("Failed to download file: %s", e)
+        header = {"error": f"Failed to download file: {str(e)}"}
+    try:
+        out.write(json.dumps(header).encode('utf-8') + b'\n')
+        out.flush()
+        if f is not None:
+            send_file(out.fileno(), f, offset, header['content_length'])
+            logger.info("Sent %s bytes of file %s (status %s)", header['content_length'], file_id, header['status'])
+    finally:
+        if f is not None:
+            f.close()
+    return header
+
+def remove_file(path):
+    try:
+        st = os.stat(path)
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    # Место освобождается только при удалении последней жёсткой ссылки
+    return st.st_size if st.st_nlink == 1 else 0
+
+def referenced_blobs_txt(config):
+    referenced = set()
+    if os.path.exists(config['FILES_TXT']):
+        with lock_file(config['FILES_TXT'], 'r') as f:
+            for line in f:
+                entry = parse_files_line(line)
+                if entry and entry['sha256']:
+                    referenced.add(entry['sha256'])
+    return referenced
+
+def sweep_blobs(config, referenced):
+    # Вызывается под blob_lock: удаляет блобы, на которые не ссылается ни одна запись
+    removed = 0
+    reclaimed = 0
+    for root, dirs, names in os.walk(blobs_dir(config)):
+        for name in names:
+            if name != '.lock' and name not in referenced:
+                reclaimed += remove_file(os.path.join(root, name))
+                removed += 1
+        if root != blobs_dir(config) and not os.listdir(root):
+            os.rmdir(root)
+    return removed, reclaimed
+
+@timed
+def collect_garbage(storage):
+    # Файлы удалённых задач не трогаются: их вместе с задачей освобождает purge по истечении PURGE_RETENTION_DAYS
+    try:
+        config = get_config()
+        logger.info("Collecting unreferenced file blobs")
+        with blob_lock(config):
+            if storage == 'sqlite':
+                with get_connection(config['TASKS_DB']) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("DELETE FROM blobs WHERE refcount <= 0 OR NOT EXISTS (SELECT 1 FROM files f WHERE f.sha256 = blobs.sha256)")
+                    cursor.execute("SELECT sha256 FROM blobs")
+                    referenced = {row[0] for row in cursor.fetchall()}
+                    conn.commit()
+            else:
+                referenced = referenced_blobs_txt(config)
+            removed_blobs, reclaimed = sweep_blobs(config, referenced)
+        logger.info("Removed %s blobs, reclaimed %s bytes", removed_blobs, reclaimed)
+        return {"message": "Garbage collected", "removed_blobs": removed_blobs, "reclaimed_bytes": reclaimed}
+    except Exception as e:
+        logger.error("Failed to collect garbage: %s", e)
+        return {"error": f"Failed to collect garbage: {str(e)}"}
@@ -26,8 +26,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($task_id) || empty($content)) {
                     $error = $lang['all_fields_required'];
                 } else {
-                    $command = "python3 main.py create_note " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($content);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('create_note', [$user_id, $task_id, $content]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Note created') {
                         $success = $lang['note_created'];
@@ -40,8 +39,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($note_id)) {
                     $error = $lang['note_id_required'];
                 } else {
-                    $command = "python3 main.py delete_note " . escapeshellarg($user_id) . " " . escapeshellarg($note_id);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('delete_note', [$user_id, $note_id]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Note deleted') {
                         $success = $lang['note_deleted'];
@@ -55,8 +53,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($note_id) || empty($target_username)) {
                     $error = $lang['all_fields_required'];
                 } else {
-                    $command = "python3 main.py share_note " . escapeshellarg($user_id) . " " . escapeshellarg($note_id) . " " . escapeshellarg($target_username);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('share_note', [$user_id, $note_id, $target_username]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Note shared') {
                         $success = $lang['note_shared'];
@@ -72,10 +69,17 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                     if ($file_size > 10 * 1024 * 1024 * 1024) {
                         $error = $lang['file_too_large'];
                     } else {
-                        $content = base64_encode(file_get_contents($_FILES['file']['tmp_name']));
-                        $command = "python3 main.py upload_file " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($filename) . " " . escapeshellarg($content);
-                        list($output, $return_var) = python_exec($command);
-                        $result = json_decode(implode('', $output), true);
+                        // Файл передаётся по пути: Python копирует его потоково или переименовывает без копирования
+                        $spool_path = UPLOAD_SPOOL_DIR . '/' . bin2hex(random_bytes(16));
+                        if (move_uploaded_file($_FILES['file']['tmp_name'], $spool_path)) {
+                            list($output, $return_var) = python_exec('upload_file_path', [$user_id, $task_id, $filename, $spool_path, 'move']);
+                            $result = json_decode(implode('', $output), true);
+                            if (file_exists($spool_path)) {
+                                unlink($spool_path);
+                            }
+                        } else {
+                            $result = null;
+                        }
                         if ($result && isset($result['message']) && $result['message'] === 'File uploaded') {
                             $success = $lang['file_uploaded'];
                         } else {
@@ -94,16 +98,14 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($title) || empty($description)) {
                     $error = $lang['all_fields_required'];
                 } else {
-                    $command = "python3 main.py create_task " . escapeshellarg($user_id) . " " . escapeshellarg($title) . " " . escapeshellarg($description);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('create_task', [$user_id, $title, $description]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Task created' && isset($result['task_id'])) {
                         $task_id = $result['task_id'];
                         foreach ($subtasks as $subtask) {
                             $subtask = sanitize_input($subtask);
                             if (!empty($subtask)) {
-                                $command = "python3 main.py create_subtask " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($subtask);
-                                python_exec($command);
+                                python_exec('create_subtask', [$user_id, $task_id, $subtask]);
                             }
                         }
                         $success = $lang['task_created'];
@@ -116,8 +118,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($task_id)) {
                     $error = $lang['task_id_required'];
                 } else {
-                    $command = "python3 main.py delete_task " . escapeshellarg($user_id) . " " . escapeshellarg($task_id);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('delete_task', [$user_id, $task_id]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Task deleted') {
                         $success = $lang['task_deleted'];
@@ -131,8 +132,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($task_id) || empty($target_username)) {
                     $error = $lang['all_fields_required'];
                 } else {
-                    $command = "python3 main.py share_note " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($target_username);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('share_note', [$user_id, $task_id, $target_username]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Note shared') {
                         $success = $lang['task_shared'];
@@ -146,8 +146,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($task_id) || empty($subtask_id)) {
                     $error = $lang['all_fields_required'];
                 } else {
-                    $command = "python3 main.py mark_subtask_completed " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($subtask_id);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('mark_subtask_completed', [$user_id, $task_id, $subtask_id]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Subtask marked as completed') {
                         $success = $lang['subtask_completed'];
@@ -162,8 +161,7 @@ if ($_SERVER['REQUEST_METHOD'] === 'POST') {
                 if (empty($new_password)) {
                     $error = $lang['password_required'];
                 } else {
-                    $command = "python3 main.py change_password " . escapeshellarg($user_id) . " " . escapeshellarg($new_password);
-                    list($output, $return_var) = python_exec($command);
+                    list($output, $return_var) = python_exec('change_password', [$user_id, $new_password]);
                     $result = json_decode(implode('', $output), true);
                     if ($result && isset($result['message']) && $result['message'] === 'Password changed') {
                         $success = $lang['password_changed'];
@@ -192,28 +190,18 @@ $tasks = [];
 $sort_by = $_GET['sort_by'] ?? 'created_at';
 $hide_completed = isset($_GET['hide_completed']) && $_GET['hide_completed'] === '1';
 
-if ($tab === 'notes') {
-    $task_id = $_GET['task_id'] ?? '';
+if ($tab === 'notes' || $tab === 'tasks') {
+    $task_id = $tab === 'notes' ? ($_GET['task_id'] ?? '') : '';
+    $dashboard_args = [$user_id, $sort_by];
     if ($task_id) {
-        $command = "python3 main.py get_notes " . escapeshellarg($user_id) . " " . escapeshellarg($task_id) . " " . escapeshellarg($sort_by);
-        list($output, $return_var) = python_exec($command);
-        $result = json_decode(implode('', $output), true);
-        if ($result && isset($result['notes'])) {
-            $notes = $result['notes'];
-        }
-    }
-    $command = "python3 main.py get_shared_notes " . escapeshellarg($user_id);
-    list($output, $return_var) = python_exec($command);
-    $result = json_decode(implode('', $output), true);
-    if ($result && isset($result['shared_notes'])) {
-        $shared_notes = $result['shared_notes'];
+        $dashboard_args[] = $task_id;
     }
-} elseif ($tab === 'tasks') {
-    $command = "python3 main.py get_tasks " . escapeshellarg($user_id) . " " . escapeshellarg($sort_by);
-    list($output, $return_var) = python_exec($command);
+    list($output, $return_var) = python_exec('get_dashboard', $dashboard_args);
     $result = json_decode(implode('', $output), true);
     if ($result && isset($result['tasks'])) {
         $tasks = $result['tasks'];
+        $notes = $result['notes'] ?? [];
+        $shared_notes = $result['shared_notes'] ?? [];
         if ($hide_completed) {
             $tasks = array_filter($tasks, function($task) {
                 return $task['status'] !== 'completed';
@@ -328,7 +316,13 @@ button:hover { background: #0056b3; }
                             </form>
                             <h5><?= $lang['attached_files'] ?></h5>
                             <ul class="file-list">
-                                <!-- Placeholder for files, implemented in Python -->
+                                <?php foreach ($tasks as $task): ?>
+                                    <?php if ($task['task_id'] === $task_id): ?>
+                                        <?php foreach ($task['files'] as $file): ?>
+                                            <li><a href="download.php?file_id=<?= urlencode($file['file_id']) ?>"><?= htmlspecialchars($file['filename']) ?></a><small><?= htmlspecialchars((string)$file['size']) ?></small></li>
+                                        <?php endforeach; ?>
+                                    <?php endif; ?>
+                                <?php endforeach; ?>
                             </ul>
                             <form method="POST">
                                 <input type="hidden" name="csrf_token" value="<?= htmlspecialchars($_SESSION['csrf_token']) ?>">
@@ -32,6 +32,8 @@ cat > config.php <<EOF
 <?php
 define('PYTHON_PATH', '/usr/bin/python3');
 define('MAIN_PY_PATH', '$INSTALL_DIR/main.py');
+define('DAEMON_SOCKET', '$INSTALL_DIR/note_server.sock');
+define('UPLOAD_SPOOL_DIR', '$INSTALL_DIR/files/.incoming');
 
 \$languages = [
     'ru' => [
@@ -194,7 +196,7 @@ EOF
 
 # Создание директорий и файлов
 echo "Создание директорий и файлов..."
-mkdir -p "$INSTALL_DIR/files"
+mkdir -p "$INSTALL_DIR/files" "$INSTALL_DIR/files/.incoming" "$INSTALL_DIR/mail_spool"
 touch "$INSTALL_DIR/users.db" "$INSTALL_DIR/tasks.db" "$INSTALL_DIR/note_server.log"
 
 # Настройка прав доступа
@@ -294,9 +296,19 @@ SMTP_PORT = $SMTP_PORT
 SMTP_USER = $SMTP_USER
 SMTP_PASS = $SMTP_PASS
 SMTP_FROM = $SMTP_FROM
+MAIL_SPOOL_DIR = $INSTALL_DIR/mail_spool
 SERVER_HOST = $SERVER_HOST
+DAEMON_SOCKET = $INSTALL_DIR/note_server.sock
 EOF
 
+# Применение миграций схемы (индексы, версия схемы)
+echo "Применение миграций схемы..."
+sudo -u www-data python3 "$INSTALL_DIR/main.py" migrate_schema
+if [ $? -ne 0 ]; then
+    echo "Ошибка при применении миграций. Подробности в $INSTALL_DIR/note_server.log"
+    exit 1
+fi
+
 # Настройка PHP для больших файлов
 echo "Настройка PHP для поддержки файлов до 10 ГБ..."
 PHP_INI=$(find /etc/php -name php.ini | grep apache2)
@@ -325,6 +337,43 @@ a2ensite note_server.conf
 a2enmod rewrite
 systemctl restart apache2
 
+# Настройка фонового процесса Python
+echo "Настройка службы note_server..."
+cat > /etc/systemd/system/note_server.service <<EOF
+[Unit]
+Description=Note Server Python daemon
+After=network.target
+
+[Service]
+User=www-data
+Group=www-data
+WorkingDirectory=$INSTALL_DIR
+ExecStart=/usr/bin/python3 $INSTALL_DIR/main.py serve
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+systemctl daemon-reload
+systemctl enable --now note_server.service
+
+# Ежедневная очистка блобов, на которые больше нет ссылок
+echo "Настройка очистки файлов..."
+cat > /etc/cron.d/note_server_gc <<EOF
+30 3 * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py gc_blobs >/dev/null 2>&1
+EOF
+
+# Ежедневное окончательное удаление строк старше PURGE_RETENTION_DAYS
+cat > /etc/cron.d/note_server_purge <<EOF
+0 4 * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py purge >/dev/null 2>&1
+EOF
+
+# Письма отправляет фоновый процесс; cron дослает очередь, если он не запущен
+cat > /etc/cron.d/note_server_mail <<EOF
+*/5 * * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py send_mail >/dev/null 2>&1
+EOF
+
 # Проверка установки
 echo "Проверка установки..."
 if curl -s "http://$SERVER_HOST/welcome.php" | grep -q "Note Server"; then
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import logging
+from config import get_config, on_config_reload
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+# LOG_ROTATE -> формат периода; файл ротируется, когда период последней записи в него закончился
+ROTATE_PERIODS = {'hourly': '%Y%m%d%H', 'daily': '%Y%m%d'}
+# Ротация проверяется раз в столько записей или секунд; файл может перерасти LOG_MAX_BYTES на эти записи
+ROTATE_CHECK_RECORDS = 100
+ROTATE_CHECK_SECONDS = 1.0
+
+logger = logging.getLogger(__name__)
+
+_handler = None
+_listener = None
+_levels = {}
+
+def parse_mapping(value, convert):
+    # "tasks=0.1, notes=WARNING" -> {'tasks': 0.1, 'notes': 'WARNING'}
+    mapping = {}
+    for item in value.split(','):
+        if item.strip():
+            name, _, setting = item.partition('=')
+            mapping[name.strip()] = convert(setting.strip())
+    return mapping
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S') + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "pid": record.process,
+            "thread": record.threadName,
+        }
+        if isinstance(record.args, tuple) and record.args:
+            # Аргументы отдельно от текста, чтобы по ним можно было фильтровать
+            entry["args"] = record.args
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SampleFilter(logging.Filter):
+    # Из записей INFO и ниже модуля проходит доля rate (0.1 - каждая десятая);
+    # предупреждения и ошибки не отбрасываются
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.credit = {}
+
+    def filter(self, record):
+        if record.levelno > logging.INFO:
+            return True
+        rate = self.rates.get(record.name)
+        if rate is None:
+            return True
+        credit = self.credit.get(record.name, 1.0) + rate
+        self.credit[record.name] = credit - 1 if credit >= 1 else credit
+        return credit >= 1
+
+class SharedRotatingFileHandler(logging.FileHandler):
+    # В один файл пишут CLI-процессы и демон: записи дописываются в режиме append без блокировки,
+    # а ротация и переоткрытие файла, который ротировал другой процесс, идут под flock не на каждой записи
+    def __init__(self, filename, max_bytes, backup_count, period):
+        super().__init__(filename, encoding='utf-8', delay=True)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.period = period
+        self.lock_path = filename + '.lock'
+        self.lock_file = None
+        self.unchecked = 0
+        self.checked_at = 0.0
+
+    def reopen_if_rotated(self):
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self.stream.fileno()).st_ino:
+            self.stream.close()
+            self.stream = None
+
+    def should_rotate(self):
+        if self.backup_count <= 0:
+            return False
+        try:
+            st = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return False
+        if self.max_bytes > 0 and st.st_size >= self.max_bytes:
+            return True
+        return bool(self.period and st.st_size
+                    and time.strftime(self.period, time.localtime(st.st_mtime)) != time.strftime(self.period))
+
+    def rotate(self):
+        # note_server.log -> .1 -> .2 ... -> .LOG_BACKUP_COUNT, самый старый удаляется
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.baseFilename}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.baseFilename}.{index + 1}")
+        os.replace(self.baseFilename, self.baseFilename + '.1')
+
+    def check_rotation(self):
+        if self.lock_file is None:
+            self.lock_file = open(self.lock_path, 'a')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        try:
+            self.reopen_if_rotated()
+            if self.should_rotate():
+                self.rotate()
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def emit(self, record):
+        try:
+            now = time.monotonic()
+            if (self.stream is None or self.unchecked >= ROTATE_CHECK_RECORDS
+                    or now - self.checked_at >= ROTATE_CHECK_SECONDS):
+                self.check_rotation()
+                self.unchecked = 0
+                self.checked_at = now
+            self.unchecked += 1
+            super().emit(record)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        super().close()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+def make_handler(config):
+    handler = SharedRotatingFileHandler(config['LOG_FILE'], config['LOG_MAX_BYTES'], config['LOG_BACKUP_COUNT'],
+                                        ROTATE_PERIODS.get(config['LOG_ROTATE']))
+    handler.setFormatter(JsonFormatter() if config['LOG_FORMAT'] == 'json' else logging.Formatter(TEXT_FORMAT))
+    return handler
+
+def is_level(level):
+    return isinstance(logging.getLevelName(level), int)
+
+def apply_levels(config):
+    # Возвращает предупреждения о неверных уровнях: до установки обработчика их некуда записать
+    global _levels
+    warnings = []
+    level = config['LOG_LEVEL'].upper()
+    if not is_level(level):
+        warnings.append(f"Invalid LOG_LEVEL {config['LOG_LEVEL']!r}, using INFO")
+        level = 'INFO'
+    logging.getLogger().setLevel(level)
+    levels = parse_mapping(config['LOG_LEVELS'], str.upper)
+    for name, level in list(levels.items()):
+        if not is_level(level):
+            warnings.append(f"Invalid level {level!r} for {name} in LOG_LEVELS, using LOG_LEVEL")
+            del levels[name]
+    # Модули, убранные из LOG_LEVELS, снова наследуют общий уровень
+    for name in _levels:
+        if name not in levels:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
+    _levels = levels
+    return warnings
+
+def setup_logging(background=False):
+    # CLI-процесс пишет сразу: поток записи ему ничего не даёт, а logging.handlers
+    # заметно удлиняет холодный старт. Демон пишет через очередь и отдельный поток
+    global _handler, _listener
+    if _handler is not None:
+        return
+    config = get_config()
+    warnings = apply_levels(config)
+    file_handler = make_handler(config)
+    if background:
+        import queue
+        from logging.handlers import QueueHandler, QueueListener
+
+        class LazyQueueHandler(QueueHandler):
+            # Очередь внутри процесса: строка собирается в потоке записи, а не в потоке команды
+            def prepare(self, record):
+                return record
+
+        records = queue.SimpleQueue()
+        _handler = LazyQueueHandler(records)
+        _listener = QueueListener(records, file_handler)
+        _listener.start()
+        atexit.register(stop_logging)
+    else:
+        _handler = file_handler
+    _handler.addFilter(SampleFilter(parse_mapping(config['LOG_SAMPLE'], float)))
+    logging.getLogger().addHandler(_handler)
+    for warning in warnings:
+        logger.warning(warning)
+
+def stop_logging():
+    # Записи, сделанные после остановки (например, из других atexit-обработчиков), пишутся сразу в файл
+    global _handler, _listener
+    listener, _listener = _listener, None
+    if listener is None:
+        return
+    listener.stop()
+    root = logging.getLogger()
+    root.removeHandler(_handler)
+    file_handler = listener.handlers[0]
+    file_handler.filters = _handler.filters
+    root.addHandler(file_handler)
+    _handler = file_handler
+
+@on_config_reload
+def _reconfigure(config):
+    if _handler is None:
+        return
+    for warning in apply_levels(config):
+        logger.warning(warning)
+    _handler.filters[0].rates = parse_mapping(config['LOG_SAMPLE'], float)
+    if _listener is not None:
+        previous = _listener.handlers[0]
+        _listener.handlers = (make_handler(config),)
+        previous.close()
+    else:
+        _handler.setFormatter(make_handler(config).formatter)
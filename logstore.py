@@ -0,0 +1,544 @@
+import os
+import json
+import mmap
+import zlib
+import bisect
+import logging
+import datetime
+import threading
+from utils import lock_file, try_lock_file, LockTimeout, parse_txt_line, format_txt_line, TXT_LAYOUTS
+
+logger = logging.getLogger(__name__)
+
+# Вторичные индексы для каждого хранилища (ключ set.conf -> индексируемые поля)
+STORE_KEYS = {
+    'USERS_TXT': ('username', 'email'),
+    'TASKS_TXT': ('user_id',),
+    'NOTES_TXT': ('user_id', 'task_id'),
+    'SUBTASKS_TXT': ('task_id',),
+}
+
+# Контрольная точка индекса пишется, когда не покрытый ею хвост журнала дорастает до этого размера
+INDEX_SAVE_BYTES = 32 * 1024
+# Соседние сегменты сливаются, пока более старый не больше чем в SEGMENT_MERGE_RATIO раз нового
+SEGMENT_MERGE_RATIO = 2
+COMPACT_MIN_DEAD = 1000
+COMPACT_DEAD_RATIO = 0.5
+ENTRY_SIZE = 16
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+def index_key(field, value):
+    # 8 байт хэша поля и значения; коллизии отсеиваются проверкой самой записи
+    data = f"{field}\0{value}".encode('utf-8')
+    return zlib.crc32(data).to_bytes(4, 'big') + zlib.adler32(data).to_bytes(4, 'big')
+
+class Segment:
+    # Отсортированный файл записей фиксированной ширины: ключ (8 байт) + смещение в журнале (8 байт).
+    # Поиск — bisect по mmap, так что холодному процессу не нужно читать индекс целиком
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.count = size // ENTRY_SIZE
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.data[i * ENTRY_SIZE:i * ENTRY_SIZE + 8]
+
+    def offsets(self, key):
+        i = bisect.bisect_left(self, key)
+        while i < self.count and self[i] == key:
+            yield int.from_bytes(self.data[i * ENTRY_SIZE + 8:(i + 1) * ENTRY_SIZE], 'big')
+            i += 1
+
+    def entries(self):
+        return [self.data[i:i + ENTRY_SIZE] for i in range(0, self.count * ENTRY_SIZE, ENTRY_SIZE)]
+
+def write_segment(path, entries):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(b''.join(sorted(entries)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class LogStore:
+    def __init__(self, path, key_fields, legacy_txt=None, legacy_layout=None):
+        self.path = path
+        self.index_path = path + '.index'
+        self.lock_path = path + '.lock'
+        self.key_fields = key_fields
+        self.legacy_txt = legacy_txt
+        self.legacy_layout = legacy_layout
+        self.lock = threading.RLock()
+        self.compacting = False
+        self.retention_days = 0
+        self._reset()
+        self._load_index()
+
+    def _reset(self):
+        self.inode = None
+        self.size = 0
+        self.saved_size = 0
+        self.segments = []
+        self.next_segment = 0
+        # Хвост журнала после контрольной точки: ключ -> смещения
+        self.tail = {}
+        self.live = 0
+        self.dead = 0
+        # Мёртвые строки, которые компактизация оставила до истечения срока хранения удалённых
+        self.retained = 0
+        # Сегменты манифеста, от которого строится индекс в памяти
+        self.base = []
+        # Сегменты прежнего файла журнала, удаляются после следующей контрольной точки
+        self.orphans = []
+
+    def _restart(self, inode):
+        # Индекс строится заново для другого файла; номера сегментов продолжают расти,
+        # чтобы не перезаписать сегменты, которые ещё читают другие процессы
+        orphans = [segment.path for segment in self.segments]
+        next_segment = self.next_segment
+        self._reset()
+        self.inode = inode
+        self.next_segment = next_segment
+        self.orphans = orphans
+
+    def _read_manifest(self):
+        with open(self.index_path) as f:
+            return json.load(f)
+
+    def _load_index(self):
+        # Сегмент может исчезнуть при слиянии в другом процессе между чтением манифеста и открытием
+        for _ in range(3):
+            try:
+                manifest = self._read_manifest()
+                segments = [Segment(os.path.join(os.path.dirname(self.index_path), name))
+                            for name in manifest['segments']]
+            except FileNotFoundError as e:
+                if e.filename == self.index_path:
+                    return
+                continue
+            except Exception as e:
+                logger.error("Failed to load index %s, rebuilding: %s", self.index_path, e)
+                self._reset()
+                return
+            self.inode = manifest['inode']
+            self.size = self.saved_size = manifest['size']
+            self.segments = segments
+            self.base = manifest['segments']
+            self.next_segment = manifest['next_segment']
+            self.live = manifest['live']
+            self.dead = manifest['dead']
+            self.retained = manifest.get('retained', 0)
+            return
+        self._reset()
+
+    def _save_manifest(self):
+        manifest = {'inode': self.inode, 'size': self.size, 'live': self.live, 'dead': self.dead,
+                    'retained': self.retained,
+                    'next_segment': self.next_segment,
+                    'segments': [os.path.basename(segment.path) for segment in self.segments]}
+        tmp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _new_segment(self, entries):
+        path = f"{self.index_path}.{self.next_segment}"
+        self.next_segment += 1
+        write_segment(path, entries)
+        return Segment(path)
+
+    def _rebase(self):
+        # Пока мы читали, индекс сохранил другой процесс: его сегменты могли уже слиться
+        # и исчезнуть, поэтому индекс в памяти строится заново от его манифеста
+        try:
+            manifest = self._read_manifest()
+        except FileNotFoundError:
+            return
+        except Exception:
+            manifest = None
+        if manifest is None or manifest['inode'] != self.inode:
+            # Манифест прежнего файла журнала перезаписывается, его сегменты больше не нужны
+            if manifest is not None:
+                self.orphans += [os.path.join(os.path.dirname(self.index_path), name)
+                                 for name in manifest['segments'] if name not in self.base]
+                self.next_segment = max(self.next_segment, manifest['next_segment'])
+            return
+        if manifest['segments'] == self.base:
+            return
+        self._reset()
+        self._load_index()
+        with open(self.path, 'rb') as f:
+            self._read_tail(f)
+
+    def _save_index(self):
+        # Вызывается под блокировкой писателя. Хвост становится новым маленьким сегментом,
+        # соседние сегменты сравнимого размера сливаются, как в LSM-дереве
+        self._rebase()
+        if self.tail:
+            entries = [key + offset.to_bytes(8, 'big') for key, offsets in self.tail.items() for offset in offsets]
+            self.segments.append(self._new_segment(entries))
+        merged = []
+        while len(self.segments) > 1 and len(self.segments[-2]) <= SEGMENT_MERGE_RATIO * len(self.segments[-1]):
+            newer = self.segments.pop()
+            older = self.segments.pop()
+            self.segments.append(self._new_segment(older.entries() + newer.entries()))
+            merged += [older.path, newer.path]
+        self._save_manifest()
+        for path in merged + self.orphans:
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self.path + '.idx'):
+            # Индекс прежнего формата (pickle целиком)
+            os.remove(self.path + '.idx')
+        self.tail = {}
+        self.base = [os.path.basename(segment.path) for segment in self.segments]
+        self.orphans = []
+        self.saved_size = self.size
+
+    def _checkpoint(self):
+        # Читатель сохраняет индекс, только если может сразу взять блокировку писателя
+        try:
+            with try_lock_file(self.lock_path, 'a'):
+                self._save_index()
+        except LockTimeout:
+            pass
+
+    def _add_key(self, key, offset):
+        self.tail.setdefault(key, []).append(offset)
+
+    def _candidates(self, key):
+        # Новые смещения раньше старых: сначала хвост, затем сегменты от новых к старым
+        yield from reversed(self.tail.get(key, ()))
+        for segment in reversed(self.segments):
+            yield from sorted(segment.offsets(key), reverse=True)
+
+    def _versions(self, f, record_id):
+        # Версии записи от новой к старой: (смещение, запись)
+        for offset in self._candidates(index_key('id', record_id)):
+            record = self._read_at(f, offset)
+            if record['id'] == record_id:
+                yield offset, record
+
+    def _current(self, f, record_id):
+        # Последняя версия записи: (смещение, запись) или None, если записи нет или она удалена
+        for offset, record in self._versions(f, record_id):
+            return None if record.get('_deleted') else (offset, record)
+        return None
+
+    def _created(self, f, record_id):
+        # Смещение первой версии записи задаёт порядок создания
+        return min(offset for offset, _ in self._versions(f, record_id))
+
+    def _read_at(self, f, offset):
+        # pread не сдвигает позицию файла, поэтому безопасен во время итерации по f
+        fd = f.fileno()
+        chunks = []
+        while True:
+            chunk = os.pread(fd, 4096, offset)
+            end = chunk.find(b'\n')
+            if end >= 0 or not chunk:
+                chunks.append(chunk[:end] if end >= 0 else chunk)
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        return json.loads(b''.join(chunks))
+
+    def _apply(self, f, record, offset):
+        record_id = record['id']
+        if self._current(f, record_id) is not None:
+            self.live -= 1
+            self.dead += 1
+        self._add_key(index_key('id', record_id), offset)
+        if record.get('_deleted'):
+            self.dead += 1
+            return
+        self.live += 1
+        for field in self.key_fields:
+            self._add_key(index_key(field, record.get(field)), offset)
+
+    def _sync(self, f):
+        st = os.fstat(f.fileno())
+        if st.st_ino != self.inode or st.st_size < self.size:
+            # Файл заменён компактизацией в другом процессе
+            self._reset()
+            self._load_index()
+            if st.st_ino != self.inode or st.st_size < self.size:
+                self._restart(st.st_ino)
+        if st.st_size == self.size:
+            return
+        self._read_tail(f)
+        if self.size - self.saved_size >= INDEX_SAVE_BYTES:
+            self._checkpoint()
+
+    def _read_tail(self, f):
+        f.seek(self.size)
+        offset = self.size
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            self._apply(f, json.loads(line), offset)
+            offset += len(line)
+        self.size = offset
+
+    def _open(self):
+        f = open(self.path, 'rb')
+        try:
+            self._sync(f)
+        except Exception:
+            f.close()
+            raise
+        return f
+
+    def _writer(self):
+        return lock_file(self.lock_path, 'a')
+
+    def _ensure_created(self):
+        if os.path.exists(self.path):
+            return
+        with self._writer():
+            if os.path.exists(self.path):
+                return
+            tmp_path = self.path + '.tmp'
+            count = 0
+            with open(tmp_path, 'wb') as out:
+                if self.legacy_txt and os.path.exists(self.legacy_txt):
+                    with lock_file(self.legacy_txt, 'r') as f:
+                        for line in f:
+                            record = parse_txt_line(line, self.legacy_layout)
+                            if not record:
+                                continue
+                            if record.pop('deleted', '0') == '1':
+                                continue
+                            out.write(self._encode(record))
+                            count += 1
+                out.flush()
+                os.fsync(out.fileno())
+            os.replace(tmp_path, self.path)
+            if count:
+                logger.info("Imported %s records from %s into %s", count, self.legacy_txt, self.path)
+
+    def _encode(self, record):
+        return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+    def get(self, record_id):
+        self._ensure_created()
+        with self.lock:
+            f = self._open()
+            try:
+                current = self._current(f, record_id)
+                return current[1] if current is not None else None
+            finally:
+                f.close()
+
+    def find(self, field, value, by_creation=False):
+        self._ensure_created()
+        with self.lock:
+            f = self._open()
+            try:
+                # Кандидаты проверяются: хэш мог совпасть случайно, а запись - устареть или быть удалённой.
+                # Записи возвращаются в порядке журнала (последних версий) или, с by_creation, в порядке создания
+                found = {}
+                for offset in self._candidates(index_key(field, value)):
+                    record = self._read_at(f, offset)
+                    if record.get(field) != value or record['id'] in found:
+                        continue
+                    current = self._current(f, record['id'])
+                    if current is not None and current[0] == offset:
+                        found[record['id']] = (offset, record)
+                if by_creation:
+                    return sorted((record for _, record in found.values()), key=lambda record: self._created(f, record['id']))
+                return [record for _, record in sorted(found.values(), key=lambda item: item[0])]
+            finally:
+                f.close()
+
+    # Порядок блокировок: сначала файловая блокировка писателя, затем self.lock
+    def _append_locked(self, records):
+        with self.lock:
+            with open(self.path, 'ab') as out:
+                reader = self._open()
+                try:
+                    out.seek(0, os.SEEK_END)
+                    offset = out.tell()
+                    for record in records:
+                        data = self._encode(record)
+                        out.write(data)
+                        out.flush()
+                        self._apply(reader, record, offset)
+                        offset += len(data)
+                    self.size = offset
+                finally:
+                    reader.close()
+                if self.size - self.saved_size >= INDEX_SAVE_BYTES:
+                    self._save_index()
+
+    def put(self, record):
+        self._ensure_created()
+        with self._writer():
+            self._append_locked([record])
+        self._maybe_compact()
+
+    def update(self, record_id, **changes):
+        self._ensure_created()
+        with self._writer():
+            record = self.get(record_id)
+            if record is None:
+                return None
+            record.update(changes)
+            self._append_locked([record])
+        self._maybe_compact()
+        return record
+
+    def delete(self, record_id, deleted_at=None):
+        # deleted_at задаёт начало срока хранения, по умолчанию - сейчас
+        self._ensure_created()
+        with self._writer():
+            if self.get(record_id) is None:
+                return False
+            self._append_locked([{'id': record_id, '_deleted': 1,
+                                  '_deleted_at': deleted_at or datetime.datetime.now().isoformat()}])
+        self._maybe_compact()
+        return True
+
+    def _needs_compaction(self):
+        dead = self.dead - self.retained
+        return dead >= COMPACT_MIN_DEAD and dead >= COMPACT_DEAD_RATIO * (self.dead + self.live)
+
+    def _maybe_compact(self):
+        with self.lock:
+            if self.compacting or not self._needs_compaction():
+                return
+            self.compacting = True
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=self.retention_days)).isoformat()
+        # Команда CLI не ждёт компактизацию при выходе: недописанный файл остаётся .tmp, журнал не меняется
+        threading.Thread(target=self.compact, args=(cutoff,), name=f"compact:{self.path}", daemon=True).start()
+
+    def compact(self, cutoff):
+        # Удалённая запись исчезает из файла, только когда её удаление старше cutoff, как при purge
+        # в txt и sqlite; до этого остаются её последняя версия и пометка об удалении.
+        # Пометки без времени удаления записаны до появления срока хранения и считаются истёкшими
+        try:
+            self._ensure_created()
+            with self._writer():
+                with self.lock:
+                    f = self._open()
+                    end = self.size
+                # Последняя версия каждой записи встаёт на место первой, так что порядок создания сохраняется
+                latest = {}
+                deleted = {}
+                f.seek(0)
+                offset = 0
+                for line in f:
+                    if offset + len(line) > end:
+                        break
+                    record = json.loads(line)
+                    if record.get('_deleted'):
+                        deleted[record['id']] = (offset, record.get('_deleted_at') or '')
+                    else:
+                        latest[record['id']] = offset
+                        deleted.pop(record['id'], None)
+                    offset += len(line)
+                offsets = []
+                for record_id, offset in latest.items():
+                    if record_id not in deleted:
+                        offsets.append(offset)
+                    elif deleted[record_id][1] > cutoff:
+                        offsets += [offset, deleted[record_id][0]]
+                del latest, deleted
+                before = os.fstat(f.fileno()).st_size
+                tmp_path = self.path + '.tmp'
+                try:
+                    # Писатели заблокированы, читатели продолжают работать со старым файлом
+                    with open(tmp_path, 'wb') as out:
+                        for offset in offsets:
+                            f.seek(offset)
+                            out.write(f.readline())
+                        out.flush()
+                        os.fsync(out.fileno())
+                finally:
+                    f.close()
+                with self.lock:
+                    os.replace(tmp_path, self.path)
+                    self._restart(os.stat(self.path).st_ino)
+                    self._open().close()
+                    self.retained = self.dead
+                    self._save_index()
+                    after = self.size
+            logger.info("Compacted %s: %s -> %s bytes", self.path, before, after)
+            return before - after
+        except Exception as e:
+            logger.error("Failed to compact %s: %s", self.path, e)
+            return 0
+        finally:
+            self.compacting = False
+
+    def export_txt(self):
+        # Журнал выгружается обратно в txt-файл, после чего откладывается в сторону, чтобы при
+        # следующем переходе на log txt-файл был импортирован заново, а не расходился с журналом
+        self._ensure_created()
+        with self._writer():
+            with self.lock:
+                f = self._open()
+                end = self.size
+            try:
+                latest = {}
+                deleted = set()
+                f.seek(0)
+                offset = 0
+                for line in f:
+                    offset += len(line)
+                    if offset > end:
+                        break
+                    record = json.loads(line)
+                    if record.get('_deleted'):
+                        deleted.add(record['id'])
+                    else:
+                        latest[record['id']] = record
+                        deleted.discard(record['id'])
+            finally:
+                f.close()
+            has_deleted = any(name == 'deleted' for name, _ in self.legacy_layout[2])
+            tmp_path = self.legacy_txt + '.export.tmp'
+            count = 0
+            with open(tmp_path, 'w') as out:
+                for record_id, record in latest.items():
+                    if has_deleted:
+                        # Удалённые, но ещё хранимые записи дождутся purge в txt
+                        record['deleted'] = '1' if record_id in deleted else '0'
+                    elif record_id in deleted:
+                        continue
+                    out.write(format_txt_line(record, self.legacy_layout))
+                    count += 1
+                out.flush()
+                os.fsync(out.fileno())
+            with lock_file(self.legacy_txt, 'a'):
+                os.replace(tmp_path, self.legacy_txt)
+            with self.lock:
+                os.replace(self.path, self.path + '.exported')
+                for path in [segment.path for segment in self.segments] + self.orphans + [self.index_path]:
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._reset()
+        logger.info("Exported %s records from %s into %s", count, self.path, self.legacy_txt)
+        return count
+
+def open_store(config, name):
+    path = config[name] + '.log'
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None:
+            store = _stores[path] = LogStore(path, STORE_KEYS[name], config[name], TXT_LAYOUTS[name])
+        store.retention_days = config['PURGE_RETENTION_DAYS']
+        return store
+
+def get_owned_task(config, task_id, user_id):
+    task = open_store(config, 'TASKS_TXT').get(task_id)
+    if task is None or task['user_id'] != user_id:
+        return None
+    return task
@@ -0,0 +1,301 @@
+import os
+import json
+import time
+import secrets
+import smtplib
+import logging
+import datetime
+import threading
+from email.mime.text import MIMEText
+from config import get_config
+from metrics import timed
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRY_DELAY = 3600
+# Сообщение, взятое в отправку и не вернувшееся за это время, снова считается ожидающим
+CLAIM_LEASE = 300
+SMTP_SETTINGS = ('SMTP_HOST', 'SMTP_PORT', 'SMTP_USER', 'SMTP_PASS', 'SMTP_STARTTLS', 'SMTP_TIMEOUT')
+
+_worker = None
+_worker_lock = threading.Lock()
+
+class SMTPSession:
+    # Одно авторизованное SMTP-соединение на несколько писем и между проходами отправителя
+    def __init__(self):
+        self.server = None
+        self.settings = None
+        self.last_used = 0
+
+    def get(self, config):
+        settings = tuple(config[name] for name in SMTP_SETTINGS)
+        if self.server is not None and (settings != self.settings or self.idle(config)):
+            self.close()
+        if self.server is not None:
+            try:
+                alive = self.server.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if not alive:
+                self.close()
+        if self.server is None:
+            server = smtplib.SMTP(config['SMTP_HOST'], config['SMTP_PORT'], timeout=config['SMTP_TIMEOUT'])
+            try:
+                if config['SMTP_STARTTLS']:
+                    server.starttls()
+                if config['SMTP_USER']:
+                    server.login(config['SMTP_USER'], config['SMTP_PASS'])
+            except BaseException:
+                server.close()
+                raise
+            self.server = server
+            self.settings = settings
+            logger.info("Connected to SMTP server %s:%s", config['SMTP_HOST'], config['SMTP_PORT'])
+        self.last_used = time.monotonic()
+        return self.server
+
+    def idle(self, config):
+        return time.monotonic() - self.last_used > config['SMTP_IDLE_TIMEOUT']
+
+    def close(self):
+        server, self.server = self.server, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+def now():
+    return datetime.datetime.now()
+
+def retry_delay(config, attempts):
+    return min(config['MAIL_RETRY_DELAY'] * 2 ** (attempts - 1), MAX_RETRY_DELAY)
+
+def is_permanent(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+def spool_dirs(config):
+    spool = config['MAIL_SPOOL_DIR']
+    dirs = {name: os.path.join(spool, name) for name in ('tmp', 'new', 'cur', 'failed')}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+def write_spool_message(dirs, target, message):
+    tmp_path = os.path.join(dirs['tmp'], f"{message['id']}.{os.getpid()}.{threading.get_ident()}.json")
+    with open(tmp_path, 'w') as f:
+        json.dump(message, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(dirs[target], f"{message['id']}.json"))
+
+def enqueue_mail(recipient, subject, body, storage):
+    config = get_config()
+    message = {
+        'id': secrets.token_hex(8),
+        'recipient': recipient,
+        'subject': subject,
+        'body': body,
+        'attempts': 0,
+        'next_attempt_at': now().isoformat(),
+        'last_error': None,
+        'created_at': now().isoformat()
+    }
+    if storage == 'sqlite':
+        with get_connection(config['USERS_DB']) as conn:
+            conn.execute("""
+                INSERT INTO outbox (id, recipient, subject, body, attempts, next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+            """, (message['id'], recipient, subject, body, message['next_attempt_at'], message['created_at']))
+            conn.commit()
+    else:
+        write_spool_message(spool_dirs(config), 'new', message)
+    logger.info("Queued mail %s to %s", message['id'], recipient)
+    wake_worker()
+    return message['id']
+
+def claim_sqlite(config, limit):
+    started = now()
+    lease = (started + datetime.timedelta(seconds=CLAIM_LEASE)).isoformat()
+    with get_connection(config['USERS_DB']) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute("""
+            SELECT id, recipient, subject, body, attempts
+            FROM outbox
+            WHERE failed = 0 AND next_attempt_at <= ?
+            ORDER BY next_attempt_at
+            LIMIT ?
+        """, (started.isoformat(), limit)).fetchall()
+        conn.executemany("UPDATE outbox SET next_attempt_at = ? WHERE id = ?", [(lease, row[0]) for row in rows])
+        conn.commit()
+    keys = ('id', 'recipient', 'subject', 'body', 'attempts')
+    return [dict(zip(keys, row)) for row in rows]
+
+def finish_sqlite(config, message, error):
+    with get_connection(config['USERS_DB']) as conn:
+        if error is None:
+            conn.execute("DELETE FROM outbox WHERE id = ?", (message['id'],))
+        else:
+            conn.execute("UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ?, failed = ? WHERE id = ?",
+                         (message['attempts'], message['next_attempt_at'], message['last_error'],
+                          int(message['failed']), message['id']))
+        conn.commit()
+
+def claim_spool(config, limit):
+    dirs = spool_dirs(config)
+    started = now()
+    # Письма из cur/, застрявшие после падения отправителя, возвращаются в очередь
+    for name in os.listdir(dirs['cur']):
+        path = os.path.join(dirs['cur'], name)
+        try:
+            if time.time() - os.stat(path).st_mtime > CLAIM_LEASE:
+                os.replace(path, os.path.join(dirs['new'], name))
+        except FileNotFoundError:
+            pass
+    due = []
+    for name in os.listdir(dirs['new']):
+        try:
+            with open(os.path.join(dirs['new'], name)) as f:
+                message = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logger.error("Invalid spooled mail %s: %s", name, e)
+            os.replace(os.path.join(dirs['new'], name), os.path.join(dirs['failed'], name))
+            continue
+        if message['next_attempt_at'] <= started.isoformat():
+            due.append((message['next_attempt_at'], name, message))
+    claimed = []
+    for _, name, message in sorted(due)[:limit]:
+        # Переименование атомарно, поэтому письмо забирает только один отправитель
+        try:
+            os.replace(os.path.join(dirs['new'], name), os.path.join(dirs['cur'], name))
+        except FileNotFoundError:
+            continue
+        os.utime(os.path.join(dirs['cur'], name))
+        claimed.append(message)
+    return claimed
+
+def finish_spool(config, message, error):
+    dirs = spool_dirs(config)
+    if error is None:
+        os.remove(os.path.join(dirs['cur'], f"{message['id']}.json"))
+        return
+    write_spool_message(dirs, 'failed' if message['failed'] else 'new', message)
+    os.remove(os.path.join(dirs['cur'], f"{message['id']}.json"))
+
+def send_message(config, session, message):
+    msg = MIMEText(message['body'])
+    msg['Subject'] = message['subject']
+    msg['From'] = config['SMTP_FROM']
+    msg['To'] = message['recipient']
+    try:
+        session.get(config).sendmail(config['SMTP_FROM'], message['recipient'], msg.as_string())
+        return None
+    except Exception as e:
+        if not isinstance(e, smtplib.SMTPResponseException):
+            # Соединение в неизвестном состоянии, следующее письмо откроет новое
+            session.close()
+        return e
+
+def send_pending(config, storage, session):
+    claim, finish = (claim_sqlite, finish_sqlite) if storage == 'sqlite' else (claim_spool, finish_spool)
+    sent = retried = failed = 0
+    messages = claim(config, config['MAIL_BATCH_SIZE'])
+    for message in messages:
+        error = send_message(config, session, message)
+        if error is None:
+            sent += 1
+            logger.info("Sent mail %s to %s", message['id'], message['recipient'])
+        else:
+            message['attempts'] += 1
+            message['last_error'] = str(error)
+            message['failed'] = is_permanent(error) or message['attempts'] >= config['MAIL_MAX_ATTEMPTS']
+            delay = retry_delay(config, message['attempts'])
+            message['next_attempt_at'] = (now() + datetime.timedelta(seconds=delay)).isoformat()
+            if message['failed']:
+                failed += 1
+                logger.error("Giving up on mail %s to %s after %s attempts: %s", message['id'], message['recipient'], message['attempts'], error)
+            else:
+                retried += 1
+                logger.error("Failed to send mail %s, retrying in %ss: %s", message['id'], delay, error)
+        finish(config, message, error)
+    return {"claimed": len(messages), "sent": sent, "retried": retried, "failed": failed}
+
+class MailWorker(threading.Thread):
+    def __init__(self):
+        super().__init__(name='mail-sender', daemon=True)
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.session = SMTPSession()
+
+    def run(self):
+        logger.info("Mail sender started")
+        while not self.stopping:
+            # Сброс до прохода, а не после ожидания: письмо, поставленное во время прохода,
+            # снова взведёт событие, и следующий проход начнётся сразу
+            self.wakeup.clear()
+            config = get_config()
+            result = None
+            try:
+                result = send_pending(config, config['STORAGE'], self.session)
+            except Exception as e:
+                logger.error("Mail sender pass failed: %s", e)
+            if result and result['claimed'] >= config['MAIL_BATCH_SIZE']:
+                continue
+            if self.session.idle(config):
+                self.session.close()
+            self.wakeup.wait(config['MAIL_POLL_INTERVAL'])
+        self.session.close()
+        logger.info("Mail sender stopped")
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        self.join()
+
+def start_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = MailWorker()
+            _worker.start()
+        return _worker
+
+def stop_worker():
+    global _worker
+    with _worker_lock:
+        worker, _worker = _worker, None
+    if worker is not None:
+        worker.stop()
+
+def wake_worker():
+    worker = _worker
+    if worker is not None:
+        worker.wakeup.set()
+
+@timed
+def send_mail(storage):
+    try:
+        config = get_config()
+        logger.info("Sending queued mail")
+        session = SMTPSession()
+        totals = {"sent": 0, "retried": 0, "failed": 0}
+        try:
+            while True:
+                result = send_pending(config, storage, session)
+                for key in totals:
+                    totals[key] += result[key]
+                if result['claimed'] < config['MAIL_BATCH_SIZE']:
+                    break
+        finally:
+            session.close()
+        logger.info("Mail queue processed: %s sent, %s retried, %s failed", totals['sent'], totals['retried'], totals['failed'])
+        return {"message": "Mail queue processed", **totals}
+    except Exception as e:
+        logger.error("Failed to send mail: %s", e)
+        return {"error": f"Failed to send mail: {str(e)}"}
@@ -1,106 +1,281 @@
-import argparse
 import json
 import logging
+import sys
+import types
 from config import get_config
-from users import register_user, login_user, change_password, user_exists, get_username, request_password_reset, reset_password
-from tasks import create_task, get_tasks, delete_task
-from notes import create_note, edit_note, delete_note, get_notes, share_note, get_shared_notes
-from subtasks import create_subtask, get_subtasks, mark_subtask_completed
-from files import upload_file
+import metrics
 
-def main():
-    config = get_config()
-    logging.basicConfig(filename=config['LOG_FILE'], level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger('main')
 
-    parser = argparse.ArgumentParser(description='Note Server CLI')
-    parser.add_argument('command', choices=[
-        'register', 'login', 'create_task', 'get_tasks', 'delete_task',
-        'create_note', 'edit_note', 'delete_note', 'get_notes', 'share_note', 'get_shared_notes',
-        'create_subtask', 'get_subtasks', 'mark_subtask_completed',
-        'upload_file', 'change_password', 'request_password_reset', 'reset_password'
-    ])
-    parser.add_argument('args', nargs='*')
-    args = parser.parse_args()
+COMMANDS = [
+    'register', 'login', 'create_task', 'get_tasks', 'get_dashboard', 'search', 'delete_task',
+    'create_note', 'edit_note', 'delete_note', 'get_notes', 'share_note', 'get_shared_notes',
+    'create_subtask', 'get_subtasks', 'mark_subtask_completed',
+    'upload_file', 'upload_file_path', 'list_files', 'download_file',
+    'change_password', 'request_password_reset', 'reset_password',
+    'gc_blobs', 'purge', 'send_mail', 'stats', 'migrate_schema', 'migrate', 'serve', 'batch'
+]
+
+def execute_command(command, args, storage):
+    if not metrics.ENABLED:
+        return dispatch_command(command, args, storage)
+    # Неизвестные имена команд из сокета не должны плодить метки
+    label = command if command in COMMANDS else 'unknown'
+    with metrics.timer('command', label):
+        result = dispatch_command(command, args, storage)
+    if 'error' in result:
+        metrics.increment('command_errors', label)
+    return result
 
+def stream_command(command, args, out, storage):
+    # Команды с потоком байтов после строки JSON-заголовка: пишут прямо в out (stdout или сокет)
+    with metrics.timer('command', command):
+        if len(args) < 2 or len(args) > 5:
+            result = {'error': 'download_file requires user_id, file_id and optional range, if_none_match, if_modified_since'}
+            logger.error("Command %s failed: %s", command, result['error'])
+            out.write(json.dumps(result).encode('utf-8') + b'\n')
+            out.flush()
+        else:
+            from files import download_file
+            result = download_file(out, args[0], args[1], storage, *[arg or None for arg in args[2:]])
+    if 'error' in result:
+        metrics.increment('command_errors', command)
+    return result
+
+def dispatch_command(command, args, storage):
     result = {}
     try:
-        if args.command == 'register':
-            if len(args.args) != 3:
+        if command == 'register':
+            if len(args) != 3:
                 raise ValueError('register requires username, password, email')
-            result = register_user(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'login':
-            if len(args.args) != 2:
+            from users import register_user
+            result = register_user(args[0], args[1], args[2], storage)
+        elif command == 'login':
+            if len(args) != 2:
                 raise ValueError('login requires username, password')
-            result = login_user(args.args[0], args.args[1], config['STORAGE'])
-        elif args.command == 'create_task':
-            if len(args.args) != 3:
+            from users import login_user
+            result = login_user(args[0], args[1], storage)
+        elif command == 'create_task':
+            if len(args) != 3:
                 raise ValueError('create_task requires user_id, title, description')
-            result = create_task(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'get_tasks':
-            if len(args.args) != 2:
-                raise ValueError('get_tasks requires user_id, sort_by')
-            result = get_tasks(args.args[0], config['STORAGE'], sort_by=args.args[1])
-        elif args.command == 'delete_task':
-            if len(args.args) != 2:
+            from tasks import create_task
+            result = create_task(args[0], args[1], args[2], storage)
+        elif command == 'get_tasks':
+            if len(args) < 2 or len(args) > 4:
+                raise ValueError('get_tasks requires user_id, sort_by and optional limit, after')
+            from tasks import get_tasks
+            result = get_tasks(args[0], storage, sort_by=args[1],
+                               limit=int(args[2]) if len(args) > 2 and args[2] != '' else None,
+                               after=args[3] if len(args) > 3 else None)
+        elif command == 'get_dashboard':
+            if len(args) not in (2, 3):
+                raise ValueError('get_dashboard requires user_id, sort_by and optional task_id')
+            from dashboard import get_dashboard
+            result = get_dashboard(args[0], storage, sort_by=args[1], task_id=args[2] if len(args) == 3 else None)
+        elif command == 'search':
+            if len(args) < 2 or len(args) > 4:
+                raise ValueError('search requires user_id, query and optional limit, offset')
+            from search import search
+            result = search(args[0], args[1], storage,
+                            limit=int(args[2]) if len(args) > 2 else 20,
+                            offset=int(args[3]) if len(args) > 3 else 0)
+        elif command == 'delete_task':
+            if len(args) != 2:
                 raise ValueError('delete_task requires user_id, task_id')
-            result = delete_task(args.args[0], args.args[1], config['STORAGE'])
-        elif args.command == 'create_note':
-            if len(args.args) != 3:
+            from tasks import delete_task
+            result = delete_task(args[0], args[1], storage)
+        elif command == 'create_note':
+            if len(args) != 3:
                 raise ValueError('create_note requires user_id, task_id, content')
-            result = create_note(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'edit_note':
-            if len(args.args) != 3:
+            from notes import create_note
+            result = create_note(args[0], args[1], args[2], storage)
+        elif command == 'edit_note':
+            if len(args) != 3:
                 raise ValueError('edit_note requires user_id, note_id, content')
-            result = edit_note(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'delete_note':
-            if len(args.args) != 2:
+            from notes import edit_note
+            result = edit_note(args[0], args[1], args[2], storage)
+        elif command == 'delete_note':
+            if len(args) != 2:
                 raise ValueError('delete_note requires user_id, note_id')
-            result = delete_note(args.args[0], args.args[1], config['STORAGE'])
-        elif args.command == 'get_notes':
-            if len(args.args) != 3:
-                raise ValueError('get_notes requires user_id, task_id, sort_by')
-            result = get_notes(args.args[0], args.args[1], config['STORAGE'], sort_by=args.args[2])
-        elif args.command == 'share_note':
-            if len(args.args) != 3:
+            from notes import delete_note
+            result = delete_note(args[0], args[1], storage)
+        elif command == 'get_notes':
+            if len(args) < 3 or len(args) > 5:
+                raise ValueError('get_notes requires user_id, task_id, sort_by and optional limit, after')
+            from notes import get_notes
+            result = get_notes(args[0], args[1], storage, sort_by=args[2],
+                               limit=int(args[3]) if len(args) > 3 and args[3] != '' else None,
+                               after=args[4] if len(args) > 4 else None)
+        elif command == 'share_note':
+            if len(args) != 3:
                 raise ValueError('share_note requires user_id, note_id, target_username')
-            result = share_note(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'get_shared_notes':
-            if len(args.args) != 1:
-                raise ValueError('get_shared_notes requires user_id')
-            result = get_shared_notes(args.args[0], config['STORAGE'])
-        elif args.command == 'create_subtask':
-            if len(args.args) != 3:
+            from notes import share_note
+            result = share_note(args[0], args[1], args[2], storage)
+        elif command == 'get_shared_notes':
+            if len(args) < 1 or len(args) > 3:
+                raise ValueError('get_shared_notes requires user_id and optional limit, after')
+            from notes import get_shared_notes
+            result = get_shared_notes(args[0], storage,
+                                      limit=int(args[1]) if len(args) > 1 and args[1] != '' else None,
+                                      after=args[2] if len(args) > 2 else None)
+        elif command == 'create_subtask':
+            if len(args) != 3:
                 raise ValueError('create_subtask requires user_id, task_id, title')
-            result = create_subtask(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'get_subtasks':
-            if len(args.args) != 2:
-                raise ValueError('get_subtasks requires user_id, task_id')
-            result = get_subtasks(args.args[0], args.args[1], config['STORAGE'])
-        elif args.command == 'mark_subtask_completed':
-            if len(args.args) != 3:
+            from subtasks import create_subtask
+            result = create_subtask(args[0], args[1], args[2], storage)
+        elif command == 'get_subtasks':
+            if len(args) < 2 or len(args) > 5:
+                raise ValueError('get_subtasks requires user_id, task_id and optional status (all, open, completed), limit, offset')
+            from subtasks import get_subtasks
+            result = get_subtasks(args[0], args[1], storage,
+                                  status=args[2] if len(args) > 2 else 'all',
+                                  limit=int(args[3]) if len(args) > 3 and args[3] != '' else None,
+                                  offset=int(args[4]) if len(args) > 4 else 0)
+        elif command == 'mark_subtask_completed':
+            if len(args) != 3:
                 raise ValueError('mark_subtask_completed requires user_id, task_id, subtask_id')
-            result = mark_subtask_completed(args.args[0], args.args[1], args.args[2], config['STORAGE'])
-        elif args.command == 'upload_file':
-            if len(args.args) != 4:
+            from subtasks import mark_subtask_completed
+            result = mark_subtask_completed(args[0], args[1], args[2], storage)
+        elif command == 'upload_file':
+            if len(args) != 4:
                 raise ValueError('upload_file requires user_id, task_id, filename, content')
-            result = upload_file(args.args[0], args.args[1], args.args[2], args.args[3], config['STORAGE'])
-        elif args.command == 'change_password':
-            if len(args.args) != 2:
+            from files import upload_file
+            result = upload_file(args[0], args[1], args[2], args[3], storage)
+        elif command == 'upload_file_path':
+            if len(args) not in (4, 5) or (len(args) == 5 and args[4] != 'move'):
+                raise ValueError('upload_file_path requires user_id, task_id, filename, path (or - for stdin), optional move')
+            from files import upload_file_from_path
+            result = upload_file_from_path(args[0], args[1], args[2], args[3], storage, move=len(args) == 5)
+        elif command == 'list_files':
+            if len(args) < 1 or len(args) > 4:
+                raise ValueError('list_files requires user_id and optional task_id, limit, after')
+            from files import list_files
+            result = list_files(args[0], storage,
+                                task_id=args[1] if len(args) > 1 and args[1] != '' else None,
+                                limit=int(args[2]) if len(args) > 2 and args[2] != '' else None,
+                                after=args[3] if len(args) > 3 else None)
+        elif command == 'download_file':
+            raise ValueError('download_file streams file content and must be called directly, not in a batch')
+        elif command == 'change_password':
+            if len(args) != 2:
                 raise ValueError('change_password requires user_id, new_password')
-            result = change_password(args.args[0], args.args[1], config['STORAGE'])
-        elif args.command == 'request_password_reset':
-            if len(args.args) != 1:
+            from users import change_password
+            result = change_password(args[0], args[1], storage)
+        elif command == 'request_password_reset':
+            if len(args) != 1:
                 raise ValueError('request_password_reset requires email')
-            result = request_password_reset(args.args[0], config['STORAGE'])
-        elif args.command == 'reset_password':
-            if len(args.args) != 2:
+            from users import request_password_reset
+            result = request_password_reset(args[0], storage)
+        elif command == 'reset_password':
+            if len(args) != 2:
                 raise ValueError('reset_password requires token, new_password')
-            result = reset_password(args.args[0], args.args[1], config['STORAGE'])
+            from users import reset_password
+            result = reset_password(args[0], args[1], storage)
+        elif command == 'gc_blobs':
+            if len(args) != 0:
+                raise ValueError('gc_blobs takes no arguments')
+            from files import collect_garbage
+            result = collect_garbage(storage)
+        elif command == 'purge':
+            if len(args) != 0:
+                raise ValueError('purge takes no arguments')
+            from purge import purge_deleted
+            result = purge_deleted(storage)
+        elif command == 'send_mail':
+            if len(args) != 0:
+                raise ValueError('send_mail takes no arguments')
+            from mailer import send_mail
+            result = send_mail(storage)
+        elif command == 'stats':
+            if len(args) != 0:
+                raise ValueError('stats takes no arguments')
+            from cache import cache_stats
+            result = metrics.get_stats()
+            if 'error' not in result:
+                result['cache'] = cache_stats()
+        elif command == 'migrate':
+            if len(args) not in (1, 2) or (len(args) == 2 and args[1] != 'restart'):
+                raise ValueError('migrate requires direction (to_sqlite or to_txt) and optional restart')
+            from migrate import migrate_storage
+            result = migrate_storage(args[0], storage, restart=len(args) == 2)
+        elif command == 'migrate_schema':
+            if len(args) != 0:
+                raise ValueError('migrate_schema takes no arguments')
+            from migrations import migrate_schema
+            result = migrate_schema(storage)
+        else:
+            raise ValueError(f'Unknown command: {command}')
     except Exception as e:
         result = {'error': str(e)}
-        logging.error(f"Command {args.command} failed: {str(e)}")
+        logger.error("Command %s failed: %s", command, e)
+
+    return result
 
+def parse_args(argv):
+    # Быстрый путь для вызовов из PHP: argparse нужен только для справки и ошибок
+    if argv and argv[0] in COMMANDS and not any(arg.startswith('-') and arg != '-' for arg in argv):
+        return types.SimpleNamespace(command=argv[0], args=argv[1:])
+    import argparse
+    parser = argparse.ArgumentParser(description='Note Server CLI')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('args', nargs='*')
+    return parser.parse_args(argv)
+
+def print_result(result):
+    # Ненулевой код выхода позволяет скриптам установки и PHP (exec) заметить ошибку без разбора JSON
     print(json.dumps(result))
+    if 'error' in result:
+        sys.exit(1)
+
+def main():
+    config = get_config()
+    args = parse_args(sys.argv[1:])
+    from logs import setup_logging
+    setup_logging(background=args.command == 'serve')
+
+    if args.command == 'serve':
+        from server import serve
+        from migrations import migrate_schema
+        result = migrate_schema(config['STORAGE'])
+        if 'error' in result:
+            print_result(result)
+            return
+        serve(config, execute_command, stream_command)
+        return
+
+    if args.command == 'download_file':
+        stream_command(args.command, args.args, sys.stdout.buffer, config['STORAGE'])
+        return
+
+    if args.command == 'batch':
+        from batch import run_batch
+        if len(args.args) > 2:
+            print_result({'error': 'batch takes optional path (- for stdin) and batch_size'})
+            return
+        path = args.args[0] if args.args else '-'
+        try:
+            batch_size = int(args.args[1]) if len(args.args) > 1 else config['BATCH_SIZE']
+        except ValueError:
+            batch_size = 0
+        if batch_size < 1:
+            print_result({'error': 'batch_size must be a positive integer'})
+            return
+        if path == '-':
+            result = run_batch(sys.stdin, sys.stdout, config['STORAGE'], execute_command, batch_size)
+        else:
+            try:
+                source = open(path, encoding='utf-8')
+            except OSError as e:
+                logger.error("Failed to open batch file %s: %s", path, e)
+                print_result({'error': f'Failed to open batch file: {e.strerror}'})
+                return
+            with source:
+                result = run_batch(source, sys.stdout, config['STORAGE'], execute_command, batch_size)
+        print_result(result)
+        return
+
+    result = execute_command(args.command, args.args, config['STORAGE'])
+    print_result(result)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import fcntl
+import atexit
+import logging
+import threading
+import functools
+import contextlib
+import config as config_module
+from config import get_config, on_config_reload
+
+logger = logging.getLogger(__name__)
+
+# Верхние границы корзин гистограмм в секундах
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Семейство -> (имя метрики Prometheus, имя метки)
+FAMILIES = {
+    'command': ('note_server_command_seconds', 'command'),
+    'operation': ('note_server_operation_seconds', 'operation'),
+    'lock_wait': ('note_server_lock_wait_seconds', 'mode'),
+    'db': ('note_server_db_seconds', 'database'),
+    'bcrypt': ('note_server_bcrypt_seconds', 'operation'),
+    'config': ('note_server_config_parse_seconds', 'source'),
+}
+COUNTERS = {
+    'command_errors': ('note_server_command_errors_total', 'command'),
+    'cache_hits': ('note_server_cache_hits_total', 'function'),
+    'cache_misses': ('note_server_cache_misses_total', 'function'),
+}
+
+NOOP = contextlib.nullcontext()
+
+def _enabled():
+    try:
+        return get_config()['METRICS']
+    except Exception:
+        return False
+
+# Решается один раз при запуске процесса: выключенные метрики не оборачивают функции вовсе
+ENABLED = _enabled()
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_flusher = None
+
+def empty_histogram():
+    return {"count": 0, "sum": 0.0, "buckets": [0] * (len(BUCKETS) + 1)}
+
+def observe(family, label, seconds):
+    index = next((i for i, bound in enumerate(BUCKETS) if seconds <= bound), len(BUCKETS))
+    with _lock:
+        histogram = _histograms.setdefault(family, {}).get(label)
+        if histogram is None:
+            histogram = _histograms[family][label] = empty_histogram()
+        histogram['count'] += 1
+        histogram['sum'] += seconds
+        histogram['buckets'][index] += 1
+
+def increment(name, label, value=1):
+    with _lock:
+        counters = _counters.setdefault(name, {})
+        counters[label] = counters.get(label, 0) + value
+
+class Timer:
+    def __init__(self, family, label):
+        self.family = family
+        self.label = label
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.family, self.label, time.perf_counter() - self.started)
+        return False
+
+def timer(family, label):
+    return Timer(family, label) if ENABLED else NOOP
+
+def timed(func=None, family='operation', label=None):
+    def decorate(func):
+        if not ENABLED:
+            return func
+        name = label or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(family, name, time.perf_counter() - started)
+        return wrapper
+    return decorate(func) if func is not None else decorate
+
+def merge(state, histograms, counters):
+    for family, labels in histograms.items():
+        target = state['histograms'].setdefault(family, {})
+        for label, histogram in labels.items():
+            merged = target.setdefault(label, empty_histogram())
+            merged['count'] += histogram['count']
+            merged['sum'] += histogram['sum']
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], histogram['buckets'])]
+    for name, labels in counters.items():
+        target = state['counters'].setdefault(name, {})
+        for label, value in labels.items():
+            target[label] = target.get(label, 0) + value
+    return state
+
+def take_local():
+    global _histograms, _counters
+    with _lock:
+        histograms, counters = _histograms, _counters
+        _histograms, _counters = {}, {}
+    return histograms, counters
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"histograms": {}, "counters": {}}
+    except ValueError as e:
+        logger.error("Invalid metrics state %s, starting over: %s", path, e)
+        return {"histograms": {}, "counters": {}}
+
+def write_atomic(path, content):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus(state):
+    lines = []
+    for family, labels in sorted(state['histograms'].items()):
+        if family not in FAMILIES:
+            continue
+        metric, label_name = FAMILIES[family]
+        lines.append(f"# TYPE {metric} histogram")
+        for label, histogram in sorted(labels.items()):
+            selector = f'{label_name}="{escape_label(label)}"'
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram['buckets']):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{selector},le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{selector}}} {histogram['sum']:.6f}")
+            lines.append(f"{metric}_count{{{selector}}} {histogram['count']}")
+    for name, labels in sorted(state['counters'].items()):
+        if name not in COUNTERS:
+            continue
+        metric, label_name = COUNTERS[name]
+        lines.append(f"# TYPE {metric} counter")
+        for label, value in sorted(labels.items()):
+            lines.append(f'{metric}{{{label_name}="{escape_label(label)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+def flush(config=None):
+    # Каждый процесс (CLI или фоновый) сливает свои приращения в общий файл состояния,
+    # поэтому счётчики суммируются по всем процессам без двойного учёта
+    if not ENABLED:
+        return
+    config = config or get_config()
+    histograms, counters = take_local()
+    if not histograms and not counters:
+        return
+    path = config['METRICS_FILE']
+    try:
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            state = merge(load_state(path + '.json'), histograms, counters)
+            write_atomic(path + '.json', json.dumps(state))
+            write_atomic(path, render_prometheus(state))
+    except Exception as e:
+        logger.error("Failed to write metrics to %s: %s", path, e)
+
+def estimate_quantile(histogram, q):
+    # Верхняя граница корзины, в которую попадает квантиль
+    rank = q * histogram['count']
+    cumulative = 0
+    for bound, count in zip(BUCKETS + (None,), histogram['buckets']):
+        cumulative += count
+        if cumulative >= rank:
+            return round(bound * 1000, 3) if bound is not None else None
+    return None
+
+def summary(state):
+    result = {}
+    for family, labels in state['histograms'].items():
+        for label, histogram in labels.items():
+            if not histogram['count']:
+                continue
+            result.setdefault(family, {})[label] = {
+                "count": histogram['count'],
+                "total_seconds": round(histogram['sum'], 6),
+                "mean_ms": round(histogram['sum'] / histogram['count'] * 1000, 3),
+                "p50_ms": estimate_quantile(histogram, 0.5),
+                "p95_ms": estimate_quantile(histogram, 0.95),
+                "p99_ms": estimate_quantile(histogram, 0.99)
+            }
+    for name, labels in state['counters'].items():
+        result[name] = dict(labels)
+    return result
+
+def get_stats():
+    try:
+        config = get_config()
+        if not ENABLED:
+            return {"enabled": False, "metrics": {}}
+        flush(config)
+        state = load_state(config['METRICS_FILE'] + '.json')
+        return {"enabled": True, "metrics_file": config['METRICS_FILE'], "metrics": summary(state)}
+    except Exception as e:
+        logger.error("Failed to get stats: %s", e)
+        return {"error": f"Failed to get stats: {str(e)}"}
+
+class Flusher(threading.Thread):
+    def __init__(self):
+        super().__init__(name='metrics-flusher', daemon=True)
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(get_config()['METRICS_FLUSH_INTERVAL']):
+            flush()
+
+    def stop(self):
+        self.stopping.set()
+        self.join()
+        flush()
+
+def start_flusher():
+    global _flusher
+    if ENABLED and _flusher is None:
+        _flusher = Flusher()
+        _flusher.start()
+
+def stop_flusher():
+    global _flusher
+    flusher, _flusher = _flusher, None
+    if flusher is not None:
+        flusher.stop()
+
+@on_config_reload
+def _observe_reload(config):
+    if ENABLED:
+        observe('config', 'reload', config_module.last_parse_seconds)
+
+if ENABLED:
+    observe('config', 'startup', config_module.last_parse_seconds)
+    atexit.register(flush)
@@ -0,0 +1,311 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from config import get_config
+from metrics import timed
+from db import get_connection
+from migrations import migrate_schema
+from search import drop_txt_indexes, shard_dir
+from utils import lock_file, parse_txt_line, format_txt_line, parse_files_line, format_files_line, TXT_LAYOUTS
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_MASK = (1 << 64) - 1
+STATE_FIELDS = ('inode', 'position', 'source_rows', 'rows', 'duplicates', 'invalid', 'checksum', 'done')
+
+# Набор данных -> (файл в set.conf, база в set.conf, таблица, столбцы)
+DATASETS = (
+    ('users', 'USERS_TXT', 'USERS_DB', 'users', ('id', 'username', 'password_hash', 'email', 'language', 'theme')),
+    ('reset_tokens', 'RESET_TOKENS_TXT', 'USERS_DB', 'reset_tokens', ('user_id', 'token', 'expiry')),
+    ('tasks', 'TASKS_TXT', 'TASKS_DB', 'tasks', ('id', 'user_id', 'title', 'description', 'status', 'created_at', 'deleted')),
+    ('notes', 'NOTES_TXT', 'TASKS_DB', 'notes', ('id', 'user_id', 'task_id', 'content', 'created_at', 'deleted')),
+    ('subtasks', 'SUBTASKS_TXT', 'TASKS_DB', 'subtasks', ('id', 'task_id', 'title', 'completed')),
+    ('files', 'FILES_TXT', 'TASKS_DB', 'files', ('id', 'user_id', 'task_id', 'filename', 'mime_type', 'path', 'size', 'sha256')),
+    ('shared_notes', 'SHARED_NOTES_TXT', 'TASKS_DB', 'shared_notes', ('user_id', 'target_user_id', 'note_id')),
+)
+
+def row_hash(row):
+    # Значения сравниваются в текстовом виде: 0 из SQLite и '0' из txt дают одинаковый хеш
+    canonical = '\x1f'.join('' if value is None else str(value) for value in row)
+    return int.from_bytes(hashlib.blake2b(canonical.encode('utf-8'), digest_size=8).digest(), 'big')
+
+def add_checksum(checksum, row):
+    # Сумма по модулю 2^64 не зависит от порядка строк, поэтому txt и таблицу можно сверять потоково
+    return (checksum + row_hash(row)) & CHECKSUM_MASK
+
+def parse_row(txt_key, columns, line):
+    if txt_key == 'FILES_TXT':
+        record = parse_files_line(line)
+    else:
+        record = parse_txt_line(line, TXT_LAYOUTS[txt_key])
+    if not record:
+        return None
+    return tuple(record[column] for column in columns)
+
+def format_row(txt_key, columns, row):
+    record = dict(zip(columns, row))
+    if txt_key == 'FILES_TXT':
+        return format_files_line(record)
+    for column, value in record.items():
+        if value is None:
+            record[column] = ''
+        elif isinstance(value, str) and ('\n' in value or '\r' in value):
+            raise ValueError(f"Row {row[0]} has a line break in {column} and cannot be written to a txt file")
+    return format_txt_line(record, TXT_LAYOUTS[txt_key])
+
+def new_state(inode=None):
+    return {"inode": inode, "position": 0, "source_rows": 0, "rows": 0, "duplicates": 0, "invalid": 0,
+            "checksum": 0, "done": False}
+
+def state_report(state, verified):
+    return {
+        "source_rows": state['source_rows'],
+        "rows": state['rows'],
+        "duplicates": state['duplicates'],
+        "invalid": state['invalid'],
+        "checksum": f"{state['checksum']:016x}",
+        "verified": verified
+    }
+
+def checksum_table(conn, table, columns):
+    count = 0
+    checksum = 0
+    # Курсор SQLite отдаёт строки по мере чтения, таблица не загружается в память
+    for row in conn.execute(f"SELECT {', '.join(columns)} FROM {table}"):
+        count += 1
+        checksum = add_checksum(checksum, row)
+    return count, checksum
+
+def checksum_txt(path, txt_key, columns):
+    count = 0
+    checksum = 0
+    if os.path.exists(path):
+        with lock_file(path, 'r') as f:
+            for line in f:
+                row = parse_row(txt_key, columns, line)
+                if row is None:
+                    continue
+                count += 1
+                checksum = add_checksum(checksum, row)
+    return count, checksum
+
+def load_import_state(conn, name):
+    row = conn.execute(f"SELECT {', '.join(STATE_FIELDS)} FROM migrate_state WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        return None
+    state = dict(zip(STATE_FIELDS, row))
+    state['checksum'] = int(state['checksum'], 16)
+    state['done'] = bool(state['done'])
+    return state
+
+def save_import_state(conn, name, state):
+    values = dict(state, checksum=f"{state['checksum']:016x}", done=int(state['done']))
+    conn.execute(f"INSERT OR REPLACE INTO migrate_state (name, {', '.join(STATE_FIELDS)}) "
+                 f"VALUES (?, {', '.join('?' * len(STATE_FIELDS))})",
+                 [name] + [values[field] for field in STATE_FIELDS])
+
+def import_dataset(config, name, txt_key, db_key, table, columns, batch_size):
+    path = config[txt_key]
+    insert = f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    with get_connection(config[db_key]) as conn:
+        state = load_import_state(conn, name)
+        if state is None or not state['done']:
+            if state is None and conn.execute(f"SELECT EXISTS (SELECT 1 FROM {table})").fetchone()[0]:
+                raise ValueError(f"Table {table} in {config[db_key]} already contains data, use restart to replace it")
+            if not os.path.exists(path):
+                state = state or new_state()
+            else:
+                # Разделяемая блокировка не даёт приложению переписать файл во время переноса
+                with lock_file(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    if state is None:
+                        state = new_state(st.st_ino)
+                    elif state['inode'] != st.st_ino or st.st_size < state['position']:
+                        raise ValueError(f"{path} was rewritten after the last checkpoint, use restart to start over")
+                    if state['position']:
+                        logger.info("Resuming %s import at byte %s", name, state['position'])
+                    f.seek(state['position'])
+                    cursor = conn.cursor()
+                    pending = 0
+                    for line in f:
+                        state['position'] += len(line)
+                        state['source_rows'] += 1
+                        row = parse_row(txt_key, columns, line.decode('utf-8'))
+                        if row is None:
+                            state['invalid'] += 1
+                        else:
+                            cursor.execute(insert, row)
+                            if cursor.rowcount == 1:
+                                state['rows'] += 1
+                                state['checksum'] = add_checksum(state['checksum'], row)
+                            else:
+                                state['duplicates'] += 1
+                        pending += 1
+                        if pending >= batch_size:
+                            # Строки и контрольная точка фиксируются одной транзакцией
+                            save_import_state(conn, name, state)
+                            conn.commit()
+                            pending = 0
+            if table == 'files':
+                conn.execute("""
+                    INSERT INTO blobs (sha256, size, refcount)
+                    SELECT sha256, MAX(size), COUNT(*) FROM files WHERE sha256 IS NOT NULL GROUP BY sha256
+                    ON CONFLICT(sha256) DO UPDATE SET size = excluded.size, refcount = excluded.refcount
+                """)
+            state['done'] = True
+            save_import_state(conn, name, state)
+            conn.commit()
+            logger.info("Imported %s rows from %s into %s", state['rows'], path, table)
+        count, checksum = checksum_table(conn, table, columns)
+    return state, count == state['rows'] and checksum == state['checksum']
+
+def load_export_state(state_path):
+    try:
+        with open(state_path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def save_export_state(state_path, state):
+    tmp_path = f"{state_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, state_path)
+
+def export_dataset(config, name, txt_key, db_key, table, columns, batch_size, restart):
+    path = config[txt_key]
+    tmp_path = path + '.migrate.tmp'
+    state_path = path + '.migrate.json'
+    state = load_export_state(state_path)
+    if state is None:
+        if not restart and os.path.exists(path) and os.path.getsize(path) > 0:
+            raise ValueError(f"{path} already contains data, use restart to replace it")
+        state = dict(new_state(), last_rowid=0)
+    if not state['done']:
+        query = f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?"
+        with open(tmp_path, 'r+b' if state['position'] else 'wb') as out:
+            # Всё, что записано после последней контрольной точки, отбрасывается
+            out.truncate(state['position'])
+            out.seek(state['position'])
+            with get_connection(config[db_key]) as conn:
+                while True:
+                    rows = conn.execute(query, (state['last_rowid'], batch_size)).fetchall()
+                    if not rows:
+                        break
+                    for rowid, *values in rows:
+                        row = tuple(values)
+                        out.write(format_row(txt_key, columns, row).encode('utf-8'))
+                        state['source_rows'] += 1
+                        state['rows'] += 1
+                        state['checksum'] = add_checksum(state['checksum'], row)
+                        state['last_rowid'] = rowid
+                    out.flush()
+                    os.fsync(out.fileno())
+                    state['position'] = out.tell()
+                    save_export_state(state_path, state)
+        count, checksum = checksum_txt(tmp_path, txt_key, columns)
+        if count != state['rows'] or checksum != state['checksum']:
+            return state, False
+        state['done'] = True
+        save_export_state(state_path, state)
+        logger.info("Exported %s rows from %s into %s", state['rows'], table, path)
+    if os.path.exists(tmp_path):
+        with lock_file(path, 'a'):
+            os.replace(tmp_path, path)
+    count, checksum = checksum_txt(path, txt_key, columns)
+    return state, count == state['rows'] and checksum == state['checksum']
+
+def reset_import(config):
+    for db_key in ('USERS_DB', 'TASKS_DB'):
+        with get_connection(config[db_key]) as conn:
+            for _, _, dataset_db, table, _ in DATASETS:
+                if dataset_db == db_key:
+                    conn.execute(f"DELETE FROM {table}")
+            if db_key == 'TASKS_DB':
+                conn.execute("DELETE FROM blobs")
+            conn.execute("DELETE FROM migrate_state")
+            conn.commit()
+
+def reset_export(config):
+    for _, txt_key, _, _, _ in DATASETS:
+        for suffix in ('.migrate.tmp', '.migrate.json'):
+            if os.path.exists(config[txt_key] + suffix):
+                os.remove(config[txt_key] + suffix)
+
+def export_log_stores(config):
+    from logstore import open_store, STORE_KEYS
+    exported = {}
+    for name in STORE_KEYS:
+        store = open_store(config, name)
+        # Журнал, уже выгруженный при прерванной миграции, повторно не создаётся
+        if os.path.exists(store.path):
+            exported[name] = store.export_txt()
+    # Поисковые шарды журнала собираются заново после следующего импорта
+    import shutil
+    shutil.rmtree(shard_dir(config, 'log'), ignore_errors=True)
+    drop_txt_indexes(config)
+    return exported
+
+@timed
+def migrate_storage(direction, storage, restart=False):
+    try:
+        config = get_config()
+        logger.info("Migrating storage %s, restart: %s", direction, restart)
+        if direction not in ('to_sqlite', 'to_txt'):
+            return {"error": "Direction must be to_sqlite or to_txt"}
+        if storage == 'log':
+            # Журналы выгружаются в txt-файлы, дальше миграция идёт как из txt
+            exported = export_log_stores(config)
+            if direction == 'to_txt':
+                logger.info("Storage migrated to txt")
+                return {"message": "Storage migrated to txt, set STORAGE = txt in set.conf", "exported": exported}
+
+        schema = migrate_schema('sqlite')
+        if 'error' in schema:
+            return schema
+
+        batch_size = config['MIGRATE_BATCH_SIZE']
+        if direction == 'to_sqlite':
+            if restart:
+                reset_import(config)
+            run = lambda name, txt_key, db_key, table, columns: import_dataset(
+                config, name, txt_key, db_key, table, columns, batch_size)
+        else:
+            if restart:
+                reset_export(config)
+            run = lambda name, txt_key, db_key, table, columns: export_dataset(
+                config, name, txt_key, db_key, table, columns, batch_size, restart)
+
+        datasets = {}
+        failed = []
+        for name, txt_key, db_key, table, columns in DATASETS:
+            state, verified = run(name, txt_key, db_key, table, columns)
+            datasets[name] = state_report(state, verified)
+            if not verified:
+                failed.append(name)
+                logger.error("Verification of %s failed after migrating %s", name, direction)
+        if direction == 'to_txt':
+            # Поисковые шарды описывают прежнее содержимое tasks.txt и notes.txt
+            drop_txt_indexes(config)
+
+        if failed:
+            # Контрольные точки остаются, чтобы можно было разобраться или начать заново через restart
+            return {"error": f"Verification failed for {', '.join(failed)}", "datasets": datasets}
+
+        if direction == 'to_sqlite':
+            for db_key in ('USERS_DB', 'TASKS_DB'):
+                with get_connection(config[db_key]) as conn:
+                    conn.execute("DELETE FROM migrate_state")
+                    conn.commit()
+        else:
+            reset_export(config)
+        target = 'sqlite' if direction == 'to_sqlite' else 'txt'
+        logger.info("Storage migrated to %s", target)
+        return {"message": f"Storage migrated to {target}, set STORAGE = {target} in set.conf", "datasets": datasets}
+    except Exception as e:
+        logger.error("Failed to migrate storage: %s", e)
+        return {"error": f"Failed to migrate storage: {str(e)}"}
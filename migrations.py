@@ -0,0 +1,325 @@
+import logging
+from config import get_config
+from db import get_connection
+
+logger = logging.getLogger(__name__)
+
+USERS_MIGRATIONS = [
+    (1, [
+        """CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            username TEXT UNIQUE,
+            password_hash TEXT,
+            email TEXT UNIQUE,
+            language TEXT DEFAULT 'ru',
+            theme TEXT DEFAULT 'light'
+        )""",
+        """CREATE TABLE IF NOT EXISTS reset_tokens (
+            user_id TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expiry TEXT NOT NULL
+        )""",
+    ]),
+    # username и email уже покрыты UNIQUE-индексами
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_reset_tokens_token ON reset_tokens (token)",
+    ]),
+    # Очередь исходящих писем для фонового отправителя
+    (3, [
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id TEXT PRIMARY KEY,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TEXT NOT NULL,
+            last_error TEXT,
+            failed INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox (next_attempt_at) WHERE failed = 0",
+    ]),
+    # Контрольные точки переноса из txt (python3 main.py migrate)
+    (4, [
+        """CREATE TABLE IF NOT EXISTS migrate_state (
+            name TEXT PRIMARY KEY,
+            inode INTEGER,
+            position INTEGER NOT NULL DEFAULT 0,
+            source_rows INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            invalid INTEGER NOT NULL DEFAULT 0,
+            checksum TEXT NOT NULL DEFAULT '0',
+            done INTEGER NOT NULL DEFAULT 0
+        )""",
+    ]),
+]
+
+TASKS_MIGRATIONS = [
+    (1, [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            title TEXT,
+            description TEXT,
+            status TEXT,
+            created_at TEXT,
+            deleted INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS notes (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            task_id TEXT,
+            content TEXT,
+            created_at TEXT,
+            deleted INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS subtasks (
+            id TEXT PRIMARY KEY,
+            task_id TEXT,
+            title TEXT,
+            completed INTEGER DEFAULT 0
+        )""",
+        """CREATE TABLE IF NOT EXISTS files (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            task_id TEXT,
+            filename TEXT,
+            mime_type TEXT,
+            path TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS shared_notes (
+            user_id TEXT,
+            target_user_id TEXT,
+            note_id TEXT,
+            PRIMARY KEY (user_id, target_user_id, note_id)
+        )""",
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON tasks (user_id, created_at) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_title ON tasks (user_id, title) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_task_created ON notes (user_id, task_id, created_at) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_subtasks_task ON subtasks (task_id)",
+        "CREATE INDEX IF NOT EXISTS idx_shared_notes_target ON shared_notes (target_user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_shared_notes_note ON shared_notes (note_id)",
+        "CREATE INDEX IF NOT EXISTS idx_files_task ON files (task_id)",
+    ]),
+    (3, [
+        "ALTER TABLE files ADD COLUMN size INTEGER",
+        "ALTER TABLE files ADD COLUMN sha256 TEXT",
+    ]),
+    (4, [
+        """CREATE TABLE IF NOT EXISTS blobs (
+            sha256 TEXT PRIMARY KEY,
+            size INTEGER,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files (sha256)",
+    ]),
+    (5, [
+        "CREATE INDEX IF NOT EXISTS idx_subtasks_task_completed ON subtasks (task_id, completed)",
+    ]),
+    # Индексы для keyset-пагинации: id в конце делает порядок однозначным
+    (6, [
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_created_id ON tasks (user_id, created_at, id) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_title_id ON tasks (user_id, title, id) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_task_created_id ON notes (user_id, task_id, created_at, id) WHERE deleted = 0",
+        "CREATE INDEX IF NOT EXISTS idx_notes_user_task_content_id ON notes (user_id, task_id, content, id) WHERE deleted = 0",
+        "DROP INDEX IF EXISTS idx_tasks_user_created",
+        "DROP INDEX IF EXISTS idx_tasks_user_title",
+        "DROP INDEX IF EXISTS idx_notes_user_task_created",
+    ]),
+    # Полнотекстовый индекс; user_id и ref_id индексируются, чтобы фильтровать и удалять через MATCH
+    (7, [
+        """CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+            user_id, ref_id, kind UNINDEXED, task_id UNINDEXED, created_at UNINDEXED, title, body,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+        )""",
+        """CREATE TRIGGER IF NOT EXISTS notes_search_insert AFTER INSERT ON notes WHEN new.deleted = 0 BEGIN
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            VALUES (new.user_id, new.id, 'note', new.task_id, new.created_at, '', new.content);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS notes_search_update AFTER UPDATE OF content, deleted ON notes BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'ref_id : "' || old.id || '"' AND kind = 'note';
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT new.user_id, new.id, 'note', new.task_id, new.created_at, '', new.content WHERE new.deleted = 0;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS notes_search_delete AFTER DELETE ON notes BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'ref_id : "' || old.id || '"' AND kind = 'note';
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS tasks_search_insert AFTER INSERT ON tasks WHEN new.deleted = 0 BEGIN
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            VALUES (new.user_id, new.id, 'task', new.id, new.created_at, new.title, new.description);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS tasks_search_update AFTER UPDATE OF title, description, deleted ON tasks BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'ref_id : "' || old.id || '"' AND kind = 'task';
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT new.user_id, new.id, 'task', new.id, new.created_at, new.title, new.description WHERE new.deleted = 0;
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS tasks_search_delete AFTER DELETE ON tasks BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'ref_id : "' || old.id || '"' AND kind = 'task';
+        END""",
+        """INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT user_id, id, 'note', task_id, created_at, '', content FROM notes WHERE deleted = 0""",
+        """INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT user_id, id, 'task', id, created_at, title, description FROM tasks WHERE deleted = 0""",
+    ]),
+    # Списки вложений по задаче и по пользователю в порядке (filename, id)
+    (8, [
+        "CREATE INDEX IF NOT EXISTS idx_files_task_filename_id ON files (task_id, filename, id)",
+        "CREATE INDEX IF NOT EXISTS idx_files_user_filename_id ON files (user_id, filename, id)",
+        "DROP INDEX IF EXISTS idx_files_task",
+    ]),
+    # Контрольные точки переноса из txt (python3 main.py migrate)
+    (9, [
+        """CREATE TABLE IF NOT EXISTS migrate_state (
+            name TEXT PRIMARY KEY,
+            inode INTEGER,
+            position INTEGER NOT NULL DEFAULT 0,
+            source_rows INTEGER NOT NULL DEFAULT 0,
+            rows INTEGER NOT NULL DEFAULT 0,
+            duplicates INTEGER NOT NULL DEFAULT 0,
+            invalid INTEGER NOT NULL DEFAULT 0,
+            checksum TEXT NOT NULL DEFAULT '0',
+            done INTEGER NOT NULL DEFAULT 0
+        )""",
+    ]),
+    # Время удаления для срока хранения и индексы для каскадной очистки (python3 main.py purge)
+    (10, [
+        "ALTER TABLE tasks ADD COLUMN deleted_at TEXT",
+        "ALTER TABLE notes ADD COLUMN deleted_at TEXT",
+        "UPDATE tasks SET deleted_at = strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime') WHERE deleted = 1",
+        "UPDATE notes SET deleted_at = strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime') WHERE deleted = 1",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_deleted_at ON tasks (deleted_at) WHERE deleted = 1",
+        "CREATE INDEX IF NOT EXISTS idx_notes_deleted_at ON notes (deleted_at) WHERE deleted = 1",
+        "CREATE INDEX IF NOT EXISTS idx_notes_task ON notes (task_id)",
+    ]),
+    # Заметки удалённой задачи не ищутся: убираются из индекса при удалении задачи и возвращаются при восстановлении
+    (11, [
+        "DROP TRIGGER IF EXISTS notes_search_insert",
+        "DROP TRIGGER IF EXISTS notes_search_update",
+        """CREATE TRIGGER notes_search_insert AFTER INSERT ON notes
+            WHEN new.deleted = 0 AND NOT EXISTS (SELECT 1 FROM tasks WHERE id = new.task_id AND deleted = 1) BEGIN
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            VALUES (new.user_id, new.id, 'note', new.task_id, new.created_at, '', new.content);
+        END""",
+        """CREATE TRIGGER notes_search_update AFTER UPDATE OF content, deleted ON notes BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'ref_id : "' || old.id || '"' AND kind = 'note';
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT new.user_id, new.id, 'note', new.task_id, new.created_at, '', new.content
+            WHERE new.deleted = 0 AND NOT EXISTS (SELECT 1 FROM tasks WHERE id = new.task_id AND deleted = 1);
+        END""",
+        """CREATE TRIGGER IF NOT EXISTS tasks_search_notes AFTER UPDATE OF deleted ON tasks
+            WHEN new.deleted IS NOT old.deleted BEGIN
+            DELETE FROM search_index WHERE search_index MATCH 'user_id : "' || old.user_id || '"'
+                AND kind = 'note' AND task_id = old.id;
+            INSERT INTO search_index (user_id, ref_id, kind, task_id, created_at, title, body)
+            SELECT user_id, id, 'note', task_id, created_at, '', content FROM notes
+            WHERE task_id = new.id AND deleted = 0 AND new.deleted = 0;
+        END""",
+        """DELETE FROM search_index WHERE kind = 'note'
+            AND task_id IN (SELECT id FROM tasks WHERE deleted = 1)""",
+    ]),
+]
+
+HOT_QUERIES = [
+    ('TASKS_DB', "SELECT id, title, description, status, created_at FROM tasks WHERE user_id = ? AND deleted = 0 AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", ('', '', '', 1)),
+    ('TASKS_DB', "SELECT id, title, description, status, created_at FROM tasks WHERE user_id = ? AND deleted = 0 AND (title, id) > (?, ?) ORDER BY title, id LIMIT ?", ('', '', '', 1)),
+    ('TASKS_DB', "SELECT id, content, created_at FROM notes WHERE user_id = ? AND task_id = ? AND deleted = 0 AND (created_at, id) < (?, ?) ORDER BY created_at DESC, id DESC LIMIT ?", ('', '', '', '', 1)),
+    ('TASKS_DB', "SELECT id, content, created_at FROM notes WHERE user_id = ? AND task_id = ? AND deleted = 0 AND (content, id) > (?, ?) ORDER BY content, id LIMIT ?", ('', '', '', '', 1)),
+    ('TASKS_DB', "SELECT s.id, s.title, s.completed FROM subtasks s JOIN tasks t ON t.id = s.task_id WHERE s.task_id = ? AND t.user_id = ? AND t.deleted = 0 AND s.completed = ? ORDER BY s.rowid LIMIT ? OFFSET ?", ('', '', 0, -1, 0)),
+    ('TASKS_DB', "SELECT task_id, COUNT(*), id, content, MAX(created_at) FROM notes WHERE user_id = ? AND deleted = 0 GROUP BY task_id", ('',)),
+    ('TASKS_DB', "SELECT s.task_id, s.id, s.title, s.completed FROM subtasks s JOIN tasks t ON t.id = s.task_id WHERE t.user_id = ? AND t.deleted = 0 ORDER BY s.rowid", ('',)),
+    ('TASKS_DB', "SELECT f.task_id, f.id, f.filename, f.mime_type, f.size FROM files f JOIN tasks t ON t.id = f.task_id WHERE t.user_id = ? AND t.deleted = 0", ('',)),
+    ('TASKS_DB', "SELECT f.id, f.task_id, f.filename, f.mime_type, f.size, f.sha256 FROM files f JOIN tasks t ON t.id = f.task_id WHERE f.user_id = ? AND t.deleted = 0 AND f.task_id = ? AND (f.filename, f.id) > (?, ?) ORDER BY f.filename, f.id LIMIT ?", ('', '', '', '', 1)),
+    ('TASKS_DB', "SELECT f.id, f.task_id, f.filename, f.mime_type, f.size, f.sha256 FROM files f JOIN tasks t ON t.id = f.task_id WHERE f.user_id = ? AND t.deleted = 0 AND (f.filename, f.id) > (?, ?) ORDER BY f.filename, f.id LIMIT ?", ('', '', '', 1)),
+    ('TASKS_DB', "SELECT f.filename, f.mime_type, f.path, f.sha256 FROM files f JOIN tasks t ON t.id = f.task_id WHERE f.id = ? AND f.user_id = ? AND t.deleted = 0", ('', '')),
+    ('TASKS_DB', "SELECT note_id FROM shared_notes WHERE target_user_id = ?", ('',)),
+    ('TASKS_DB', "SELECT id FROM tasks WHERE deleted = 1 AND deleted_at <= ? LIMIT ?", ('', 1)),
+    ('TASKS_DB', "SELECT id FROM notes WHERE deleted = 1 AND deleted_at <= ? LIMIT ?", ('', 1)),
+    ('TASKS_DB', "DELETE FROM notes WHERE task_id IN (?)", ('',)),
+    ('USERS_DB', "SELECT id, username FROM users WHERE email = ?", ('',)),
+    ('USERS_DB', "SELECT user_id FROM reset_tokens WHERE token = ? AND expiry > ?", ('', '')),
+    ('USERS_DB', "SELECT id, recipient, subject, body, attempts FROM outbox WHERE failed = 0 AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?", ('', 1)),
+]
+
+def apply_migrations(db_path, migrations):
+    with get_connection(db_path) as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for target, statements in migrations:
+            if target <= version:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            # Другой процесс мог применить миграцию, пока мы ждали блокировку
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if target <= version:
+                conn.rollback()
+                continue
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target}")
+            conn.commit()
+            version = target
+            logger.info("Applied migration %s to %s", target, db_path)
+        conn.execute("PRAGMA optimize")
+        return version
+
+def schema_copy(conn):
+    # Пустая копия схемы без sqlite_stat1: на маленькой базе перебор таблицы дешевле индекса,
+    # и по статистике планировщик выбрал бы его, поэтому проверяется наличие индексов, а не размер данных.
+    # Полнотекстовые таблицы и их служебные таблицы горячими запросами не используются
+    import sqlite3
+    copy = sqlite3.connect(':memory:')
+    rows = conn.execute("SELECT name, sql FROM sqlite_master WHERE type IN ('table', 'index') "
+                        "AND sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type DESC").fetchall()
+    virtual = [name for name, sql in rows if sql.upper().startswith('CREATE VIRTUAL')]
+    for name, sql in rows:
+        if not any(name == table or name.startswith(table + '_') for table in virtual):
+            copy.execute(sql)
+    return copy
+
+def find_full_scans(config):
+    scans = []
+    copies = {}
+    try:
+        for db_key, query, params in HOT_QUERIES:
+            if db_key not in copies:
+                with get_connection(config[db_key]) as conn:
+                    copies[db_key] = schema_copy(conn)
+            for row in copies[db_key].execute("EXPLAIN QUERY PLAN " + query, params):
+                detail = row[-1]
+                if detail.startswith('SCAN'):
+                    scans.append({"query": query, "plan": detail})
+    finally:
+        for copy in copies.values():
+            copy.close()
+    return scans
+
+def migrate_schema(storage):
+    try:
+        config = get_config()
+        if storage != 'sqlite':
+            logger.info("Schema migration skipped for storage %s", storage)
+            return {"message": "Schema migration is only needed for sqlite storage"}
+        users_version = apply_migrations(config['USERS_DB'], USERS_MIGRATIONS)
+        tasks_version = apply_migrations(config['TASKS_DB'], TASKS_MIGRATIONS)
+        full_scans = find_full_scans(config)
+        for scan in full_scans:
+            logger.error("Hot query still scans a table: %s (%s)", scan['plan'], scan['query'])
+        if full_scans:
+            return {
+                "error": f"{len(full_scans)} hot queries scan a table, an index is missing",
+                "users_db_version": users_version,
+                "tasks_db_version": tasks_version,
+                "full_scans": full_scans
+            }
+        logger.info("Schema migrated: users.db v%s, tasks.db v%s", users_version, tasks_version)
+        return {
+            "message": "Schema migrated",
+            "users_db_version": users_version,
+            "tasks_db_version": tasks_version,
+            "full_scans": full_scans
+        }
+    except Exception as e:
+        logger.error("Failed to migrate schema: %s", e)
+        return {"error": f"Failed to migrate schema: {str(e)}"}
@@ -1,295 +1,450 @@
-import sqlite3
-import secrets
 import os
 import logging
 import datetime
 from config import get_config
-from utils import lock_file, validate_id
-from users import user_exists, get_username
+from metrics import timed
+from cache import cached, invalidates
+from db import get_connection, attach_database
+from utils import lock_file, rewrite_file, validate_id, validate_username, parse_txt_line, TXT_LAYOUTS, format_txt_line, record_deletion, encode_cursor, decode_cursor, select_page
+from users import user_exists, find_txt_user, txt_users
+from logstore import open_store, get_owned_task
 
+logger = logging.getLogger(__name__)
+
+@timed
+@invalidates
 def create_note(user_id, task_id, content, storage):
+    import secrets
     try:
         config = get_config()
-        logging.info(f"Creating note for user_id {user_id}, task_id {task_id}")
+        logger.info("Creating note for user_id %s, task_id %s", user_id, task_id)
         
         if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
         
         if not content.strip():
-            logging.error(f"Empty note content")
+            logger.error("Empty note content")
             return {"error": "Note content cannot be empty"}
         
         note_id = secrets.token_hex(8)
         created_at = datetime.datetime.now().isoformat()
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
                 if not cursor.fetchone():
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                    logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                     return {"error": "Task not found or not owned by user"}
                 cursor.execute("INSERT INTO notes (id, user_id, task_id, content, created_at) VALUES (?, ?, ?, ?, ?)",
                               (note_id, user_id, task_id, content, created_at))
                 conn.commit()
-                logging.info(f"Note {note_id} created in SQLite")
+                logger.info("Note %s created in SQLite", note_id)
                 return {"message": "Note created", "note_id": note_id}
+        elif storage == 'log':
+            if not get_owned_task(config, task_id, user_id):
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
+            from search import index_update
+            with index_update(config, storage, user_id) as index:
+                open_store(config, 'NOTES_TXT').put({
+                    "id": note_id,
+                    "user_id": user_id,
+                    "task_id": task_id,
+                    "content": content,
+                    "created_at": created_at
+                })
+                if index is not None:
+                    index.add('note', note_id, user_id, task_id, created_at, '', content)
+            logger.info("Note %s created in log storage", note_id)
+            return {"message": "Note created", "note_id": note_id}
         else:
             if not os.path.exists(config['TASKS_TXT']):
-                logging.info(f"Tasks file {config['TASKS_TXT']} does not exist")
+                logger.info("Tasks file %s does not exist", config['TASKS_TXT'])
                 return {"error": "Task not found"}
             with lock_file(config['TASKS_TXT'], 'r') as f:
                 tasks = f.readlines()
             task_exists = any(line.strip().split(':')[0] == task_id and line.strip().split(':')[1] == user_id for line in tasks)
             if not task_exists:
-                logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                 return {"error": "Task not found or not owned by user"}
-            with lock_file(config['NOTES_TXT'], 'a') as f:
-                f.write(f"{note_id}:{user_id}:{task_id}:{content}:{created_at}:0\n")
-            logging.info(f"Note {note_id} created in txt")
+            from search import index_update
+            with index_update(config, storage, user_id) as index:
+                with lock_file(config['NOTES_TXT'], 'a') as f:
+                    f.write(f"{note_id}:{user_id}:{task_id}:{content}:{created_at}:0\n")
+                if index is not None:
+                    index.add('note', note_id, user_id, task_id, created_at, '', content)
+            logger.info("Note %s created in txt", note_id)
             return {"message": "Note created", "note_id": note_id}
     except Exception as e:
-        logging.error(f"Failed to create note: {str(e)}")
+        logger.error("Failed to create note: %s", e)
         return {"error": f"Failed to create note: {str(e)}"}
 
+@timed
+@invalidates(shared=True)
 def edit_note(user_id, note_id, content, storage):
     try:
         config = get_config()
-        logging.info(f"Editing note {note_id} for user_id {user_id}")
+        logger.info("Editing note %s for user_id %s", note_id, user_id)
         
         if not validate_id(user_id) or not validate_id(note_id):
-            logging.error(f"Invalid user_id or note_id: {user_id}, {note_id}")
+            logger.error("Invalid user_id or note_id: %s, %s", user_id, note_id)
             return {"error": "Invalid user_id or note_id"}
         
         if not content.strip():
-            logging.error(f"Empty note content")
+            logger.error("Empty note content")
             return {"error": "Note content cannot be empty"}
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("UPDATE notes SET content = ? WHERE id = ? AND user_id = ? AND deleted = 0",
                               (content, note_id, user_id))
                 conn.commit()
                 if cursor.rowcount == 0:
-                    logging.error(f"Note {note_id} not found or not owned by user {user_id}")
+                    logger.error("Note %s not found or not owned by user %s", note_id, user_id)
                     return {"error": "Note not found or not owned by user"}
-                logging.info(f"Note {note_id} updated")
+                logger.info("Note %s updated", note_id)
                 return {"message": "Note updated"}
+        elif storage == 'log':
+            from search import index_update
+            store = open_store(config, 'NOTES_TXT')
+            with index_update(config, storage, user_id) as index:
+                note = store.get(note_id)
+                if note is None or note['user_id'] != user_id or not store.update(note_id, content=content):
+                    logger.error("Note %s not found or not owned by user %s", note_id, user_id)
+                    return {"error": "Note not found or not owned by user"}
+                if index is not None:
+                    index.remove('note', note_id)
+                    index.add('note', note_id, user_id, note['task_id'], note['created_at'], '', content)
+            logger.info("Note %s updated", note_id)
+            return {"message": "Note updated"}
         else:
             if not os.path.exists(config['NOTES_TXT']):
-                logging.info(f"Notes file {config['NOTES_TXT']} does not exist")
+                logger.info("Notes file %s does not exist", config['NOTES_TXT'])
                 return {"error": "Note not found"}
-            lines = []
-            found = False
-            with lock_file(config['NOTES_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['NOTES_TXT'], 'w') as f:
-                for line in lines:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 6 and parts[0] == note_id and parts[1] == user_id and parts[5] == '0':
-                        f.write(f"{parts[0]}:{parts[1]}:{parts[2]}:{content}:{parts[4]}:0\n")
-                        found = True
-                    else:
-                        f.write(line)
-                if not found:
-                    logging.error(f"Note {note_id} not found or not owned by user {user_id}")
-                    return {"error": "Note not found or not owned by user"}
-            logging.info(f"Note {note_id} updated")
+            from search import index_update
+            edited = None
+            with index_update(config, storage, user_id) as index:
+                with rewrite_file(config['NOTES_TXT']) as (lines, f):
+                    for line in lines:
+                        note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+                        if note and note['id'] == note_id and note['user_id'] == user_id and note['deleted'] == '0':
+                            note['content'] = content
+                            f.write(format_txt_line(note, TXT_LAYOUTS['NOTES_TXT']))
+                            edited = note
+                        else:
+                            f.write(line)
+                    if edited is None:
+                        logger.error("Note %s not found or not owned by user %s", note_id, user_id)
+                        return {"error": "Note not found or not owned by user"}
+                if index is not None:
+                    index.remove('note', note_id)
+                    index.add('note', note_id, user_id, edited['task_id'], edited['created_at'], '', content)
+            logger.info("Note %s updated", note_id)
             return {"message": "Note updated"}
     except Exception as e:
-        logging.error(f"Failed to edit note: {str(e)}")
+        logger.error("Failed to edit note: %s", e)
         return {"error": f"Failed to edit note: {str(e)}"}
 
+def remove_shared_note_txt(config, note_id):
+    if os.path.exists(config['SHARED_NOTES_TXT']):
+        removed = False
+        rewrite = rewrite_file(config['SHARED_NOTES_TXT'])
+        with rewrite as (lines, f):
+            for line in lines:
+                share = parse_txt_line(line, TXT_LAYOUTS['SHARED_NOTES_TXT'])
+                if share and share['note_id'] == note_id:
+                    removed = True
+                else:
+                    f.write(line)
+            if not removed:
+                rewrite.discard()
+
+@timed
+@invalidates(shared=True)
 def delete_note(user_id, note_id, storage):
     try:
         config = get_config()
-        logging.info(f"Deleting note {note_id} for user_id {user_id}")
+        logger.info("Deleting note %s for user_id %s", note_id, user_id)
         
         if not validate_id(user_id) or not validate_id(note_id):
-            logging.error(f"Invalid user_id or note_id: {user_id}, {note_id}")
+            logger.error("Invalid user_id or note_id: %s, %s", user_id, note_id)
             return {"error": "Invalid user_id or note_id"}
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
-                cursor.execute("UPDATE notes SET deleted = 1 WHERE id = ? AND user_id = ?", (note_id, user_id))
-                cursor.execute("DELETE FROM shared_notes WHERE note_id = ?", (note_id,))
+                cursor.execute("UPDATE notes SET deleted = 1, deleted_at = COALESCE(deleted_at, ?) WHERE id = ? AND user_id = ?",
+                               (datetime.datetime.now().isoformat(), note_id, user_id))
+                updated = cursor.rowcount
+                if updated:
+                    cursor.execute("DELETE FROM shared_notes WHERE note_id = ?", (note_id,))
                 conn.commit()
-                if cursor.rowcount == 0:
-                    logging.error(f"Note {note_id} not found or not owned by user {user_id}")
+                if updated == 0:
+                    logger.error("Note %s not found or not owned by user %s", note_id, user_id)
                     return {"error": "Note not found or not owned by user"}
-                logging.info(f"Note {note_id} marked as deleted")
+                logger.info("Note %s marked as deleted", note_id)
                 return {"message": "Note deleted"}
+        elif storage == 'log':
+            from search import index_update
+            store = open_store(config, 'NOTES_TXT')
+            with index_update(config, storage, user_id) as index:
+                note = store.get(note_id)
+                if note is None or note['user_id'] != user_id or not store.delete(note_id):
+                    logger.error("Note %s not found or not owned by user %s", note_id, user_id)
+                    return {"error": "Note not found or not owned by user"}
+                if index is not None:
+                    index.remove('note', note_id)
+            remove_shared_note_txt(config, note_id)
+            record_deletion(config['NOTES_TXT'], note_id)
+            logger.info("Note %s marked as deleted", note_id)
+            return {"message": "Note deleted"}
         else:
             if not os.path.exists(config['NOTES_TXT']):
-                logging.info(f"Notes file {config['NOTES_TXT']} does not exist")
+                logger.info("Notes file %s does not exist", config['NOTES_TXT'])
                 return {"error": "Note not found"}
-            lines = []
+            from search import index_update
             found = False
-            with lock_file(config['NOTES_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['NOTES_TXT'], 'w') as f:
-                for line in lines:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 6 and parts[0] == note_id and parts[1] == user_id:
-                        f.write(f"{parts[0]}:{parts[1]}:{parts[2]}:{parts[3]}:{parts[4]}:1\n")
-                        found = True
-                    else:
-                        f.write(line)
-                if not found:
-                    logging.error(f"Note {note_id} not found or not owned by user {user_id}")
-                    return {"error": "Note not found or not owned by user"}
-            if os.path.exists(config['SHARED_NOTES_TXT']):
-                lines = []
-                with lock_file(config['SHARED_NOTES_TXT'], 'r') as f:
-                    lines = f.readlines()
-                with lock_file(config['SHARED_NOTES_TXT'], 'w') as f:
+            with index_update(config, storage, user_id) as index:
+                with rewrite_file(config['NOTES_TXT']) as (lines, f):
                     for line in lines:
-                        parts = line.strip().split(':')
-                        if parts[2] != note_id:
+                        note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+                        if note and note['id'] == note_id and note['user_id'] == user_id:
+                            note['deleted'] = '1'
+                            f.write(format_txt_line(note, TXT_LAYOUTS['NOTES_TXT']))
+                            found = True
+                        else:
                             f.write(line)
-            logging.info(f"Note {note_id} marked as deleted")
+                    if not found:
+                        logger.error("Note %s not found or not owned by user %s", note_id, user_id)
+                        return {"error": "Note not found or not owned by user"}
+                if index is not None:
+                    index.remove('note', note_id)
+            remove_shared_note_txt(config, note_id)
+            record_deletion(config['NOTES_TXT'], note_id)
+            logger.info("Note %s marked as deleted", note_id)
             return {"message": "Note deleted"}
     except Exception as e:
-        logging.error(f"Failed to delete note: {str(e)}")
+        logger.error("Failed to delete note: %s", e)
         return {"error": f"Failed to delete note: {str(e)}"}
 
-def get_notes(user_id, task_id, storage, sort_by='created_at'):
+def note_sort_key(sort_by):
+    if sort_by == 'content':
+        return lambda x: (x['content'], x['note_id'])
+    return lambda x: (x['created_at'], x['note_id'])
+
+def note_record(note):
+    return {
+        "note_id": note['id'],
+        "content": note['content'],
+        "created_at": note['created_at']
+    }
+
+@timed
+@cached
+def get_notes(user_id, task_id, storage, sort_by='created_at', limit=None, after=None):
     try:
         config = get_config()
-        logging.info(f"Getting notes for user_id {user_id}, task_id {task_id}, sort_by: {sort_by}")
+        logger.info("Getting notes for user_id %s, task_id %s, sort_by: %s, limit: %s, after: %s", user_id, task_id, sort_by, limit, after)
         
         if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
         
+        if limit is not None and limit < 1:
+            logger.error("Invalid limit: %s", limit)
+            return {"error": "Limit must be positive"}
+        if limit is not None:
+            limit = min(limit, config['MAX_PAGE_SIZE'])
+        try:
+            after_key = decode_cursor(after) if after else None
+        except ValueError:
+            logger.error("Invalid cursor: %s", after)
+            return {"error": "Invalid cursor"}
+        
+        by_content = sort_by == 'content'
+        sort_key = note_sort_key(sort_by)
+        next_cursor = None
         notes = []
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 query = "SELECT id, content, created_at FROM notes WHERE user_id = ? AND task_id = ? AND deleted = 0"
-                if sort_by == 'content':
-                    query += " ORDER BY content"
+                params = [user_id, task_id]
+                if after_key:
+                    query += " AND (content, id) > (?, ?)" if by_content else " AND (created_at, id) < (?, ?)"
+                    params += list(after_key)
+                if by_content:
+                    query += " ORDER BY content, id"
                 else:
-                    query += " ORDER BY created_at DESC"
-                cursor.execute(query, (user_id, task_id))
+                    query += " ORDER BY created_at DESC, id DESC"
+                if limit is not None:
+                    query += " LIMIT ?"
+                    params.append(limit + 1)
+                cursor.execute(query, params)
                 for row in cursor.fetchall():
                     notes.append({
                         "note_id": row[0],
                         "content": row[1],
                         "created_at": row[2]
                     })
+            if limit is not None and len(notes) > limit:
+                notes = notes[:limit]
+                next_cursor = encode_cursor(sort_key(notes[-1]))
+        elif storage == 'log':
+            records = (note_record(note) for note in open_store(config, 'NOTES_TXT').find('task_id', task_id)
+                       if note['user_id'] == user_id)
+            notes, next_cursor = select_page(records, sort_key, not by_content, after_key, limit)
         else:
             if not os.path.exists(config['NOTES_TXT']):
-                logging.info(f"Notes file {config['NOTES_TXT']} does not exist")
+                logger.info("Notes file %s does not exist", config['NOTES_TXT'])
                 return {"notes": []}
             with lock_file(config['NOTES_TXT'], 'r') as f:
-                lines = f.readlines()
-            for line in lines:
-                parts = line.strip().split(':')
-                if len(parts) >= 6 and parts[1] == user_id and parts[2] == task_id and parts[5] == '0':
-                    notes.append({
-                        "note_id": parts[0],
-                        "content": parts[3],
-                        "created_at": parts[4]
-                    })
-            if sort_by == 'content':
-                notes.sort(key=lambda x: x['content'])
-            else:
-                notes.sort(key=lambda x: x['created_at'], reverse=True)
+                parsed = (parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT']) for line in f)
+                records = (note_record(note) for note in parsed
+                           if note and note['user_id'] == user_id and note['task_id'] == task_id and note['deleted'] == '0')
+                notes, next_cursor = select_page(records, sort_key, not by_content, after_key, limit)
         
-        logging.info(f"Retrieved {len(notes)} notes for user_id {user_id}, task_id {task_id}")
-        return {"notes": notes}
+        logger.info("Retrieved %s notes for user_id %s, task_id %s", len(notes), user_id, task_id)
+        result = {"notes": notes}
+        if limit is not None:
+            result["next_cursor"] = next_cursor
+        return result
     except Exception as e:
-        logging.error(f"Failed to get notes: {str(e)}")
+        logger.error("Failed to get notes: %s", e)
         return {"error": f"Failed to get notes: {str(e)}"}
 
+@timed
+@invalidates(shared=True)
 def share_note(user_id, note_id, target_username, storage):
     try:
         config = get_config()
-        logging.info(f"Sharing note {note_id} from user_id {user_id} to {target_username}")
+        logger.info("Sharing note %s from user_id %s to %s", note_id, user_id, target_username)
         
         if not validate_id(user_id) or not validate_id(note_id):
-            logging.error(f"Invalid user_id or note_id: {user_id}, {note_id}")
+            logger.error("Invalid user_id or note_id: %s, %s", user_id, note_id)
             return {"error": "Invalid user_id or note_id"}
         
         if not validate_username(target_username):
-            logging.error(f"Invalid target username: {target_username}")
+            logger.error("Invalid target username: %s", target_username)
             return {"error": "Invalid target username"}
         
         if not user_exists(target_username, storage):
-            logging.error(f"Target user {target_username} does not exist")
+            logger.error("Target user %s does not exist", target_username)
             return {"error": "Target user does not exist"}
         
         target_user_id = None
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id FROM users WHERE username = ?", (target_username,))
                 result = cursor.fetchone()
                 if not result:
-                    logging.error(f"Target user {target_username} not found")
+                    logger.error("Target user %s not found", target_username)
                     return {"error": "Target user not found"}
                 target_user_id = result[0]
+            with get_connection(config['TASKS_DB']) as conn:
+                cursor = conn.cursor()
                 cursor.execute("SELECT 1 FROM notes WHERE id = ? AND user_id = ? AND deleted = 0", (note_id, user_id))
                 if not cursor.fetchone():
-                    logging.error(f"Note {note_id} not found or not owned by user {user_id}")
+                    logger.error("Note %s not found or not owned by user %s", note_id, user_id)
                     return {"error": "Note not found or not owned by user"}
                 cursor.execute("INSERT INTO shared_notes (user_id, target_user_id, note_id) VALUES (?, ?, ?)",
                               (user_id, target_user_id, note_id))
                 conn.commit()
+        elif storage == 'log':
+            targets = open_store(config, 'USERS_TXT').find('username', target_username)
+            if not targets:
+                logger.error("Target user %s not found", target_username)
+                return {"error": "Target user not found"}
+            target_user_id = targets[0]['id']
+            note = open_store(config, 'NOTES_TXT').get(note_id)
+            if note is None or note['user_id'] != user_id:
+                logger.error("Note %s not found or not owned by user %s", note_id, user_id)
+                return {"error": "Note not found or not owned by user"}
+            with lock_file(config['SHARED_NOTES_TXT'], 'a') as f:
+                f.write(f"{user_id}:{target_user_id}:{note_id}\n")
         else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
+            target = find_txt_user(config, 'username', target_username)
+            if not target:
+                logger.error("Target user %s not found", target_username)
                 return {"error": "Target user not found"}
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                for line in f:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 4 and parts[1] == target_username:
-                        target_user_id = parts[0]
-                        break
-                if not target_user_id:
-                    logging.error(f"Target user {target_username} not found")
-                    return {"error": "Target user not found"}
+            target_user_id = target['id']
             if not os.path.exists(config['NOTES_TXT']):
-                logging.info(f"Notes file {config['NOTES_TXT']} does not exist")
+                logger.info("Notes file %s does not exist", config['NOTES_TXT'])
                 return {"error": "Note not found"}
             with lock_file(config['NOTES_TXT'], 'r') as f:
                 note_exists = any(line.strip().split(':')[0] == note_id and line.strip().split(':')[1] == user_id for line in f)
             if not note_exists:
-                logging.error(f"Note {note_id} not found or not owned by user {user_id}")
+                logger.error("Note %s not found or not owned by user %s", note_id, user_id)
                 return {"error": "Note not found or not owned by user"}
             with lock_file(config['SHARED_NOTES_TXT'], 'a') as f:
                 f.write(f"{user_id}:{target_user_id}:{note_id}\n")
         
-        logging.info(f"Note {note_id} shared with {target_username}")
+        logger.info("Note %s shared with %s", note_id, target_username)
         return {"message": "Note shared"}
     except Exception as e:
-        logging.error(f"Failed to share note: {str(e)}")
+        logger.error("Failed to share note: %s", e)
         return {"error": f"Failed to share note: {str(e)}"}
 
-def get_shared_notes(user_id, storage):
+def shared_note_sort_key(record):
+    return (record['created_at'], record['note_id'])
+
+def shared_note_record(note, shared_by):
+    return {
+        "note_id": note['id'],
+        "content": note['content'],
+        "created_at": note['created_at'],
+        "shared_by": shared_by
+    }
+
+@timed
+@cached(shared=True)
+def get_shared_notes(user_id, storage, limit=None, after=None):
     try:
         config = get_config()
-        logging.info(f"Getting shared notes for user_id {user_id}")
+        logger.info("Getting shared notes for user_id %s, limit: %s, after: %s", user_id, limit, after)
         
         if not validate_id(user_id):
-            logging.error(f"Invalid user_id: {user_id}")
+            logger.error("Invalid user_id: %s", user_id)
             return {"error": "Invalid user_id"}
         
+        if limit is not None and limit < 1:
+            logger.error("Invalid limit: %s", limit)
+            return {"error": "Limit must be positive"}
+        if limit is not None:
+            limit = min(limit, config['MAX_PAGE_SIZE'])
+        try:
+            after_key = decode_cursor(after) if after else None
+        except ValueError:
+            logger.error("Invalid cursor: %s", after)
+            return {"error": "Invalid cursor"}
+        
+        next_cursor = None
         shared_notes = []
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
+                # users живёт в users.db, поэтому имена берутся из подключённой базы одним JOIN
+                attach_database(conn, config['USERS_DB'], 'users_db')
                 cursor = conn.cursor()
-                cursor.execute("""
+                query = """
                     SELECT n.id, n.content, n.created_at, u.username
                     FROM shared_notes sn
                     JOIN notes n ON sn.note_id = n.id
-                    JOIN users u ON sn.user_id = u.id
+                    JOIN users_db.users u ON sn.user_id = u.id
                     WHERE sn.target_user_id = ? AND n.deleted = 0
-                """, (user_id,))
+                """
+                params = [user_id]
+                if after_key:
+                    query += " AND (n.created_at, n.id) < (?, ?)"
+                    params += list(after_key)
+                query += " ORDER BY n.created_at DESC, n.id DESC"
+                if limit is not None:
+                    query += " LIMIT ?"
+                    params.append(limit + 1)
+                cursor.execute(query, params)
                 for row in cursor.fetchall():
                     shared_notes.append({
                         "note_id": row[0],
@@ -297,32 +452,47 @@ def get_shared_notes(user_id, storage):
                         "created_at": row[2],
                         "shared_by": row[3]
                     })
+            if limit is not None and len(shared_notes) > limit:
+                shared_notes = shared_notes[:limit]
+                next_cursor = encode_cursor(shared_note_sort_key(shared_notes[-1]))
         else:
-            if not os.path.exists(config['SHARED_NOTES_TXT']) or not os.path.exists(config['NOTES_TXT']):
-                logging.info(f"Shared notes or notes file does not exist")
+            if not os.path.exists(config['SHARED_NOTES_TXT']):
+                logger.info("Shared notes file does not exist")
                 return {"shared_notes": []}
-            shared = []
+            owners = {}
             with lock_file(config['SHARED_NOTES_TXT'], 'r') as f:
-                shared = f.readlines()
-            notes = []
-            with lock_file(config['NOTES_TXT'], 'r') as f:
-                notes = f.readlines()
-            note_dict = {line.strip().split(':')[0]: line.strip().split(':') for line in notes if len(line.strip().split(':')) >= 6 and line.strip().split(':')[5] == '0'}
-            for line in shared:
-                parts = line.strip().split(':')
-                if len(parts) >= 3 and parts[1] == user_id and parts[2] in note_dict:
-                    note = note_dict[parts[2]]
-                    shared_by = get_username(parts[0], storage)
-                    if 'username' in shared_by:
-                        shared_notes.append({
-                            "note_id": note[0],
-                            "content": note[3],
-                            "created_at": note[4],
-                            "shared_by": shared_by['username']
-                        })
+                for line in f:
+                    parts = line.strip().split(':')
+                    if len(parts) >= 3 and parts[1] == user_id:
+                        owners[parts[2]] = parts[0]
+            records = []
+            if storage == 'log':
+                notes_store = open_store(config, 'NOTES_TXT')
+                users_store = open_store(config, 'USERS_TXT')
+                usernames = {}
+                for note_id, owner_id in owners.items():
+                    note = notes_store.get(note_id)
+                    if owner_id not in usernames:
+                        owner = users_store.get(owner_id)
+                        usernames[owner_id] = owner['username'] if owner else None
+                    if note and usernames[owner_id]:
+                        records.append(shared_note_record(note, usernames[owner_id]))
+            elif owners and os.path.exists(config['NOTES_TXT']):
+                users = txt_users(config)['id']
+                with lock_file(config['NOTES_TXT'], 'r') as f:
+                    for line in f:
+                        note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+                        if note and note['deleted'] == '0' and note['id'] in owners:
+                            owner = users.get(owners[note['id']])
+                            if owner:
+                                records.append(shared_note_record(note, owner['username']))
+            shared_notes, next_cursor = select_page(records, shared_note_sort_key, True, after_key, limit)
         
-        logging.info(f"Retrieved {len(shared_notes)} shared notes for user_id {user_id}")
-        return {"shared_notes": shared_notes}
+        logger.info("Retrieved %s shared notes for user_id %s", len(shared_notes), user_id)
+        result = {"shared_notes": shared_notes}
+        if limit is not None:
+            result["next_cursor"] = next_cursor
+        return result
     except Exception as e:
-        logging.error(f"Failed to get shared notes: {str(e)}")
-        return {"error": f"Failed to get shared notes: {str(e)}"}
\ No newline at end of file
+        logger.error("Failed to get shared notes: %s", e)
+        return {"error": f"Failed to get shared notes: {str(e)}"}
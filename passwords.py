@@ -0,0 +1,75 @@
+import bcrypt
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import get_config, on_config_reload
+from metrics import timer
+
+logger = logging.getLogger(__name__)
+
+QUEUE_TIMEOUT = 10
+
+_lock = threading.Lock()
+_executor = None
+_slots = None
+
+class PasswordBusy(Exception):
+    pass
+
+def _new_pool(config):
+    # bcrypt отпускает GIL, поэтому потоки действительно считают параллельно
+    return (ThreadPoolExecutor(max_workers=config['BCRYPT_WORKERS'], thread_name_prefix='bcrypt'),
+            threading.BoundedSemaphore(config['BCRYPT_MAX_PENDING']))
+
+def _get_pool():
+    global _executor, _slots
+    with _lock:
+        if _executor is None:
+            _executor, _slots = _new_pool(get_config())
+        return _executor, _slots
+
+def _run(func, *args):
+    executor, slots = _get_pool()
+    if not slots.acquire(timeout=QUEUE_TIMEOUT):
+        logger.error("Password hashing queue is full")
+        raise PasswordBusy("Server is busy, try again later")
+    try:
+        with timer('bcrypt', func.__name__):
+            try:
+                future = executor.submit(func, *args)
+            except RuntimeError:
+                # Пул заменили перезагрузкой конфигурации, пока мы ждали слот: одна попытка
+                # в новом пуле, а если закрыт и он (например, интерпретатор завершается) - считаем здесь
+                try:
+                    future = _get_pool()[0].submit(func, *args)
+                except RuntimeError as e:
+                    logger.warning("Password pool is shut down, hashing inline: %s", e)
+                    return func(*args)
+            return future.result()
+    finally:
+        slots.release()
+
+def hash_password(password):
+    rounds = get_config()['BCRYPT_ROUNDS']
+    return _run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def check_password(password, password_hash):
+    return _run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+
+def needs_rehash(password_hash):
+    try:
+        return int(password_hash.split('$')[2]) != get_config()['BCRYPT_ROUNDS']
+    except (IndexError, ValueError):
+        return True
+
+@on_config_reload
+def _reset_pool(config):
+    # Новый пул ставится раньше, чем останавливается старый: задачи, уже отправленные
+    # в старый пул, досчитываются, а новые запросы сразу идут в новый
+    global _executor, _slots
+    with _lock:
+        executor = _executor
+        if executor is not None:
+            _executor, _slots = _new_pool(config)
+    if executor is not None:
+        executor.shutdown(wait=False)
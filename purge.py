@@ -0,0 +1,247 @@
+import os
+import logging
+import datetime
+from config import get_config
+from metrics import timed
+from db import get_connection
+from utils import lock_file, rewrite_file, record_deletion, parse_txt_line, parse_files_line, TXT_LAYOUTS, DELETED_SUFFIX
+from logstore import open_store
+from files import blob_lock, remove_file, sweep_blobs
+
+logger = logging.getLogger(__name__)
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def field(line, index):
+    parts = line.rstrip('\n').split(':')
+    return parts[index] if index < len(parts) else None
+
+def empty_counts():
+    return {"tasks": 0, "notes": 0, "subtasks": 0, "files": 0, "shared_notes": 0, "blobs": 0}
+
+def purge_chunk_sqlite(conn, task_ids, note_ids, counts):
+    # Одна транзакция на порцию: задачи каскадно забирают заметки, подзадачи, файлы и общий доступ
+    marks = ', '.join('?' * len(task_ids))
+    released = []
+    if task_ids:
+        released = conn.execute(f"SELECT path, sha256 FROM files WHERE task_id IN ({marks})", task_ids).fetchall()
+        conn.executemany("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?",
+                         [(sha256,) for _, sha256 in released if sha256])
+        conn.execute("DELETE FROM blobs WHERE refcount <= 0")
+        counts['files'] += conn.execute(f"DELETE FROM files WHERE task_id IN ({marks})", task_ids).rowcount
+        counts['shared_notes'] += conn.execute(
+            f"DELETE FROM shared_notes WHERE note_id IN (SELECT id FROM notes WHERE task_id IN ({marks}))", task_ids).rowcount
+        counts['notes'] += conn.execute(f"DELETE FROM notes WHERE task_id IN ({marks})", task_ids).rowcount
+        counts['subtasks'] += conn.execute(f"DELETE FROM subtasks WHERE task_id IN ({marks})", task_ids).rowcount
+        counts['tasks'] += conn.execute(f"DELETE FROM tasks WHERE id IN ({marks})", task_ids).rowcount
+    if note_ids:
+        marks = ', '.join('?' * len(note_ids))
+        counts['shared_notes'] += conn.execute(f"DELETE FROM shared_notes WHERE note_id IN ({marks})", note_ids).rowcount
+        counts['notes'] += conn.execute(f"DELETE FROM notes WHERE id IN ({marks})", note_ids).rowcount
+    conn.commit()
+    return [path for path, _ in released]
+
+def database_size(db_path):
+    return file_size(db_path) + file_size(db_path + '-wal')
+
+def vacuum_sqlite(db_path, pages):
+    # Свободные страницы возвращаются порциями, чтобы не держать блокировку записи на всё время
+    full_vacuum = False
+    with get_connection(db_path) as conn:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            # Режим auto_vacuum меняется только полным VACUUM; это происходит один раз
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            full_vacuum = True
+            logger.info("Converted %s to incremental auto_vacuum", db_path)
+        while conn.execute("PRAGMA freelist_count").fetchone()[0] > 0:
+            conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    return full_vacuum
+
+def purge_sqlite(config, cutoff, counts):
+    db_path = config['TASKS_DB']
+    batch_size = config['PURGE_BATCH_SIZE']
+    before = database_size(db_path)
+    reclaimed_files = 0
+    with get_connection(db_path) as conn:
+        # Строки, удалённые до появления deleted_at (например, после migrate), начинают отсчёт сейчас
+        now = datetime.datetime.now().isoformat()
+        conn.execute("UPDATE tasks SET deleted_at = ? WHERE deleted = 1 AND deleted_at IS NULL", (now,))
+        conn.execute("UPDATE notes SET deleted_at = ? WHERE deleted = 1 AND deleted_at IS NULL", (now,))
+        conn.commit()
+        for query, is_task in (("SELECT id FROM tasks WHERE deleted = 1 AND deleted_at <= ? LIMIT ?", True),
+                               ("SELECT id FROM notes WHERE deleted = 1 AND deleted_at <= ? LIMIT ?", False)):
+            while True:
+                ids = [row[0] for row in conn.execute(query, (cutoff, batch_size)).fetchall()]
+                if not ids:
+                    break
+                with blob_lock(config):
+                    released = purge_chunk_sqlite(conn, ids if is_task else [], [] if is_task else ids, counts)
+                    for path in released:
+                        reclaimed_files += remove_file(path)
+    with blob_lock(config):
+        with get_connection(db_path) as conn:
+            referenced = {row[0] for row in conn.execute("SELECT sha256 FROM blobs").fetchall()}
+        counts['blobs'], blob_bytes = sweep_blobs(config, referenced)
+    full_vacuum = vacuum_sqlite(db_path, config['PURGE_VACUUM_PAGES'])
+    # Переход на incremental auto_vacuum может немного увеличить файл базы
+    return {"files": reclaimed_files + blob_bytes, "database": max(0, before - database_size(db_path))}, full_vacuum
+
+def load_deletions(path):
+    deletions = {}
+    if os.path.exists(path + DELETED_SUFFIX):
+        with lock_file(path + DELETED_SUFFIX, 'r') as f:
+            for line in f:
+                record_id, _, deleted_at = line.rstrip('\n').partition(':')
+                if deleted_at:
+                    # При повторном удалении отсчёт идёт от первой записи
+                    deletions.setdefault(record_id, deleted_at)
+    return deletions
+
+def compact_txt(path, drop):
+    # drop(line) решает, удалить ли строку; возвращает число удалённых строк и освобождённые байты
+    if not os.path.exists(path):
+        return 0, 0
+    before = file_size(path)
+    removed = 0
+    with rewrite_file(path) as (lines, f):
+        for line in lines:
+            if drop(line):
+                removed += 1
+            else:
+                f.write(line)
+    return removed, before - file_size(path)
+
+def expired_txt(config, name, deletions, cutoff):
+    # Помеченные строки без записи в журнале (удалены до его появления) начинают отсчёт сейчас
+    expired = set()
+    if not os.path.exists(config[name]):
+        return expired
+    layout = TXT_LAYOUTS[name]
+    with lock_file(config[name], 'r') as f:
+        for line in f:
+            record = parse_txt_line(line, layout)
+            if not record or record['deleted'] != '1':
+                continue
+            if record['id'] not in deletions:
+                record_deletion(config[name], record['id'])
+            elif deletions[record['id']] <= cutoff:
+                expired.add(record['id'])
+    return expired
+
+def purge_txt(config, storage, cutoff, counts):
+    task_deletions = load_deletions(config['TASKS_TXT'])
+    note_deletions = load_deletions(config['NOTES_TXT'])
+    reclaimed = {"files": 0, "txt": 0}
+    if storage == 'log':
+        # В log-хранилище удалённые записи уже недоступны, остаются каскад и компактизация.
+        # Каскадные пометки получают время удаления задачи, чтобы компактизация с тем же cutoff их убрала
+        tasks_store = open_store(config, 'TASKS_TXT')
+        notes_store = open_store(config, 'NOTES_TXT')
+        subtasks_store = open_store(config, 'SUBTASKS_TXT')
+        tasks = {task_id for task_id, deleted_at in task_deletions.items()
+                 if deleted_at <= cutoff and tasks_store.get(task_id) is None}
+        notes = {note_id for note_id, deleted_at in note_deletions.items()
+                 if deleted_at <= cutoff and notes_store.get(note_id) is None}
+        # Удалённые напрямую заметки уже сняты из хранилища; каскадные ниже считаются по мере удаления
+        counts['notes'] += len(notes)
+        for task_id in tasks:
+            for note in notes_store.find('task_id', task_id):
+                if notes_store.delete(note['id'], task_deletions[task_id]):
+                    counts['notes'] += 1
+                notes.add(note['id'])
+            for subtask in subtasks_store.find('task_id', task_id):
+                if subtasks_store.delete(subtask['id'], task_deletions[task_id]):
+                    counts['subtasks'] += 1
+        counts['tasks'] += len(tasks)
+        for store in (tasks_store, notes_store, subtasks_store):
+            reclaimed['txt'] += store.compact(cutoff)
+    else:
+        tasks = expired_txt(config, 'TASKS_TXT', task_deletions, cutoff)
+        notes = expired_txt(config, 'NOTES_TXT', note_deletions, cutoff)
+        if tasks:
+            removed, freed = compact_txt(config['TASKS_TXT'], lambda line: field(line, 0) in tasks)
+            counts['tasks'] += removed
+            reclaimed['txt'] += freed
+
+        def drop_note(line):
+            note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+            if note and (note['id'] in notes or note['task_id'] in tasks):
+                notes.add(note['id'])
+                return True
+            return False
+
+        if tasks or notes:
+            removed, freed = compact_txt(config['NOTES_TXT'], drop_note)
+            counts['notes'] += removed
+            reclaimed['txt'] += freed
+        if tasks:
+            removed, freed = compact_txt(config['SUBTASKS_TXT'], lambda line: field(line, 1) in tasks)
+            counts['subtasks'] += removed
+            reclaimed['txt'] += freed
+
+    if notes:
+        removed, freed = compact_txt(config['SHARED_NOTES_TXT'], lambda line: field(line, 2) in notes)
+        counts['shared_notes'] += removed
+        reclaimed['txt'] += freed
+    with blob_lock(config):
+        released = []
+        referenced = set()
+
+        def drop_file(line):
+            entry = parse_files_line(line)
+            if entry and entry['task_id'] in tasks:
+                released.append(entry['path'])
+                return True
+            if entry and entry['sha256']:
+                referenced.add(entry['sha256'])
+            return False
+
+        if tasks:
+            removed, freed = compact_txt(config['FILES_TXT'], drop_file)
+            counts['files'] += removed
+            reclaimed['txt'] += freed
+            for path in released:
+                reclaimed['files'] += remove_file(path)
+            counts['blobs'], blob_bytes = sweep_blobs(config, referenced)
+            reclaimed['files'] += blob_bytes
+
+    # Очищенные записи убираются и из журналов удаления
+    for name, purged in (('TASKS_TXT', tasks), ('NOTES_TXT', notes)):
+        if purged:
+            _, freed = compact_txt(config[name] + DELETED_SUFFIX, lambda line: field(line, 0) in purged)
+            reclaimed['txt'] += freed
+    return reclaimed, False
+
+@timed
+def purge_deleted(storage):
+    try:
+        config = get_config()
+        retention_days = config['PURGE_RETENTION_DAYS']
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=retention_days)).isoformat()
+        logger.info("Purging rows deleted before %s", cutoff)
+        counts = empty_counts()
+        if storage == 'sqlite':
+            reclaimed, full_vacuum = purge_sqlite(config, cutoff, counts)
+        else:
+            reclaimed, full_vacuum = purge_txt(config, storage, cutoff, counts)
+        total = sum(reclaimed.values())
+        logger.info("Purged %s, reclaimed %s bytes", counts, total)
+        return {
+            "message": "Purge completed",
+            "retention_days": retention_days,
+            "purged": counts,
+            "reclaimed_bytes": total,
+            "reclaimed": reclaimed,
+            "full_vacuum": full_vacuum
+        }
+    except Exception as e:
+        logger.error("Failed to purge deleted rows: %s", e)
+        return {"error": f"Failed to purge deleted rows: {str(e)}"}
@@ -0,0 +1,305 @@
+import os
+import re
+import math
+import json
+import heapq
+import logging
+import threading
+import contextlib
+from config import get_config
+from metrics import timed
+from cache import cached
+from db import get_connection
+from utils import lock_file, validate_id, parse_txt_line, TXT_LAYOUTS
+from logstore import open_store
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+')
+TITLE_WEIGHT = 2
+BM25_K1 = 1.2
+BM25_B = 0.75
+SNIPPET_CHARS = 60
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.casefold())
+
+def result_entry(kind, ref_id, task_id, title, snippet, created_at, score):
+    return {
+        "kind": kind,
+        "id": ref_id,
+        "task_id": task_id,
+        "title": title or None,
+        "snippet": snippet,
+        "created_at": created_at,
+        "score": round(score, 4)
+    }
+
+def make_snippet(text, terms):
+    folded = text.casefold()
+    positions = [pos for pos in (folded.find(term) for term in terms) if pos >= 0]
+    if not positions:
+        return text[:SNIPPET_CHARS * 2]
+    pos = min(positions)
+    end = pos + len(next(term for term in terms if folded.find(term) == pos))
+    start = max(0, pos - SNIPPET_CHARS)
+    prefix = '...' if start > 0 else ''
+    suffix = '...' if end + SNIPPET_CHARS < len(text) else ''
+    return f"{prefix}{text[start:pos]}[{text[pos:end]}]{text[end:end + SNIPPET_CHARS]}{suffix}"
+
+class InvertedIndex:
+    def __init__(self):
+        self.docs = {}
+        self.postings = {}
+        self.user_stats = {}
+        self.dirty = False
+
+    def add(self, kind, ref_id, user_id, task_id, created_at, title, body):
+        counts = {}
+        for token in tokenize(title):
+            counts[token] = counts.get(token, 0) + TITLE_WEIGHT
+        for token in tokenize(body):
+            counts[token] = counts.get(token, 0) + 1
+        key = (kind, ref_id)
+        length = sum(counts.values())
+        self.docs[key] = (user_id, task_id, created_at, title, body, length)
+        user_postings = self.postings.setdefault(user_id, {})
+        for token, tf in counts.items():
+            user_postings.setdefault(token, {})[key] = tf
+        stats = self.user_stats.setdefault(user_id, [0, 0])
+        stats[0] += 1
+        stats[1] += length
+        self.dirty = True
+
+    def remove(self, kind, ref_id):
+        key = (kind, ref_id)
+        doc = self.docs.pop(key, None)
+        if doc is None:
+            return
+        user_id, _, _, title, body, length = doc
+        user_postings = self.postings[user_id]
+        for token in set(tokenize(title)) | set(tokenize(body)):
+            docs = user_postings.get(token)
+            if docs is not None:
+                docs.pop(key, None)
+                if not docs:
+                    del user_postings[token]
+        stats = self.user_stats[user_id]
+        stats[0] -= 1
+        stats[1] -= length
+        self.dirty = True
+
+    def remove_task(self, task_id):
+        # Задача уходит из индекса вместе со своими заметками
+        for kind, ref_id in [key for key, doc in self.docs.items() if doc[1] == task_id]:
+            self.remove(kind, ref_id)
+
+    def to_json(self):
+        # Только данные: шард читается любым процессом, поэтому pickle здесь не годится.
+        # Ключи документов в списках словаря заменены их номерами в docs
+        keys = list(self.docs)
+        positions = {key: i for i, key in enumerate(keys)}
+        return {
+            "docs": [[kind, ref_id, *self.docs[(kind, ref_id)]] for kind, ref_id in keys],
+            "postings": {user_id: {token: [[positions[key], tf] for key, tf in docs.items()]
+                                   for token, docs in user_postings.items()}
+                         for user_id, user_postings in self.postings.items()},
+            "user_stats": self.user_stats,
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        index = cls()
+        keys = []
+        for kind, ref_id, *doc in data['docs']:
+            keys.append((kind, ref_id))
+            index.docs[(kind, ref_id)] = tuple(doc)
+        index.postings = {user_id: {token: {keys[i]: tf for i, tf in docs} for token, docs in user_postings.items()}
+                          for user_id, user_postings in data['postings'].items()}
+        index.user_stats = data['user_stats']
+        return index
+
+    def add_line(self, kind, line):
+        if kind == 'task':
+            task = parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT'])
+            if task and task['deleted'] == '0':
+                self.add('task', task['id'], task['user_id'], task['id'], task['created_at'], task['title'], task['description'])
+        else:
+            note = parse_txt_line(line, TXT_LAYOUTS['NOTES_TXT'])
+            if note and note['deleted'] == '0':
+                self.add('note', note['id'], note['user_id'], note['task_id'], note['created_at'], '', note['content'])
+
+    def search(self, user_id, terms, limit, offset):
+        user_postings = self.postings.get(user_id)
+        if not user_postings:
+            return []
+        term_postings = []
+        candidates = None
+        for i, term in enumerate(terms):
+            if i == len(terms) - 1:
+                # Последнее слово ищется по префиксу, как в FTS5-запросе
+                posting = {}
+                for token, docs in user_postings.items():
+                    if token.startswith(term):
+                        for key, tf in docs.items():
+                            posting[key] = posting.get(key, 0) + tf
+            else:
+                posting = user_postings.get(term, {})
+            term_postings.append(posting)
+            candidates = set(posting) if candidates is None else candidates & posting.keys()
+            if not candidates:
+                return []
+        count, total = self.user_stats[user_id]
+        avgdl = total / count
+        scored = []
+        for key in candidates:
+            if key[0] == 'note' and ('task', self.docs[key][1]) not in self.docs:
+                # Задача заметки удалена: в индексе остаются только живые задачи
+                continue
+            length = self.docs[key][5]
+            score = 0.0
+            for posting in term_postings:
+                tf = posting[key]
+                idf = math.log(1 + (count - len(posting) + 0.5) / (len(posting) + 0.5))
+                score += idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl))
+            scored.append((score, key))
+        results = []
+        for score, (kind, ref_id) in heapq.nlargest(offset + limit + 1, scored)[offset:]:
+            _, task_id, created_at, title, body, _ = self.docs[(kind, ref_id)]
+            results.append(result_entry(kind, ref_id, task_id, title, make_snippet(body, terms), created_at, score))
+        return results
+
+def shard_dir(config, storage):
+    return config['NOTES_TXT'] + ('.log.search.d' if storage == 'log' else '.search.d')
+
+def shard_path(config, storage, user_id):
+    return os.path.join(shard_dir(config, storage), user_id)
+
+def build_shard(config, storage, user_id):
+    index = InvertedIndex()
+    if storage == 'log':
+        for task in open_store(config, 'TASKS_TXT').find('user_id', user_id):
+            index.add('task', task['id'], user_id, task['id'], task['created_at'], task['title'], task['description'])
+        for note in open_store(config, 'NOTES_TXT').find('user_id', user_id):
+            if ('task', note['task_id']) in index.docs:
+                index.add('note', note['id'], user_id, note['task_id'], note['created_at'], '', note['content'])
+        return index
+    # Один проход по tasks.txt и notes.txt; в шард попадают только строки пользователя
+    for kind, name in (('task', 'TASKS_TXT'), ('note', 'NOTES_TXT')):
+        if not os.path.exists(config[name]):
+            continue
+        with lock_file(config[name], 'r') as f:
+            for line in f:
+                parts = line.split(':', 3)
+                # Заметки удалённых задач не индексируются: задачи читаются первыми
+                if len(parts) > 3 and parts[1] == user_id and (kind == 'task' or ('task', parts[2]) in index.docs):
+                    index.add_line(kind, line)
+    return index
+
+def load_shard(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return InvertedIndex.from_json(json.load(f))
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.error("Failed to load search index %s, rebuilding: %s", path, e)
+        return None
+
+def save_shard(path, index):
+    index.dirty = False
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index.to_json(), f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+@contextlib.contextmanager
+def index_update(config, storage, user_id):
+    # Блокировка шарда держится, пока txt-файл или журнал меняется, поэтому шард меняется в том же порядке,
+    # что и данные. Если шарда нет, обновлять нечего: первый поиск соберёт его из уже изменённых данных
+    path = shard_path(config, storage, user_id)
+    os.makedirs(shard_dir(config, storage), exist_ok=True)
+    with lock_file(path + '.lock', 'a'):
+        index = load_shard(path)
+        yield index
+        if index is not None and index.dirty:
+            try:
+                save_shard(path, index)
+            except Exception as e:
+                # Устаревший шард хуже отсутствующего
+                logger.error("Failed to update search index %s, dropping it: %s", path, e)
+                if os.path.exists(path):
+                    os.remove(path)
+
+def drop_legacy_index(config):
+    # Общий индекс на весь корпус из прежних версий больше не используется
+    if os.path.isfile(config['NOTES_TXT'] + '.search'):
+        os.remove(config['NOTES_TXT'] + '.search')
+
+def drop_txt_indexes(config):
+    # После массовой перезаписи txt-файлов все шарды собираются заново
+    import shutil
+    shutil.rmtree(shard_dir(config, 'txt'), ignore_errors=True)
+    drop_legacy_index(config)
+
+def search_shard(config, storage, user_id, terms, limit, offset):
+    path = shard_path(config, storage, user_id)
+    index = load_shard(path)
+    if index is None:
+        os.makedirs(shard_dir(config, storage), exist_ok=True)
+        with lock_file(path + '.lock', 'a'):
+            # Другой процесс мог собрать шард, пока мы ждали блокировку
+            index = load_shard(path)
+            if index is None:
+                index = build_shard(config, storage, user_id)
+                save_shard(path, index)
+                logger.info("Built search index %s", path)
+                if storage == 'txt':
+                    drop_legacy_index(config)
+    return index.search(user_id, terms, limit, offset)
+
+def search_sqlite(config, user_id, terms, limit, offset):
+    match = ' '.join(f'"{term}"' for term in terms[:-1]) + f' "{terms[-1]}"*'
+    with get_connection(config['TASKS_DB']) as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT kind, ref_id, task_id, title, snippet(search_index, 6, '[', ']', '...', 12), created_at,
+                   bm25(search_index, 0, 0, 0, 0, 0, 2.0, 1.0) AS score
+            FROM search_index
+            WHERE search_index MATCH ?
+            ORDER BY score
+            LIMIT ? OFFSET ?
+        """, (f'user_id : "{user_id}" AND {{title body}} : ({match.strip()})', limit + 1, offset))
+        return [result_entry(*row[:6], -row[6]) for row in cursor.fetchall()]
+
+@timed
+@cached
+def search(user_id, query, storage, limit=20, offset=0):
+    try:
+        config = get_config()
+        logger.info("Searching for user_id %s: %s", user_id, query)
+
+        if not validate_id(user_id):
+            logger.error("Invalid user_id: %s", user_id)
+            return {"error": "Invalid user_id"}
+
+        terms = tokenize(query)
+        if not terms:
+            logger.error("Empty search query: %s", query)
+            return {"error": "Search query is empty"}
+
+        if limit < 1 or offset < 0:
+            logger.error("Invalid limit or offset: %s, %s", limit, offset)
+            return {"error": "Invalid limit or offset"}
+        limit = min(limit, config['MAX_PAGE_SIZE'])
+
+        if storage == 'sqlite':
+            results = search_sqlite(config, user_id, terms, limit, offset)
+        else:
+            results = search_shard(config, storage, user_id, terms, limit, offset)
+
+        logger.info("Found %s search results for user_id %s", len(results), user_id)
+        return {"results": results[:limit], "has_more": len(results) > limit}
+    except Exception as e:
+        logger.error("Failed to search: %s", e)
+        return {"error": f"Failed to search: {str(e)}"}
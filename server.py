@@ -0,0 +1,86 @@
+import json
+import logging
+import os
+import signal
+import socketserver
+import threading
+from config import get_config, reload_config
+from db import close_connections
+from mailer import start_worker, stop_worker
+from metrics import start_flusher, stop_flusher
+from cache import enable_cache, disable_cache
+
+logger = logging.getLogger(__name__)
+
+STREAM_COMMANDS = ('download_file',)
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                command = request['command']
+                args = [str(arg) for arg in request.get('args', [])]
+            except Exception as e:
+                logger.error("Invalid daemon request: %s", e)
+                result = {'error': f'Invalid request: {str(e)}'}
+            else:
+                if command in STREAM_COMMANDS:
+                    # Заголовок и тело пишутся прямо в сокет; после обрыва посередине тела соединение не переиспользуется
+                    try:
+                        self.server.stream_command(command, args, self.wfile, get_config()['STORAGE'])
+                    except Exception as e:
+                        logger.error("Streaming %s failed: %s", command, e)
+                        return
+                    continue
+                result = self.server.execute_command(command, args, get_config()['STORAGE'])
+            self.wfile.write(json.dumps(result).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class CommandServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, execute_command, stream_command):
+        self.execute_command = execute_command
+        self.stream_command = stream_command
+        super().__init__(socket_path, CommandHandler)
+
+def serve(config, execute_command, stream_command):
+    socket_path = config['DAEMON_SOCKET']
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    server = CommandServer(socket_path, execute_command, stream_command)
+    os.chmod(socket_path, 0o660)
+
+    def shutdown(signum, frame):
+        logger.info("Received signal %s, stopping daemon", signum)
+        threading.Thread(target=server.shutdown).start()
+
+    def reload(signum, frame):
+        try:
+            reload_config()
+        except Exception as e:
+            logger.error("Failed to reload configuration: %s", e)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGHUP, reload)
+
+    enable_cache()
+    start_worker()
+    start_flusher()
+    logger.info("Daemon listening on %s", socket_path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        stop_worker()
+        stop_flusher()
+        disable_cache()
+        close_connections()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        logger.info("Daemon stopped")
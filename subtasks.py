@@ -1,152 +1,235 @@
-import sqlite3
-import secrets
 import os
 import logging
 from config import get_config
-from utils import lock_file, validate_id, validate_task_title
+from metrics import timed
+from cache import cached, invalidates
+from db import get_connection
+from utils import lock_file, rewrite_file, validate_id, validate_task_title, parse_txt_line, format_txt_line, TXT_LAYOUTS
+from logstore import open_store, get_owned_task
 
+logger = logging.getLogger(__name__)
+
+@timed
+@invalidates
 def create_subtask(user_id, task_id, title, storage):
+    import secrets
     try:
         config = get_config()
-        logging.info(f"Creating subtask for user_id {user_id}, task_id {task_id}: {title}")
+        logger.info("Creating subtask for user_id %s, task_id %s: %s", user_id, task_id, title)
         
         if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
         
         if not validate_task_title(title):
-            logging.error(f"Invalid subtask title: {title}")
+            logger.error("Invalid subtask title: %s", title)
             return {"error": "Subtask title must be 1-100 characters long and contain letters, numbers, or spaces"}
         
         subtask_id = secrets.token_hex(8)
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
                 if not cursor.fetchone():
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                    logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                     return {"error": "Task not found or not owned by user"}
                 cursor.execute("INSERT INTO subtasks (id, task_id, title, completed) VALUES (?, ?, ?, 0)",
                               (subtask_id, task_id, title))
                 conn.commit()
-                logging.info(f"Subtask {subtask_id} created in SQLite")
+                logger.info("Subtask %s created in SQLite", subtask_id)
                 return {"message": "Subtask created", "subtask_id": subtask_id}
+        elif storage == 'log':
+            if not get_owned_task(config, task_id, user_id):
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
+            open_store(config, 'SUBTASKS_TXT').put({"id": subtask_id, "task_id": task_id, "title": title, "completed": 0})
+            logger.info("Subtask %s created in log storage", subtask_id)
+            return {"message": "Subtask created", "subtask_id": subtask_id}
         else:
             if not os.path.exists(config['TASKS_TXT']):
-                logging.info(f"Tasks file {config['TASKS_TXT']} does not exist")
+                logger.info("Tasks file %s does not exist", config['TASKS_TXT'])
                 return {"error": "Task not found"}
             with lock_file(config['TASKS_TXT'], 'r') as f:
                 tasks = f.readlines()
             task_exists = any(line.strip().split(':')[0] == task_id and line.strip().split(':')[1] == user_id for line in tasks)
             if not task_exists:
-                logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                 return {"error": "Task not found or not owned by user"}
             with lock_file(config['SUBTASKS_TXT'], 'a') as f:
                 f.write(f"{subtask_id}:{task_id}:{title}:0\n")
-            logging.info(f"Subtask {subtask_id} created in txt")
+            logger.info("Subtask %s created in txt", subtask_id)
             return {"message": "Subtask created", "subtask_id": subtask_id}
     except Exception as e:
-        logging.error(f"Failed to create subtask: {str(e)}")
+        logger.error("Failed to create subtask: %s", e)
         return {"error": f"Failed to create subtask: {str(e)}"}
 
-def get_subtasks(user_id, task_id, storage):
+SUBTASK_FILTERS = ('all', 'open', 'completed')
+
+@timed
+@cached
+def get_subtasks(user_id, task_id, storage, status='all', limit=None, offset=0):
     try:
         config = get_config()
-        logging.info(f"Getting subtasks for user_id {user_id}, task_id {task_id}")
+        logger.info("Getting subtasks for user_id %s, task_id %s, status: %s, limit: %s, offset: %s", user_id, task_id, status, limit, offset)
         
         if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
         
+        if status not in SUBTASK_FILTERS or (limit is not None and limit < 0) or offset < 0:
+            logger.error("Invalid subtask filter: %s, %s, %s", status, limit, offset)
+            return {"error": "Invalid status filter, limit or offset"}
+        
+        # Запрашиваем на одну запись больше, чтобы узнать, есть ли следующая страница
+        fetch = limit + 1 if limit is not None else None
         subtasks = []
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
-                cursor.execute("SELECT id, title, completed FROM subtasks WHERE task_id = ?", (task_id,))
+                query = """
+                    SELECT s.id, s.title, s.completed
+                    FROM subtasks s
+                    JOIN tasks t ON t.id = s.task_id
+                    WHERE s.task_id = ? AND t.user_id = ? AND t.deleted = 0
+                """
+                params = [task_id, user_id]
+                if status != 'all':
+                    query += " AND s.completed = ?"
+                    params.append(1 if status == 'completed' else 0)
+                query += " ORDER BY s.rowid LIMIT ? OFFSET ?"
+                params += [fetch if fetch is not None else -1, offset]
+                cursor.execute(query, params)
                 for row in cursor.fetchall():
-                    cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
-                    if cursor.fetchone():
-                        subtasks.append({
-                            "subtask_id": row[0],
-                            "title": row[1],
-                            "completed": bool(row[2])
-                        })
+                    subtasks.append({
+                        "subtask_id": row[0],
+                        "title": row[1],
+                        "completed": bool(row[2])
+                    })
+        elif storage == 'log':
+            if not get_owned_task(config, task_id, user_id):
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
+            for subtask in open_store(config, 'SUBTASKS_TXT').find('task_id', task_id, by_creation=True):
+                completed = bool(int(subtask['completed']))
+                if status == 'all' or completed == (status == 'completed'):
+                    subtasks.append({
+                        "subtask_id": subtask['id'],
+                        "title": subtask['title'],
+                        "completed": completed
+                    })
+            subtasks = subtasks[offset:offset + fetch if fetch is not None else None]
         else:
-            if not os.path.exists(config['SUBTASKS_TXT']):
-                logging.info(f"Subtasks file {config['SUBTASKS_TXT']} does not exist")
-                return {"subtasks": []}
-            with lock_file(config['SUBTASKS_TXT'], 'r') as f:
-                lines = f.readlines()
+            if not os.path.exists(config['TASKS_TXT']):
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
             with lock_file(config['TASKS_TXT'], 'r') as f:
-                task_exists = any(line.strip().split(':')[0] == task_id and line.strip().split(':')[1] == user_id for line in f)
+                task_exists = any(task and task['id'] == task_id and task['user_id'] == user_id and task['deleted'] == '0'
+                                  for task in (parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT']) for line in f))
             if not task_exists:
-                logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                 return {"error": "Task not found or not owned by user"}
-            for line in lines:
-                parts = line.strip().split(':')
-                if len(parts) >= 4 and parts[1] == task_id:
+            if not os.path.exists(config['SUBTASKS_TXT']):
+                logger.info("Subtasks file %s does not exist", config['SUBTASKS_TXT'])
+                return {"subtasks": []}
+            skipped = 0
+            with lock_file(config['SUBTASKS_TXT'], 'r') as f:
+                for line in f:
+                    parts = line.strip().split(':')
+                    if len(parts) < 4 or parts[1] != task_id:
+                        continue
+                    completed = parts[3] == '1'
+                    if status != 'all' and completed != (status == 'completed'):
+                        continue
+                    if skipped < offset:
+                        skipped += 1
+                        continue
                     subtasks.append({
                         "subtask_id": parts[0],
                         "title": parts[2],
-                        "completed": parts[3] == '1'
+                        "completed": completed
                     })
+                    if fetch is not None and len(subtasks) >= fetch:
+                        break
         
-        logging.info(f"Retrieved {len(subtasks)} subtasks for task_id {task_id}")
-        return {"subtasks": subtasks}
+        result = {"subtasks": subtasks[:limit] if limit is not None else subtasks}
+        if limit is not None:
+            result["has_more"] = len(subtasks) > limit
+        logger.info("Retrieved %s subtasks for task_id %s", len(result['subtasks']), task_id)
+        return result
     except Exception as e:
-        logging.error(f"Failed to get subtasks: {str(e)}")
+        logger.error("Failed to get subtasks: %s", e)
         return {"error": f"Failed to get subtasks: {str(e)}"}
 
+@timed
+@invalidates
 def mark_subtask_completed(user_id, task_id, subtask_id, storage):
     try:
         config = get_config()
-        logging.info(f"Marking subtask {subtask_id} as completed for user_id {user_id}, task_id {task_id}")
+        logger.info("Marking subtask %s as completed for user_id %s, task_id %s", subtask_id, user_id, task_id)
         
         if not validate_id(user_id) or not validate_id(task_id) or not validate_id(subtask_id):
-            logging.error(f"Invalid user_id, task_id, or subtask_id: {user_id}, {task_id}, {subtask_id}")
+            logger.error("Invalid user_id, task_id, or subtask_id: %s, %s, %s", user_id, task_id, subtask_id)
             return {"error": "Invalid user_id, task_id, or subtask_id"}
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT 1 FROM tasks WHERE id = ? AND user_id = ? AND deleted = 0", (task_id, user_id))
                 if not cursor.fetchone():
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                    logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                     return {"error": "Task not found or not owned by user"}
                 cursor.execute("UPDATE subtasks SET completed = 1 WHERE id = ? AND task_id = ?", (subtask_id, task_id))
                 conn.commit()
                 if cursor.rowcount == 0:
-                    logging.error(f"Subtask {subtask_id} not found")
+                    logger.error("Subtask %s not found", subtask_id)
                     return {"error": "Subtask not found"}
-                logging.info(f"Subtask {subtask_id} marked as completed")
+                logger.info("Subtask %s marked as completed", subtask_id)
                 return {"message": "Subtask marked as completed"}
+        elif storage == 'log':
+            if not get_owned_task(config, task_id, user_id):
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
+            store = open_store(config, 'SUBTASKS_TXT')
+            subtask = store.get(subtask_id)
+            if subtask is None or subtask['task_id'] != task_id:
+                logger.error("Subtask %s not found", subtask_id)
+                return {"error": "Subtask not found"}
+            store.update(subtask_id, completed=1)
+            logger.info("Subtask %s marked as completed", subtask_id)
+            return {"message": "Subtask marked as completed"}
         else:
+            task_exists = False
+            if os.path.exists(config['TASKS_TXT']):
+                with lock_file(config['TASKS_TXT'], 'r') as f:
+                    task_exists = any(task and task['id'] == task_id and task['user_id'] == user_id and task['deleted'] == '0'
+                                      for task in (parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT']) for line in f))
+            if not task_exists:
+                logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                return {"error": "Task not found or not owned by user"}
             if not os.path.exists(config['SUBTASKS_TXT']):
-                logging.info(f"Subtasks file {config['SUBTASKS_TXT']} does not exist")
+                logger.info("Subtasks file %s does not exist", config['SUBTASKS_TXT'])
                 return {"error": "Subtask not found"}
-            lines = []
-            found = False
-            with lock_file(config['SUBTASKS_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['SUBTASKS_TXT'], 'w') as f:
+            found = changed = False
+            rewrite = rewrite_file(config['SUBTASKS_TXT'])
+            with rewrite as (lines, f):
                 for line in lines:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 4 and parts[0] == subtask_id and parts[1] == task_id:
-                        f.write(f"{parts[0]}:{parts[1]}:{parts[2]}:1\n")
+                    subtask = parse_txt_line(line, TXT_LAYOUTS['SUBTASKS_TXT'])
+                    if subtask and subtask['id'] == subtask_id and subtask['task_id'] == task_id:
                         found = True
-                    else:
-                        f.write(line)
-                if not found:
-                    logging.error(f"Subtask {subtask_id} not found")
-                    return {"error": "Subtask not found"}
-            with lock_file(config['TASKS_TXT'], 'r') as f:
-                task_exists = any(line.strip().split(':')[0] == task_id and line.strip().split(':')[1] == user_id for line in f)
-            if not task_exists:
-                logging.error(f"Task {task_id} not found or not owned by user {user_id}")
-                return {"error": "Task not found or not owned by user"}
-            logging.info(f"Subtask {subtask_id} marked as completed")
+                        if subtask['completed'] != '1':
+                            subtask['completed'] = '1'
+                            f.write(format_txt_line(subtask, TXT_LAYOUTS['SUBTASKS_TXT']))
+                            changed = True
+                            continue
+                    f.write(line)
+                if not changed:
+                    rewrite.discard()
+            if not found:
+                logger.error("Subtask %s not found", subtask_id)
+                return {"error": "Subtask not found"}
+            logger.info("Subtask %s marked as completed", subtask_id)
             return {"message": "Subtask marked as completed"}
     except Exception as e:
-        logging.error(f"Failed to mark subtask completed: {str(e)}")
+        logger.error("Failed to mark subtask completed: %s", e)
         return {"error": f"Failed to mark subtask completed: {str(e)}"}
\ No newline at end of file
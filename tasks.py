@@ -1,62 +1,126 @@
-import sqlite3
-import secrets
 import os
 import logging
+import datetime
 from config import get_config
-from utils import lock_file, validate_task_title, validate_id
+from metrics import timed
+from cache import cached, invalidates
+from db import get_connection
+from utils import lock_file, rewrite_file, validate_task_title, validate_id, parse_txt_line, TXT_LAYOUTS, format_txt_line, record_deletion, encode_cursor, decode_cursor, select_page
+from logstore import open_store
 
+logger = logging.getLogger(__name__)
+
+@timed
+@invalidates
 def create_task(user_id, title, description, storage):
+    import secrets
     try:
         config = get_config()
-        logging.info(f"Creating task for user_id {user_id}: {title}")
+        logger.info("Creating task for user_id %s: %s", user_id, title)
         
         if not validate_id(user_id):
-            logging.error(f"Invalid user_id: {user_id}")
+            logger.error("Invalid user_id: %s", user_id)
             return {"error": "Invalid user_id"}
         
         if not validate_task_title(title):
-            logging.error(f"Invalid task title: {title}")
+            logger.error("Invalid task title: %s", title)
             return {"error": "Task title must be 1-100 characters long and contain letters, numbers, or spaces"}
         
         task_id = secrets.token_hex(8)
         created_at = datetime.datetime.now().isoformat()
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("INSERT INTO tasks (id, user_id, title, description, status, created_at) VALUES (?, ?, ?, ?, 'pending', ?)",
                               (task_id, user_id, title, description, created_at))
                 conn.commit()
-                logging.info(f"Task {task_id} created in SQLite")
+                logger.info("Task %s created in SQLite", task_id)
                 return {"message": "Task created", "task_id": task_id}
+        elif storage == 'log':
+            from search import index_update
+            with index_update(config, storage, user_id) as index:
+                open_store(config, 'TASKS_TXT').put({
+                    "id": task_id,
+                    "user_id": user_id,
+                    "title": title,
+                    "description": description,
+                    "status": "pending",
+                    "created_at": created_at
+                })
+                if index is not None:
+                    index.add('task', task_id, user_id, task_id, created_at, title, description)
+            logger.info("Task %s created in log storage", task_id)
+            return {"message": "Task created", "task_id": task_id}
         else:
-            with lock_file(config['TASKS_TXT'], 'a') as f:
-                f.write(f"{task_id}:{user_id}:{title}:{description}:pending:{created_at}\n")
-            logging.info(f"Task {task_id} created in txt")
+            from search import index_update
+            with index_update(config, storage, user_id) as index:
+                with lock_file(config['TASKS_TXT'], 'a') as f:
+                    f.write(f"{task_id}:{user_id}:{title}:{description}:pending:{created_at}\n")
+                if index is not None:
+                    index.add('task', task_id, user_id, task_id, created_at, title, description)
+            logger.info("Task %s created in txt", task_id)
             return {"message": "Task created", "task_id": task_id}
     except Exception as e:
-        logging.error(f"Failed to create task: {str(e)}")
+        logger.error("Failed to create task: %s", e)
         return {"error": f"Failed to create task: {str(e)}"}
 
-def get_tasks(user_id, storage, sort_by='created_at'):
+def task_sort_key(sort_by):
+    if sort_by == 'title':
+        return lambda x: (x['title'], x['task_id'])
+    return lambda x: (x['created_at'], x['task_id'])
+
+def task_record(task):
+    return {
+        "task_id": task['id'],
+        "title": task['title'],
+        "description": task['description'],
+        "status": task['status'],
+        "created_at": task['created_at']
+    }
+
+@timed
+@cached
+def get_tasks(user_id, storage, sort_by='created_at', limit=None, after=None):
     try:
         config = get_config()
-        logging.info(f"Getting tasks for user_id {user_id}, sort_by: {sort_by}")
+        logger.info("Getting tasks for user_id %s, sort_by: %s, limit: %s, after: %s", user_id, sort_by, limit, after)
         
         if not validate_id(user_id):
-            logging.error(f"Invalid user_id: {user_id}")
+            logger.error("Invalid user_id: %s", user_id)
             return {"error": "Invalid user_id"}
         
+        if limit is not None and limit < 1:
+            logger.error("Invalid limit: %s", limit)
+            return {"error": "Limit must be positive"}
+        if limit is not None:
+            limit = min(limit, config['MAX_PAGE_SIZE'])
+        try:
+            after_key = decode_cursor(after) if after else None
+        except ValueError:
+            logger.error("Invalid cursor: %s", after)
+            return {"error": "Invalid cursor"}
+        
+        by_title = sort_by == 'title'
+        sort_key = task_sort_key(sort_by)
+        next_cursor = None
         tasks = []
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
                 query = "SELECT id, title, description, status, created_at FROM tasks WHERE user_id = ? AND deleted = 0"
-                if sort_by == 'title':
-                    query += " ORDER BY title"
+                params = [user_id]
+                if after_key:
+                    query += " AND (title, id) > (?, ?)" if by_title else " AND (created_at, id) < (?, ?)"
+                    params += list(after_key)
+                if by_title:
+                    query += " ORDER BY title, id"
                 else:
-                    query += " ORDER BY created_at DESC"
-                cursor.execute(query, (user_id,))
+                    query += " ORDER BY created_at DESC, id DESC"
+                if limit is not None:
+                    query += " LIMIT ?"
+                    params.append(limit + 1)
+                cursor.execute(query, params)
                 for row in cursor.fetchall():
                     tasks.append({
                         "task_id": row[0],
@@ -65,73 +129,90 @@ def get_tasks(user_id, storage, sort_by='created_at'):
                         "status": row[3],
                         "created_at": row[4]
                     })
+            if limit is not None and len(tasks) > limit:
+                tasks = tasks[:limit]
+                next_cursor = encode_cursor(sort_key(tasks[-1]))
+        elif storage == 'log':
+            records = (task_record(task) for task in open_store(config, 'TASKS_TXT').find('user_id', user_id))
+            tasks, next_cursor = select_page(records, sort_key, not by_title, after_key, limit)
         else:
             if not os.path.exists(config['TASKS_TXT']):
-                logging.info(f"Tasks file {config['TASKS_TXT']} does not exist")
+                logger.info("Tasks file %s does not exist", config['TASKS_TXT'])
                 return {"tasks": []}
             with lock_file(config['TASKS_TXT'], 'r') as f:
-                lines = f.readlines()
-            for line in lines:
-                parts = line.strip().split(':')
-                if len(parts) >= 7 and parts[1] == user_id and parts[6] == '0':
-                    tasks.append({
-                        "task_id": parts[0],
-                        "title": parts[2],
-                        "description": parts[3],
-                        "status": parts[4],
-                        "created_at": parts[5]
-                    })
-            if sort_by == 'title':
-                tasks.sort(key=lambda x: x['title'])
-            else:
-                tasks.sort(key=lambda x: x['created_at'], reverse=True)
+                parsed = (parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT']) for line in f)
+                records = (task_record(task) for task in parsed
+                           if task and task['user_id'] == user_id and task['deleted'] == '0')
+                tasks, next_cursor = select_page(records, sort_key, not by_title, after_key, limit)
         
-        logging.info(f"Retrieved {len(tasks)} tasks for user_id {user_id}")
-        return {"tasks": tasks}
+        logger.info("Retrieved %s tasks for user_id %s", len(tasks), user_id)
+        result = {"tasks": tasks}
+        if limit is not None:
+            result["next_cursor"] = next_cursor
+        return result
     except Exception as e:
-        logging.error(f"Failed to get tasks: {str(e)}")
+        logger.error("Failed to get tasks: %s", e)
         return {"error": f"Failed to get tasks: {str(e)}"}
 
+@timed
+@invalidates(shared=True)
 def delete_task(user_id, task_id, storage):
     try:
         config = get_config()
-        logging.info(f"Deleting task {task_id} for user_id {user_id}")
+        logger.info("Deleting task %s for user_id %s", task_id, user_id)
         
         if not validate_id(user_id) or not validate_id(task_id):
-            logging.error(f"Invalid user_id or task_id: {user_id}, {task_id}")
+            logger.error("Invalid user_id or task_id: %s, %s", user_id, task_id)
             return {"error": "Invalid user_id or task_id"}
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['TASKS_DB']) as conn:
+            with get_connection(config['TASKS_DB']) as conn:
                 cursor = conn.cursor()
-                cursor.execute("UPDATE tasks SET deleted = 1 WHERE id = ? AND user_id = ?", (task_id, user_id))
+                cursor.execute("UPDATE tasks SET deleted = 1, deleted_at = COALESCE(deleted_at, ?) WHERE id = ? AND user_id = ?",
+                               (datetime.datetime.now().isoformat(), task_id, user_id))
                 conn.commit()
                 if cursor.rowcount == 0:
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
+                    logger.error("Task %s not found or not owned by user %s", task_id, user_id)
                     return {"error": "Task not found or not owned by user"}
-                logging.info(f"Task {task_id} marked as deleted")
+                logger.info("Task %s marked as deleted", task_id)
                 return {"message": "Task deleted"}
+        elif storage == 'log':
+            from search import index_update
+            store = open_store(config, 'TASKS_TXT')
+            with index_update(config, storage, user_id) as index:
+                task = store.get(task_id)
+                if task is None or task['user_id'] != user_id or not store.delete(task_id):
+                    logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                    return {"error": "Task not found or not owned by user"}
+                if index is not None:
+                    index.remove_task(task_id)
+            record_deletion(config['TASKS_TXT'], task_id)
+            logger.info("Task %s marked as deleted", task_id)
+            return {"message": "Task deleted"}
         else:
             if not os.path.exists(config['TASKS_TXT']):
-                logging.info(f"Tasks file {config['TASKS_TXT']} does not exist")
+                logger.info("Tasks file %s does not exist", config['TASKS_TXT'])
                 return {"error": "Task not found"}
-            lines = []
+            from search import index_update
             found = False
-            with lock_file(config['TASKS_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['TASKS_TXT'], 'w') as f:
-                for line in lines:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 7 and parts[0] == task_id and parts[1] == user_id:
-                        f.write(f"{parts[0]}:{parts[1]}:{parts[2]}:{parts[3]}:{parts[4]}:{parts[5]}:1\n")
-                        found = True
-                    else:
-                        f.write(line)
-                if not found:
-                    logging.error(f"Task {task_id} not found or not owned by user {user_id}")
-                    return {"error": "Task not found or not owned by user"}
-            logging.info(f"Task {task_id} marked as deleted")
+            with index_update(config, storage, user_id) as index:
+                with rewrite_file(config['TASKS_TXT']) as (lines, f):
+                    for line in lines:
+                        task = parse_txt_line(line, TXT_LAYOUTS['TASKS_TXT'])
+                        if task and task['id'] == task_id and task['user_id'] == user_id:
+                            task['deleted'] = '1'
+                            f.write(format_txt_line(task, TXT_LAYOUTS['TASKS_TXT']))
+                            found = True
+                        else:
+                            f.write(line)
+                    if not found:
+                        logger.error("Task %s not found or not owned by user %s", task_id, user_id)
+                        return {"error": "Task not found or not owned by user"}
+                if index is not None:
+                    index.remove_task(task_id)
+            record_deletion(config['TASKS_TXT'], task_id)
+            logger.info("Task %s marked as deleted", task_id)
             return {"message": "Task deleted"}
     except Exception as e:
-        logging.error(f"Failed to delete task: {str(e)}")
+        logger.error("Failed to delete task: %s", e)
         return {"error": f"Failed to delete task: {str(e)}"}
\ No newline at end of file
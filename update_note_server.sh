@@ -40,6 +40,8 @@ cat > config.php <<EOF
 <?php
 define('PYTHON_PATH', '/usr/bin/python3');
 define('MAIN_PY_PATH', '$INSTALL_DIR/main.py');
+define('DAEMON_SOCKET', '$INSTALL_DIR/note_server.sock');
+define('UPLOAD_SPOOL_DIR', '$INSTALL_DIR/files/.incoming');
 
 \$languages = [
     'ru' => [
@@ -208,14 +210,79 @@ if [ $? -ne 0 ]; then
     exit 1
 fi
 
+# Параметры, которых нет в set.conf старых установок: без них демон и очередь писем
+# использовали бы пути по умолчанию, а config.php ищет сокет в каталоге установки
+if ! grep -q "^MAIL_SPOOL_DIR" "$INSTALL_DIR/set.conf"; then
+    echo "MAIL_SPOOL_DIR = $INSTALL_DIR/mail_spool" >> "$INSTALL_DIR/set.conf"
+fi
+if ! grep -q "^DAEMON_SOCKET" "$INSTALL_DIR/set.conf"; then
+    echo "DAEMON_SOCKET = $INSTALL_DIR/note_server.sock" >> "$INSTALL_DIR/set.conf"
+fi
+MAIL_SPOOL_DIR=$(grep "^MAIL_SPOOL_DIR" "$INSTALL_DIR/set.conf" | cut -d'=' -f2 | tr -d ' ')
+
 # Настройка прав доступа
 echo "Настройка прав доступа..."
+mkdir -p "$INSTALL_DIR/files/.incoming" "$MAIL_SPOOL_DIR"
+chown -R www-data:www-data "$MAIL_SPOOL_DIR"
 chown -R www-data:www-data "$INSTALL_DIR"
 chmod -R 755 "$INSTALL_DIR/files"
 chmod -R 644 "$INSTALL_DIR"/*.php "$INSTALL_DIR"/*.py "$INSTALL_DIR/set.conf"
 chmod 664 "$INSTALL_DIR/users.db" "$INSTALL_DIR/tasks.db" "$INSTALL_DIR/note_server.log"
 chmod +x "$INSTALL_DIR"/*.py
 
+# Применение миграций схемы
+echo "Применение миграций схемы..."
+sudo -u www-data python3 "$INSTALL_DIR/main.py" migrate_schema
+if [ $? -ne 0 ]; then
+    echo "Ошибка при применении миграций. Резервная копия сохранена в $BACKUP_DIR."
+    exit 1
+fi
+
+# Проверка холодного старта команд чтения: время импорта и модули, которые им загружать не нужно
+echo "Проверка времени запуска команд..."
+sudo -u www-data python3 "$INSTALL_DIR/bench/check_startup.py" > "$BACKUP_DIR/startup_check.json"
+if [ $? -ne 0 ]; then
+    echo "Команды чтения запускаются медленнее допустимого, отчёт: $BACKUP_DIR/startup_check.json."
+    echo "Резервная копия сохранена в $BACKUP_DIR."
+    exit 1
+fi
+
+# Служба и задания cron перезаписываются целиком, поэтому повторный запуск ничего не дублирует
+echo "Настройка службы note_server..."
+cat > /etc/systemd/system/note_server.service <<EOF
+[Unit]
+Description=Note Server Python daemon
+After=network.target
+
+[Service]
+User=www-data
+Group=www-data
+WorkingDirectory=$INSTALL_DIR
+ExecStart=/usr/bin/python3 $INSTALL_DIR/main.py serve
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+systemctl daemon-reload
+systemctl enable note_server.service
+
+echo "Настройка заданий cron..."
+cat > /etc/cron.d/note_server_gc <<EOF
+30 3 * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py gc_blobs >/dev/null 2>&1
+EOF
+cat > /etc/cron.d/note_server_purge <<EOF
+0 4 * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py purge >/dev/null 2>&1
+EOF
+cat > /etc/cron.d/note_server_mail <<EOF
+*/5 * * * * www-data /usr/bin/python3 $INSTALL_DIR/main.py send_mail >/dev/null 2>&1
+EOF
+
+# Перезапуск фонового процесса Python
+echo "Перезапуск службы note_server..."
+systemctl restart note_server.service
+
 # Перезапуск Apache
 echo "Перезапуск Apache..."
 systemctl restart apache2
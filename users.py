@@ -1,236 +1,289 @@
-import sqlite3
-import bcrypt
-import secrets
 import os
 import logging
-import smtplib
 import datetime
-from email.mime.text import MIMEText
+import threading
 from config import get_config
-from utils import lock_file, validate_username, validate_password, validate_email
+from metrics import timed
+from db import get_connection
+from utils import lock_file, rewrite_file, validate_username, validate_password, validate_email, parse_txt_line, TXT_LAYOUTS
+from logstore import open_store
 
+logger = logging.getLogger(__name__)
+
+_txt_users = {'path': None, 'stamp': None, 'id': {}, 'username': {}, 'email': {}}
+_txt_users_lock = threading.Lock()
+
+def txt_users(config):
+    # Индекс users.txt в памяти; перечитывается, только когда файл изменился
+    path = config['USERS_TXT']
+    try:
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    except FileNotFoundError:
+        stamp = None
+    with _txt_users_lock:
+        if _txt_users['path'] == path and _txt_users['stamp'] == stamp:
+            return _txt_users
+        index = {'path': path, 'stamp': None, 'id': {}, 'username': {}, 'email': {}}
+        if stamp is not None:
+            with lock_file(path, 'r') as f:
+                st = os.fstat(f.fileno())
+                index['stamp'] = (st.st_mtime_ns, st.st_size, st.st_ino)
+                for line in f:
+                    user = parse_txt_line(line, TXT_LAYOUTS['USERS_TXT'])
+                    if user:
+                        index['id'].setdefault(user['id'], user)
+                        index['username'].setdefault(user['username'], user)
+                        index['email'].setdefault(user['email'], user)
+        _txt_users.update(index)
+        return _txt_users
+
+def find_txt_user(config, field, value):
+    return txt_users(config)[field].get(value)
+
+@timed
 def register_user(username, password, email, storage):
+    import secrets
+    from passwords import hash_password
     try:
         config = get_config()
-        logging.info(f"Registering user: {username}")
+        logger.info("Registering user: %s", username)
         
         if not validate_username(username):
-            logging.error(f"Invalid username: {username}")
+            logger.error("Invalid username: %s", username)
             return {"error": "Invalid username"}
         
         if not validate_password(password):
-            logging.error(f"Invalid password for user: {username}")
+            logger.error("Invalid password for user: %s", username)
             return {"error": "Password must be at least 8 characters long and contain letters or numbers"}
         
         if not validate_email(email):
-            logging.error(f"Invalid email for user: {username}")
+            logger.error("Invalid email for user: %s", username)
             return {"error": "Invalid email format"}
         
         if user_exists(username, storage):
-            logging.error(f"User already exists: {username}")
+            logger.error("User already exists: %s", username)
             return {"error": "User already exists"}
         
         user_id = secrets.token_hex(8)
-        password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        password_hash = hash_password(password)
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("INSERT INTO users (id, username, password_hash, email, language, theme) VALUES (?, ?, ?, ?, 'ru', 'light')",
                               (user_id, username, password_hash, email))
                 conn.commit()
-                logging.info(f"User {username} registered in SQLite with id {user_id}")
+                logger.info("User %s registered in SQLite with id %s", username, user_id)
                 return {"message": "User registered", "user_id": user_id}
+        elif storage == 'log':
+            open_store(config, 'USERS_TXT').put({
+                "id": user_id,
+                "username": username,
+                "password_hash": password_hash,
+                "email": email,
+                "language": "ru",
+                "theme": "light"
+            })
+            logger.info("User %s registered in log storage with id %s", username, user_id)
+            return {"message": "User registered", "user_id": user_id}
         else:
             with lock_file(config['USERS_TXT'], 'a') as f:
                 f.write(f"{user_id}:{username}:{password_hash}:{email}:ru:light\n")
-            logging.info(f"User {username} registered in txt with id {user_id}")
+            logger.info("User %s registered in txt with id %s", username, user_id)
             return {"message": "User registered", "user_id": user_id}
     except Exception as e:
-        logging.error(f"Failed to register user: {str(e)}")
+        logger.error("Failed to register user: %s", e)
         return {"error": f"Failed to register user: {str(e)}"}
 
+@timed
 def login_user(username, password, storage):
+    # bcrypt загружается только командами, которые работают с паролями
+    from passwords import check_password, needs_rehash
     try:
         config = get_config()
-        logging.info(f"Attempting login for user: {username}")
+        logger.info("Attempting login for user: %s", username)
         
         if not validate_username(username):
-            logging.error(f"Invalid username: {username}")
+            logger.error("Invalid username: %s", username)
             return {"error": "Invalid username"}
         
-        password_bytes = password.encode('utf-8')
-        
+        candidates = []
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
-                result = cursor.fetchone()
-                if result and bcrypt.checkpw(password_bytes, result[1].encode('utf-8')):
-                    user_id = result[0]
-                    logging.info(f"Login successful for user: {username}, user_id: {user_id}")
-                    return {"message": "Login successful", "user_id": user_id}
-                logging.error(f"Invalid credentials for user: {username}")
-                return {"error": "Invalid credentials"}
+                candidates = cursor.fetchall()
+        elif storage == 'log':
+            candidates = [(user['id'], user['password_hash']) for user in open_store(config, 'USERS_TXT').find('username', username)]
         else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
-                return {"error": "Invalid credentials"}
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                for line in f:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 4 and parts[1] == username and bcrypt.checkpw(password_bytes, parts[2].encode('utf-8')):
-                        user_id = parts[0]
-                        logging.info(f"Login successful for user: {username}, user_id: {user_id}")
-                        return {"message": "Login successful", "user_id": user_id}
-                logging.error(f"Invalid credentials for user: {username}")
-                return {"error": "Invalid credentials"}
+            user = find_txt_user(config, 'username', username)
+            if user:
+                candidates.append((user['id'], user['password_hash']))
+        
+        # Проверка пароля выполняется вне блокировок файлов и соединений с БД
+        for user_id, password_hash in candidates:
+            if check_password(password, password_hash):
+                logger.info("Login successful for user: %s, user_id: %s", username, user_id)
+                if needs_rehash(password_hash):
+                    rehash_password(config, user_id, password, storage)
+                return {"message": "Login successful", "user_id": user_id}
+        logger.error("Invalid credentials for user: %s", username)
+        return {"error": "Invalid credentials"}
     except Exception as e:
-        logging.error(f"Failed to login user: {str(e)}")
+        logger.error("Failed to login user: %s", e)
         return {"error": f"Failed to login user: {str(e)}"}
 
 def user_exists(username, storage):
     try:
         config = get_config()
-        logging.info(f"Checking if user {username} exists")
+        logger.info("Checking if user %s exists", username)
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT 1 FROM users WHERE username = ?", (username,))
                 exists = cursor.fetchone() is not None
-                logging.info(f"User {username} exists: {exists}")
+                logger.info("User %s exists: %s", username, exists)
                 return exists
+        elif storage == 'log':
+            exists = bool(open_store(config, 'USERS_TXT').find('username', username))
+            logger.info("User %s exists: %s", username, exists)
+            return exists
         else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
-                return False
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                for line in f:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 2 and parts[1] == username:
-                        logging.info(f"User {username} found")
-                        return True
-                logging.info(f"User {username} not found")
-                return False
+            exists = find_txt_user(config, 'username', username) is not None
+            logger.info("User %s exists: %s", username, exists)
+            return exists
     except Exception as e:
-        logging.error(f"Failed to check user existence: {str(e)}")
+        logger.error("Failed to check user existence: %s", e)
         return {"error": f"Failed to check user existence: {str(e)}"}
 
 def get_username(user_id, storage):
     try:
         config = get_config()
-        logging.info(f"Getting username for user_id {user_id}")
+        logger.info("Getting username for user_id %s", user_id)
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT username FROM users WHERE id = ?", (user_id,))
                 result = cursor.fetchone()
                 if result:
-                    logging.info(f"Username for user_id {user_id}: {result[0]}")
+                    logger.info("Username for user_id %s: %s", user_id, result[0])
                     return {"username": result[0]}
-                logging.error(f"User_id {user_id} not found")
+                logger.error("User_id %s not found", user_id)
                 return {"error": "User not found"}
+        elif storage == 'log':
+            user = open_store(config, 'USERS_TXT').get(user_id)
+            if user:
+                logger.info("Username for user_id %s: %s", user_id, user['username'])
+                return {"username": user['username']}
+            logger.error("User_id %s not found", user_id)
+            return {"error": "User not found"}
         else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
-                return {"error": "User not found"}
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                for line in f:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 2 and parts[0] == user_id:
-                        logging.info(f"Username for user_id {user_id}: {parts[1]}")
-                        return {"username": parts[1]}
-                logging.error(f"User_id {user_id} not found")
-                return {"error": "User not found"}
+            user = find_txt_user(config, 'id', user_id)
+            if user:
+                logger.info("Username for user_id %s: %s", user_id, user['username'])
+                return {"username": user['username']}
+            logger.error("User_id %s not found", user_id)
+            return {"error": "User not found"}
     except Exception as e:
-        logging.error(f"Failed to get username: {str(e)}")
+        logger.error("Failed to get username: %s", e)
         return {"error": f"Failed to get username: {str(e)}"}
 
+def update_password_hash(config, user_id, password_hash, storage):
+    if storage == 'sqlite':
+        with get_connection(config['USERS_DB']) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (password_hash, user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+    elif storage == 'log':
+        return open_store(config, 'USERS_TXT').update(user_id, password_hash=password_hash) is not None
+    else:
+        if not os.path.exists(config['USERS_TXT']):
+            logger.info("Users file %s does not exist", config['USERS_TXT'])
+            return False
+        found = False
+        with rewrite_file(config['USERS_TXT']) as (lines, f):
+            for line in lines:
+                parts = line.strip().split(':')
+                if len(parts) >= 6 and parts[0] == user_id:
+                    f.write(f"{parts[0]}:{parts[1]}:{password_hash}:{parts[3]}:{parts[4]}:{parts[5]}\n")
+                    found = True
+                else:
+                    f.write(line)
+        return found
+
+def rehash_password(config, user_id, password, storage):
+    from passwords import hash_password
+    try:
+        update_password_hash(config, user_id, hash_password(password), storage)
+        logger.info("Password hash for user_id %s upgraded to cost %s", user_id, config['BCRYPT_ROUNDS'])
+    except Exception as e:
+        logger.error("Failed to rehash password for user_id %s: %s", user_id, e)
+
+@timed
 def change_password(user_id, new_password, storage):
+    from passwords import hash_password
     try:
         config = get_config()
-        logging.info(f"Changing password for user_id {user_id}")
+        logger.info("Changing password for user_id %s", user_id)
         
         if not validate_password(new_password):
-            logging.error(f"Invalid new password for user_id {user_id}")
+            logger.error("Invalid new password for user_id %s", user_id)
             return {"error": "New password must be at least 8 characters long and contain letters or numbers"}
         
-        new_password_hash = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        new_password_hash = hash_password(new_password)
         
-        if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
-                cursor = conn.cursor()
-                cursor.execute("UPDATE users SET password_hash = ? WHERE id = ?", (new_password_hash, user_id))
-                conn.commit()
-                if cursor.rowcount == 0:
-                    logging.error(f"User_id {user_id} not found")
-                    return {"error": "User not found"}
-                logging.info(f"Password changed for user_id {user_id}")
-                return {"message": "Password changed"}
-        else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
-                return {"error": "User not found"}
-            lines = []
-            found = False
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['USERS_TXT'], 'w') as f:
-                for line in lines:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 6 and parts[0] == user_id:
-                        f.write(f"{parts[0]}:{parts[1]}:{new_password_hash}:{parts[3]}:{parts[4]}:{parts[5]}\n")
-                        found = True
-                    else:
-                        f.write(line)
-                if not found:
-                    logging.error(f"User_id {user_id} not found")
-                    return {"error": "User not found"}
-            logging.info(f"Password changed for user_id {user_id}")
-            return {"message": "Password changed"}
+        if not update_password_hash(config, user_id, new_password_hash, storage):
+            logger.error("User_id %s not found", user_id)
+            return {"error": "User not found"}
+        logger.info("Password changed for user_id %s", user_id)
+        return {"message": "Password changed"}
     except Exception as e:
-        logging.error(f"Failed to change password: {str(e)}")
+        logger.error("Failed to change password: %s", e)
         return {"error": f"Failed to change password: {str(e)}"}
 
+@timed
 def request_password_reset(email, storage):
+    import secrets
+    from mailer import enqueue_mail
     try:
         config = get_config()
-        logging.info(f"Requesting password reset for email: {email}")
+        logger.info("Requesting password reset for email: %s", email)
         
         if not validate_email(email):
-            logging.error(f"Invalid email: {email}")
+            logger.error("Invalid email: %s", email)
             return {"error": "Invalid email format"}
         
         user_id = None
         username = None
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT id, username FROM users WHERE email = ?", (email,))
                 result = cursor.fetchone()
                 if not result:
-                    logging.error(f"No user found with email: {email}")
+                    logger.error("No user found with email: %s", email)
                     return {"error": "No user found with this email"}
                 user_id, username = result
+        elif storage == 'log':
+            users = open_store(config, 'USERS_TXT').find('email', email)
+            if not users:
+                logger.error("No user found with email: %s", email)
+                return {"error": "No user found with this email"}
+            user_id, username = users[0]['id'], users[0]['username']
         else:
-            if not os.path.exists(config['USERS_TXT']):
-                logging.info(f"Users file {config['USERS_TXT']} does not exist")
+            user = find_txt_user(config, 'email', email)
+            if not user:
+                logger.error("No user found with email: %s", email)
                 return {"error": "No user found with this email"}
-            with lock_file(config['USERS_TXT'], 'r') as f:
-                for line in f:
-                    parts = line.strip().split(':')
-                    if len(parts) >= 4 and parts[3] == email:
-                        user_id, username = parts[0], parts[1]
-                        break
-                if not user_id:
-                    logging.error(f"No user found with email: {email}")
-                    return {"error": "No user found with this email"}
+            user_id, username = user['id'], user['username']
         
         token = secrets.token_urlsafe(32)
         expiry = datetime.datetime.now() + datetime.timedelta(hours=1)
         
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("INSERT OR REPLACE INTO reset_tokens (user_id, token, expiry) VALUES (?, ?, ?)",
                               (user_id, token, expiry.isoformat()))
@@ -240,53 +293,44 @@ def request_password_reset(email, storage):
                 f.write(f"{user_id}:{token}:{expiry.isoformat()}\n")
         
         reset_link = f"http://{config['SERVER_HOST']}/welcome.php?tab=reset&token={token}"
-        msg = MIMEText(f"Click this link to reset your password: {reset_link}\nThis link will expire in 1 hour.")
-        msg['Subject'] = 'Password Reset Request'
-        msg['From'] = config['SMTP_FROM']
-        msg['To'] = email
-        
-        with smtplib.SMTP(config['SMTP_HOST'], config['SMTP_PORT']) as server:
-            server.starttls()
-            server.login(config['SMTP_USER'], config['SMTP_PASS'])
-            server.sendmail(config['SMTP_FROM'], email, msg.as_string())
+        enqueue_mail(email, 'Password Reset Request',
+                     f"Click this link to reset your password: {reset_link}\nThis link will expire in 1 hour.", storage)
         
-        logging.info(f"Password reset link sent to {email}")
+        logger.info("Password reset link queued for %s", email)
         return {"message": "Password reset link sent to your email"}
     except Exception as e:
-        logging.error(f"Failed to request password reset: {str(e)}")
+        logger.error("Failed to request password reset: %s", e)
         return {"error": f"Failed to request password reset: {str(e)}"}
 
+@timed
 def reset_password(token, new_password, storage):
     try:
         config = get_config()
-        logging.info(f"Resetting password with token: {token}")
+        logger.info("Resetting password by token")
         
         if not validate_password(new_password):
-            logging.error(f"Invalid new password")
+            logger.error("Invalid new password")
             return {"error": "New password must be at least 8 characters long and contain letters or numbers"}
         
         user_id = None
         if storage == 'sqlite':
-            with sqlite3.connect(config['USERS_DB']) as conn:
+            with get_connection(config['USERS_DB']) as conn:
                 cursor = conn.cursor()
                 cursor.execute("SELECT user_id FROM reset_tokens WHERE token = ? AND expiry > ?",
                               (token, datetime.datetime.now().isoformat()))
                 result = cursor.fetchone()
                 if not result:
-                    logging.error(f"Invalid or expired token: {token}")
+                    logger.error("Invalid or expired reset token")
                     return {"error": "Invalid or expired token"}
                 user_id = result[0]
                 cursor.execute("DELETE FROM reset_tokens WHERE token = ?", (token,))
                 conn.commit()
         else:
             if not os.path.exists(config['RESET_TOKENS_TXT']):
-                logging.info(f"Reset tokens file {config['RESET_TOKENS_TXT']} does not exist")
+                logger.info("Reset tokens file %s does not exist", config['RESET_TOKENS_TXT'])
                 return {"error": "Invalid or expired token"}
-            lines = []
             found = False
-            with lock_file(config['RESET_TOKENS_TXT'], 'r') as f:
-                lines = f.readlines()
-            with lock_file(config['RESET_TOKENS_TXT'], 'w') as f:
+            with rewrite_file(config['RESET_TOKENS_TXT']) as (lines, f):
                 for line in lines:
                     parts = line.strip().split(':')
                     if len(parts) >= 3 and parts[1] == token and datetime.datetime.fromisoformat(parts[2]) > datetime.datetime.now():
@@ -295,10 +339,12 @@ def reset_password(token, new_password, storage):
                     else:
                         f.write(line)
                 if not found:
-                    logging.error(f"Invalid or expired token: {token}")
+                    logger.error("Invalid or expired reset token")
                     return {"error": "Invalid or expired token"}
         
+        # Сам токен в журнал не пишется: по нему можно сменить пароль
+        logger.info("Reset token accepted for user_id %s", user_id)
         return change_password(user_id, new_password, storage)
     except Exception as e:
-        logging.error(f"Failed to reset password: {str(e)}")
+        logger.error("Failed to reset password: %s", e)
         return {"error": f"Failed to reset password: {str(e)}"}
\ No newline at end of file
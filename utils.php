@@ -21,7 +21,58 @@ function validate_csrf_token($token) {
     return $valid;
 }
 
-function python_exec($command) {
+function python_daemon_call($command, $args) {
+    if (!defined('DAEMON_SOCKET') || !file_exists(DAEMON_SOCKET)) {
+        return null;
+    }
+    $socket = @stream_socket_client('unix://' . DAEMON_SOCKET, $errno, $errstr, 1);
+    if (!$socket) {
+        error_log("Daemon connection failed: $errstr");
+        return null;
+    }
+    stream_set_timeout($socket, 30);
+    fwrite($socket, json_encode(['command' => $command, 'args' => array_values($args)]) . "\n");
+    $response = fgets($socket);
+    fclose($socket);
+    if ($response === false) {
+        // Команда уже отправлена, повторный запуск через exec мог бы выполнить её дважды
+        return json_encode(['error' => 'No response from daemon']);
+    }
+    return rtrim($response, "\n");
+}
+
+// Команды с телом после строки JSON-заголовка: возвращает [заголовок, поток с телом, функция закрытия]
+function python_stream($command, $args) {
+    if (defined('DAEMON_SOCKET') && file_exists(DAEMON_SOCKET)) {
+        $socket = @stream_socket_client('unix://' . DAEMON_SOCKET, $errno, $errstr, 1);
+        if ($socket) {
+            stream_set_timeout($socket, 30);
+            fwrite($socket, json_encode(['command' => $command, 'args' => array_values($args)]) . "\n");
+            $header = fgets($socket);
+            return [json_decode((string)$header, true), $socket, function () use ($socket) { fclose($socket); }];
+        }
+        error_log("Daemon connection failed: $errstr");
+    }
+    $cmd = PYTHON_PATH . " " . escapeshellarg(MAIN_PY_PATH) . " " . escapeshellarg($command) . " " . implode(" ", array_map('escapeshellarg', $args));
+    $process = proc_open($cmd, [1 => ['pipe', 'w'], 2 => ['file', '/dev/null', 'a']], $pipes);
+    if (!is_resource($process)) {
+        return [null, null, function () {}];
+    }
+    $header = fgets($pipes[1]);
+    return [json_decode((string)$header, true), $pipes[1], function () use ($process, $pipes) {
+        fclose($pipes[1]);
+        proc_close($process);
+    }];
+}
+
+function python_exec($command, $args = null) {
+    if (is_array($args)) {
+        $response = python_daemon_call($command, $args);
+        if ($response !== null) {
+            return [[$response], 0];
+        }
+        $command = PYTHON_PATH . " " . escapeshellarg(MAIN_PY_PATH) . " " . escapeshellarg($command) . " " . implode(" ", array_map('escapeshellarg', $args));
+    }
     $output = [];
     $return_var = 0;
     exec($command . " 2>&1", $output, $return_var);
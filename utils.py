@@ -1,37 +1,132 @@
 import fcntl
 import os
 import re
+import stat
+import time
+import threading
+import json
+import heapq
 import logging
-import mimetypes
+import datetime
+from metrics import timer
+
+logger = logging.getLogger(__name__)
+
+LOCK_POLL_INTERVAL = 0.01
+# Журнал времени удаления рядом с txt-файлом: формат строк задач и заметок не меняется
+DELETED_SUFFIX = '.deleted'
+
+class LockTimeout(Exception):
+    pass
 
 class FileLock:
-    def __init__(self, file_path, mode):
+    def __init__(self, file_path, mode, exclusive=None, timeout=None):
         self.file_path = file_path
         self.mode = mode
+        # Чтение берёт разделяемую блокировку, любая запись - исключительную
+        self.exclusive = ('r' not in mode or '+' in mode) if exclusive is None else exclusive
+        self.timeout = timeout
         self.file = None
 
+    def _acquire(self, operation):
+        if self.timeout is None:
+            fcntl.flock(self.file.fileno(), operation)
+            return
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.file.fileno(), operation | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    raise LockTimeout(f"Timed out waiting for lock on {self.file_path}")
+                time.sleep(LOCK_POLL_INTERVAL)
+
     def __enter__(self):
+        operation = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
         try:
-            self.file = open(self.file_path, self.mode)
-            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
-            return self.file
+            while True:
+                self.file = open(self.file_path, self.mode)
+                with timer('lock_wait', 'exclusive' if self.exclusive else 'shared'):
+                    self._acquire(operation)
+                # Пока мы ждали, файл мог быть атомарно заменён через rewrite_file
+                try:
+                    if os.stat(self.file_path).st_ino == os.fstat(self.file.fileno()).st_ino:
+                        return self.file
+                except FileNotFoundError:
+                    pass
+                self.file.close()
+                self.file = None
         except Exception as e:
-            logging.error(f"Failed to lock file {self.file_path}: {str(e)}")
+            # Для try_lock_file занятая блокировка - обычный исход, а не ошибка
+            if not isinstance(e, LockTimeout) or self.timeout:
+                logger.error("Failed to lock file %s: %s", self.file_path, e)
             if self.file:
                 self.file.close()
+                self.file = None
             raise
 
     def __exit__(self, exc_type, exc_value, traceback):
         try:
             if self.file:
+                # Буфер нужно сбросить до снятия блокировки, иначе запись попадёт в файл без неё
+                self.file.flush()
                 fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
                 self.file.close()
         except Exception as e:
-            logging.error(f"Failed to unlock file {self.file_path}: {str(e)}")
+            logger.error("Failed to unlock file %s: %s", self.file_path, e)
             raise
 
-def lock_file(file_path, mode):
-    return FileLock(file_path, mode)
+class FileRewrite:
+    # Читает файл под исключительной блокировкой и заменяет его целиком через временный файл,
+    # так что читатели видят либо старое, либо новое содержимое
+    def __init__(self, file_path, timeout=None):
+        self.file_path = file_path
+        self.lock = FileLock(file_path, 'r', exclusive=True, timeout=timeout)
+        self.tmp_path = None
+        self.out = None
+        self.discarded = False
+
+    def discard(self):
+        # Ничего не изменилось: файл остаётся прежним, временный файл удаляется
+        self.discarded = True
+
+    def __enter__(self):
+        source = self.lock.__enter__()
+        try:
+            lines = source.readlines()
+            self.tmp_path = f"{self.file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            self.out = open(self.tmp_path, 'w')
+            os.chmod(self.tmp_path, stat.S_IMODE(os.fstat(source.fileno()).st_mode))
+        except BaseException:
+            if self.out:
+                self.out.close()
+                os.remove(self.tmp_path)
+            self.lock.__exit__(None, None, None)
+            raise
+        return lines, self.out
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None and not self.discarded:
+                self.out.flush()
+                os.fsync(self.out.fileno())
+                self.out.close()
+                os.replace(self.tmp_path, self.file_path)
+            else:
+                self.out.close()
+                os.remove(self.tmp_path)
+        finally:
+            self.lock.__exit__(exc_type, exc_value, traceback)
+
+def lock_file(file_path, mode, timeout=None):
+    return FileLock(file_path, mode, timeout=timeout)
+
+def try_lock_file(file_path, mode):
+    return FileLock(file_path, mode, timeout=0)
+
+def rewrite_file(file_path, timeout=None):
+    return FileRewrite(file_path, timeout=timeout)
 
 def validate_username(username):
     return bool(re.match(r'^[a-zA-Z0-9_]{3,20}$', username))
@@ -46,11 +141,12 @@ def safe_path(base_dir, path):
     abs_base = os.path.abspath(base_dir)
     abs_path = os.path.abspath(os.path.join(base_dir, path))
     if not abs_path.startswith(abs_base):
-        logging.error(f"Invalid path: {abs_path} is outside {abs_base}")
+        logger.error("Invalid path: %s is outside %s", abs_path, abs_base)
         raise ValueError("Invalid path")
     return abs_path
 
 def validate_file_mime(file_path):
+    import mimetypes
     mime_type, _ = mimetypes.guess_type(file_path)
     allowed_mimes = ['text/plain', 'image/jpeg', 'image/png', 'application/pdf']
     return mime_type in allowed_mimes if mime_type else False
@@ -59,4 +155,94 @@ def validate_id(id_str):
     return bool(re.match(r'^[a-f0-9]{16}$', id_str))
 
 def validate_task_title(title):
-    return bool(re.match(r'^[a-zA-Z0-9\s]{1,100}$', title))
\ No newline at end of file
+    return bool(re.match(r'^[a-zA-Z0-9\s]{1,100}$', title))
+
+# Раскладка строк txt-файлов: поля слева, свободное поле (может содержать ':'),
+# поля справа с числом занимаемых частей (created_at в isoformat содержит два ':')
+TXT_LAYOUTS = {
+    'USERS_TXT': (('id', 'username', 'password_hash', 'email', 'language', 'theme'), None, ()),
+    'TASKS_TXT': (('id', 'user_id', 'title'), 'description', (('status', 1), ('created_at', 3), ('deleted', 1))),
+    'NOTES_TXT': (('id', 'user_id', 'task_id'), 'content', (('created_at', 3), ('deleted', 1))),
+    'SUBTASKS_TXT': (('id', 'task_id', 'title', 'completed'), None, ()),
+    'SHARED_NOTES_TXT': (('user_id', 'target_user_id', 'note_id'), None, ()),
+    'RESET_TOKENS_TXT': (('user_id', 'token'), None, (('expiry', 3),)),
+}
+
+def parse_txt_line(line, layout):
+    leading, free, trailing = layout
+    parts = line.rstrip('\n').split(':')
+    if trailing and trailing[-1][0] == 'deleted' and parts[-1] not in ('0', '1'):
+        # create_task пишет строку без флага deleted
+        parts.append('0')
+    record = {}
+    for name in leading:
+        if not parts:
+            return None
+        record[name] = parts.pop(0)
+    for name, span in reversed(trailing):
+        if len(parts) < span:
+            return None
+        record[name] = ':'.join(parts[-span:])
+        del parts[-span:]
+    if free is not None:
+        record[free] = ':'.join(parts)
+    elif parts:
+        return None
+    return record
+
+def format_txt_line(record, layout):
+    leading, free, trailing = layout
+    fields = [record[name] for name in leading]
+    if free is not None:
+        fields.append(record[free])
+    fields += [record[name] for name, _ in trailing]
+    return ':'.join(str(field) for field in fields) + '\n'
+
+def parse_files_line(line):
+    parts = line.rstrip('\n').split(':')
+    if len(parts) < 6:
+        return None
+    sha256 = parts[-1] if len(parts) >= 8 and len(parts[-1]) == 64 else None
+    end = len(parts) - 2 if sha256 else len(parts)
+    path_start = next((i for i in range(5, end) if parts[i].startswith('/')), 5)
+    return {"id": parts[0], "user_id": parts[1], "task_id": parts[2],
+            "filename": ':'.join(parts[3:path_start - 1]), "mime_type": None if parts[path_start - 1] == 'None' else parts[path_start - 1],
+            "path": ':'.join(parts[path_start:end]), "size": int(parts[-2]) if sha256 else None,
+            "sha256": sha256}
+
+def record_deletion(path, record_id):
+    with lock_file(path + DELETED_SUFFIX, 'a') as f:
+        f.write(f"{record_id}:{datetime.datetime.now().isoformat()}\n")
+
+def format_files_line(record):
+    # Старые записи без размера и хеша остаются шестипольными
+    fields = [record['id'], record['user_id'], record['task_id'], record['filename'], record['mime_type'], record['path']]
+    if record['sha256']:
+        fields += [record['size'], record['sha256']]
+    return ':'.join(str(field) for field in fields) + '\n'
+
+def encode_cursor(key):
+    import base64
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    import base64
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(key, list) or len(key) != 2 or not all(isinstance(part, str) for part in key):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+def select_page(records, key, descending, after=None, limit=None):
+    # Keyset-страница: записи строго после курсора, отбор top-k кучей вместо полной сортировки
+    if after is not None:
+        records = (record for record in records if (key(record) < after if descending else key(record) > after))
+    if limit is None:
+        return sorted(records, key=key, reverse=descending), None
+    select = heapq.nlargest if descending else heapq.nsmallest
+    page = select(limit + 1, records, key=key)
+    if len(page) > limit:
+        return page[:limit], encode_cursor(key(page[limit - 1]))
+    return page, None
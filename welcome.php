@@ -26,10 +26,7 @@ include 'layout.php';
 
 // Функция для выполнения команды регистрации
 function execute_register($username, $password, $email) {
-    $cmd = escapeshellcmd("python3 /var/www/html/main.py register " . escapeshellarg($username) . " " . escapeshellarg($password) . " " . escapeshellarg($email));
-    $output = [];
-    $return_var = 0;
-    exec($cmd, $output, $return_var);
+    list($output, $return_var) = python_exec('register', [$username, $password, $email]);
     $output = implode("\n", $output);
     error_log("Register main.py output: $output");
     error_log("Register main.py return_var: $return_var");